@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import re
+
 from setuptools import setup, find_packages
 
+with open('ventmap/__init__.py') as f:
+    version = re.search(r'__version__ = "(.*)"', f.read()).group(1)
 
 setup(name='ventmap',
       author='Gregory Rehm',
       author_email='grehm87@gmail.com',
-      version="1.5.3",
+      version=version,
       description='Ventilator Multi-Analytic Platform for analysis of ventilator waveform data',
       python_requires=">=2.7",
       packages=find_packages(exclude=["*tests*"]),
@@ -17,6 +21,10 @@ setup(name='ventmap',
           'prettytable',
           'scipy',
       ],
+      extras_require={
+          'parquet': ['pyarrow'],
+          'zstd': ['zstandard'],
+      },
       entry_points={
           'console_scripts': [
               'anonymize_datetimes=ventmap.anonymize_datatimes:main',
@@ -24,6 +32,7 @@ setup(name='ventmap',
               'clear_null_bytes=ventmap.clear_null_bytes:main',
               'cut_breath_section=ventmap.cut_breath_section:main',
               'breath_meta=ventmap.breath_meta:main',
+              'build_breath_index=ventmap.breath_index:main',
               'preprocess_breath_files=ventmap.preprocess_all_files:main',
           ]
       },
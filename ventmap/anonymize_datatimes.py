@@ -30,6 +30,9 @@ from warnings import warn
 import numpy as np
 import pandas as pd
 
+from ventmap.processed_file import load_processed
+from ventmap.timestamps import NO_TIMESTAMP, timedelta_to_us
+
 old_file_date_pattern = re.compile(r'(\d{4}-\d{2}-\d{2}__\d{2}:\d{2}:\d{2}.\d{9})')
 text_date_pattern = re.compile(r'(\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}.\d{6})')
 three_col_regex_search_pattern = re.compile(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}.\d{6})')
@@ -143,17 +146,16 @@ class File(object):
             return True, new_filename
 
     def process_npy_file(self):
-        processed = np.load(self.filename)
-        abs_bs_loc = 2
-        for i, arr in enumerate(processed):
-            abs_bs = arr[abs_bs_loc]
-            try:
-                converted = datetime.strptime(abs_bs, npy_datetime_time_pattern) + timedelta(hours=self.shift_hours)
-            except ValueError:
-                warn('file: {} had improperly formated datetime information.'.format(self.filename))
-                return False, self.filename
-
-            processed[i][abs_bs_loc] = converted.strftime(npy_datetime_time_pattern)
+        try:
+            # legacy files are converted to the current layout when loaded
+            processed = np.array(load_processed(self.filename, mmap_mode=None))
+        except ValueError:
+            processed = None
+        if processed is None or (processed['abs_bs'] == NO_TIMESTAMP).any():
+            warn('file: {} had improperly formated datetime information.'.format(self.filename))
+            return False, self.filename
+
+        processed['abs_bs'] += timedelta_to_us(timedelta(hours=self.shift_hours))
         filename_obj = Filename(self.filename, self.shift_hours, self.patient_id, self.new_patient_id, self.only_shift_date)
         new_filename = filename_obj.get_new_filename()
         np.save(new_filename, processed)
@@ -0,0 +1,86 @@
+"""
+ventmap.async_stream
+~~~~~~~~~~~~~~~~~~~~
+
+Parse breaths out of ventilator data arriving over the network with asyncio,
+so that a single process can serve many ventilator feeds at once. Breaths are
+the same as would be output by extract_raw on the full data.
+
+Usage:
+
+    async def handle_vent(reader, writer):
+        async for breath in stream_breaths(reader):
+            ...
+
+    await asyncio.start_server(handle_vent, host, port)
+
+Requires python 3.6+
+"""
+from ventmap.follow import ChunkParser
+from ventmap.raw_utils import PB840File
+
+# maximum number of bytes to read from a stream at a time
+READ_SIZE = 2 ** 16
+
+
+async def stream_breaths(reader,
+                         skip_breaths_without_be=False,
+                         rel_bn_interval=[],
+                         vent_bn_interval=[],
+                         spec_rel_bns=[],
+                         spec_vent_bns=[],
+                         vent_cls=PB840File,
+                         read_size=READ_SIZE):
+    """
+    Yield breaths read from an asyncio.StreamReader until it reaches EOF
+
+    :param reader: asyncio.StreamReader, or any object with an async read(n) method
+    :param vent_cls: ventilator class to parse the data with
+    :param read_size: maximum number of bytes to read at a time
+
+    Other arguments are the same as extract_raw
+    """
+    parser = ChunkParser(skip_breaths_without_be, rel_bn_interval, vent_bn_interval,
+                         spec_rel_bns, spec_vent_bns, vent_cls)
+    while not parser.done:
+        data = await reader.read(read_size)
+        if not data:
+            break
+        for breath in parser.feed(data):
+            yield breath
+    for breath in parser.close():
+        yield breath
+
+
+async def chunk_breaths(chunks,
+                        skip_breaths_without_be=False,
+                        rel_bn_interval=[],
+                        vent_bn_interval=[],
+                        spec_rel_bns=[],
+                        spec_vent_bns=[],
+                        vent_cls=PB840File):
+    """
+    Yield breaths parsed from chunks of raw bytes. Chunks do not need to
+    end on a line boundary.
+
+    :param chunks: async iterable or iterable of bytes
+    :param vent_cls: ventilator class to parse the data with
+
+    Other arguments are the same as extract_raw
+    """
+    parser = ChunkParser(skip_breaths_without_be, rel_bn_interval, vent_bn_interval,
+                         spec_rel_bns, spec_vent_bns, vent_cls)
+    if hasattr(chunks, '__aiter__'):
+        async for data in chunks:
+            for breath in parser.feed(data):
+                yield breath
+            if parser.done:
+                break
+    else:
+        for data in chunks:
+            for breath in parser.feed(data):
+                yield breath
+            if parser.done:
+                break
+    for breath in parser.close():
+        yield breath
@@ -0,0 +1,351 @@
+"""
+ventmap.batch_meta
+~~~~~~~~~~~~~~~~~~
+
+Compute breath meta for all breaths of a file at once. Breaths are taken from
+a BreathBatch, where flow and pressure of every breath are stored back to back
+with offsets marking where each breath starts. Every META_HEADER column is
+computed with segment wise numpy operations instead of looping over breaths in
+python. Results match get_production_breath_meta within the precision given in
+ROUNDING_RULES_DICT. Differences come from summing in a different order and
+are on the order of 1e-12.
+
+Usage:
+
+    batch = PB840File(open(<filepath>)).extract_batch(True)
+    array = get_batch_breath_meta(batch)
+"""
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from ventmap.constants import META_HEADER
+from ventmap.timestamps import NO_TIMESTAMP, seconds_to_us
+from ventmap.typed_meta import to_typed_output
+
+# liters per minute to milliliters per second
+TV_SCALE = 1000 / 60
+
+
+class _Waveform(object):
+    def __init__(self, y):
+        """
+        Flow or pressure of many breaths back to back, prepared for reducing
+        segments of it
+
+        :param y: observations of all breaths
+        """
+        self.n = len(y)
+        # reduceat reduces between consecutive indices, so arrays are padded
+        # in case a segment ends at the end of y
+        self.y = np.append(np.asarray(y, dtype=np.float64), np.zeros(3))
+        self.even = np.ascontiguousarray(self.y[0::2])
+        self.odd = np.ascontiguousarray(self.y[1::2])
+
+    def at(self, idx):
+        return self.y[np.clip(idx, 0, self.n)]
+
+    def reduce(self, ufunc, starts, lengths, empty=np.nan, y=None):
+        """
+        Reduce the segments y[start:start + length] with ufunc. Empty segments get empty
+        """
+        out = np.full(len(lengths), empty, dtype=np.float64)
+        nonempty = lengths > 0
+        if nonempty.any():
+            # every other result is a segment, the rest are the gaps between them
+            bounds = np.empty(2 * nonempty.sum(), dtype=np.int64)
+            bounds[0::2] = starts[nonempty]
+            bounds[1::2] = starts[nonempty] + lengths[nonempty]
+            out[nonempty] = ufunc.reduceat(self.y if y is None else y, bounds)[::2]
+        return out
+
+    def simpson(self, starts, lengths, dx):
+        """
+        See segment_simpson
+        """
+        # the basic rule weights samples 1, 4, 2, 4, ..., 2, 4, 1. This is
+        # summed as 2 * all + 2 * odd samples - first - last, in units of dx / 3
+        basic = np.where(lengths % 2 == 1, lengths, lengths - 1)
+        basic[lengths < 3] = 0
+        ends = starts + basic
+        # samples at odd indices of y are at index // 2 of self.odd, even ones at index // 2 of self.even
+        in_odd = self.reduce(np.add, starts // 2, ends // 2 - starts // 2, 0.0, self.odd)
+        in_even = self.reduce(np.add, (starts + 1) // 2, (ends + 1) // 2 - (starts + 1) // 2, 0.0, self.even)
+        odd_samples = np.where(starts % 2 == 0, in_odd, in_even)
+        ends = starts + lengths
+        # everything from here on is in units of dx / 12
+        total = 8 * (in_odd + in_even) + 8 * odd_samples - 4 * self.at(starts) - 4 * self.at(starts + basic - 1)
+        # correction for the last interval of even segments
+        even = (lengths % 2 == 0) & (lengths >= 4)
+        total += np.where(even, 5 * self.at(ends - 1) + 8 * self.at(ends - 2) - self.at(ends - 3), 0)
+        total = np.where(lengths == 2, 6 * (self.at(starts) + self.at(starts + 1)), total)
+        total[lengths < 2] = 0
+        return total * dx / 12
+
+
+def segment_simpson(y, starts, lengths, dx):
+    """
+    Integrate segments of y with Simpson's rule. Each segment gives the same
+    result as scipy.integrate.simps(y[start:start + length], dx=dx) does in
+    scipy 1.11. Segments with an odd number of samples use the basic rule.
+    Even segments use the basic rule up to the second last sample and a
+    correction for the last interval. Segments of 2 samples use the
+    trapezoidal rule and segments of 0 or 1 samples integrate to 0.
+
+    :param y: array holding all segments
+    :param starts: where each segment starts in y
+    :param lengths: number of samples in each segment
+    :param dx: sample spacing. Either a scalar or one value per segment
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.maximum(np.asarray(lengths, dtype=np.int64), 0)
+    return _Waveform(y).simpson(starts, lengths, np.asarray(dx, dtype=np.float64))
+
+
+def _slices(offsets, lengths, lo, hi):
+    """
+    Starts and lengths of the python slices [lo:hi] of each segment, where lo
+    and hi are non negative
+    """
+    lo = np.minimum(lo, lengths)
+    hi = np.minimum(hi, lengths)
+    return offsets + lo, np.maximum(hi - lo, 0)
+
+
+def _near_half(scaled):
+    with np.errstate(invalid='ignore'):
+        return np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+
+
+def _round(values, ndigits):
+    """
+    Same as python's round on each value. numpy rounding only differs from
+    python when a value is close to halfway between two results, so those
+    values are rounded by python.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rounded = np.round(values, ndigits)
+    for i in _near_half(values * 10 ** ndigits).tolist():
+        rounded[i] = round(float(values[i]), ndigits)
+    return rounded
+
+
+def _seconds_to_us(seconds):
+    """
+    Vectorized timestamps.seconds_to_us
+    """
+    us = seconds * 10 ** 6
+    rounded = np.rint(us).astype(np.int64)
+    for i in _near_half(us).tolist():
+        rounded[i] = seconds_to_us(float(seconds[i]))
+    return rounded
+
+
+def _format_us(us):
+    """
+    Vectorized OUT_FORMATTER.format. Breaths without a timestamp get '-'
+    """
+    missing = us == NO_TIMESTAMP
+    formatted = np.datetime_as_string(np.where(missing, 0, us).astype('datetime64[us]'), unit='us')
+    # 2016-12-15T11:54:58.672431 -> 2016-12-15 11-54-58.672431
+    chars = formatted.astype('U26').view('U1').reshape(len(us), 26)
+    chars[:, 10] = ' '
+    chars[:, 13] = '-'
+    chars[:, 16] = '-'
+    formatted = chars.view('U26').ravel().astype(object)
+    formatted[missing] = '-'
+    return formatted
+
+
+def _find_x01(flow, offsets, lengths):
+    """
+    Vectorized SAM.findx0. Only the first crossing is ever used, so crossings
+    close to each other never need to be merged.
+    """
+    n = len(flow)
+    # number of observations left in the breath, counting the current one.
+    # Observations past the end of a breath never match, just like the nans findx0 pads with
+    remaining = np.repeat(offsets + lengths, lengths) - np.arange(n)
+    neg = np.append(flow < 0, np.zeros(5, dtype=bool))
+    le5 = np.append(flow <= -5, np.zeros(5, dtype=bool))
+    n1, n2, n3, n4, n5 = [neg[k:k + n] & (remaining > k) for k in range(1, 6)]
+    l1, l2, l4 = [le5[k:k + n] & (remaining > k) for k in (1, 2, 4)]
+    crosses = (flow >= 0) & (remaining > 1) & ((l1 & n2) | (n1 & l4) | (n1 & l2) | (n1 & n2 & n3 & n4 & n5))
+    x01 = lengths - 1
+    hits = np.flatnonzero(crosses)
+    hit_breaths = np.searchsorted(offsets, hits, side='right') - 1
+    hit_breaths, first = np.unique(hit_breaths, return_index=True)
+    x01[hit_breaths] = hits[first] - offsets[hit_breaths] + 1
+    return x01
+
+
+def _find_x02(flow, wave, offsets, lengths, dt):
+    """
+    Vectorized SAM.findx02. Flow is split into runs of positive and non
+    positive values. x02 is the end of the positive run with the largest area,
+    ignoring the last run of each breath.
+    """
+    n = len(flow)
+    x02 = lengths - 1
+    if n == 0:
+        return x02
+    breath = np.repeat(np.arange(len(lengths)), lengths)
+    rel = np.arange(n) - np.repeat(offsets, lengths)
+    pos = flow > 0
+    new_run = np.ones(n, dtype=bool)
+    new_run[1:] = (pos[1:] != pos[:-1]) | (rel[1:] == 0)
+    run_starts = np.flatnonzero(new_run)
+    run_ends = np.append(run_starts[1:], n)
+    run_breaths = breath[run_starts]
+    closed = run_ends < offsets[run_breaths] + lengths[run_breaths]
+    candidates = closed & pos[run_starts]
+    run_starts, run_ends, run_breaths = run_starts[candidates], run_ends[candidates], run_breaths[candidates]
+    auc = wave.simpson(run_starts, run_ends - run_starts, dt[run_breaths]) * TV_SCALE
+    largest = auc > 0
+    run_ends, run_breaths, auc = run_ends[largest], run_breaths[largest], auc[largest]
+    # the first of the largest runs wins, same as the strict > in findx02
+    order = np.lexsort((run_ends, -auc, run_breaths))
+    hit_breaths, first = np.unique(run_breaths[order], return_index=True)
+    x02[hit_breaths] = run_ends[order][first] - offsets[hit_breaths]
+    return x02
+
+
+def get_batch_breath_meta_columns(batch, tve_pos=True, typed=False):
+    """
+    Compute breath meta for every breath in a batch. Returns a list of arrays,
+    one per column of META_HEADER.
+
+    :param batch: BreathBatch
+    :param tve_pos: Give a positive value for TVe
+    :param typed: give absolute times as int64 microseconds and the spacer
+        column as NaN, as used by ventmap.typed_meta, instead of strings
+    """
+    flow = np.asarray(batch.flow, dtype=np.float64)
+    pressure = np.asarray(batch.pressure, dtype=np.float64)
+    f_off = batch.flow_offsets[:-1]
+    p_off = batch.pressure_offsets[:-1]
+    f_len = np.diff(batch.flow_offsets)
+    p_len = np.diff(batch.pressure_offsets)
+    dt, bs_time, frame_dur = batch.dt, batch.bs_time, batch.frame_dur
+    zeros = np.zeros(len(batch), dtype=np.int64)
+
+    x01 = _find_x01(flow, f_off, f_len)
+    flow_wave, pressure_wave = _Waveform(flow), _Waveform(pressure)
+    x02 = _find_x02(flow, flow_wave, f_off, f_len, dt)
+    x0 = np.where(x02 > x01, x02, x01)
+
+    i_time = _round(x0 * dt, 2)
+    e_time = _round(frame_dur - i_time, 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ie_ratio = _round(i_time / e_time, 5)
+        rr = 60 / frame_dur
+    rel_time_at_x0 = bs_time + i_time
+    rel_time_at_be = bs_time + frame_dur - dt
+
+    def simpson(wave, offsets, lengths, lo, hi):
+        return wave.simpson(*_slices(offsets, lengths, lo, hi), dx=dt)
+
+    def reduce(ufunc, wave, offsets, lengths, lo, hi):
+        return wave.reduce(ufunc, *_slices(offsets, lengths, lo, hi))
+
+    pip = reduce(np.maximum, pressure_wave, p_off, p_len, zeros, x0)
+    n_i_pressure = np.minimum(x0, p_len)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        maw = reduce(np.add, pressure_wave, p_off, p_len, zeros, x0) / n_i_pressure
+    peep_start = np.maximum(x0, p_len - 5)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peep = reduce(np.add, pressure_wave, p_off, p_len, peep_start, p_len) / (p_len - peep_start)
+    peep[x0 >= p_len] = 0
+
+    tvi = simpson(flow_wave, f_off, f_len, zeros, x0) * TV_SCALE
+    tve = simpson(flow_wave, f_off, f_len, x0, f_len) * TV_SCALE
+    if tve_pos:
+        tve = np.abs(tve)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tv_ratio = np.abs(tve) / tvi
+    tv_ratio[x0 == 0] = np.nan
+    ip_auc = simpson(pressure_wave, p_off, p_len, zeros, x0)
+    ep_auc = simpson(pressure_wave, p_off, p_len, x0, p_len)
+    max_p = reduce(np.maximum, pressure_wave, p_off, p_len, zeros, p_len)
+    max_f = reduce(np.maximum, flow_wave, f_off, f_len, zeros, f_len)
+    min_f = reduce(np.minimum, flow_wave, f_off, f_len, zeros, f_len)
+
+    x01_time = _round(bs_time + x01 * 0.02, 2)
+    tvi1 = simpson(flow_wave, f_off, f_len, zeros, x01) * TV_SCALE
+    tve1 = simpson(flow_wave, f_off, f_len, x01, f_len - 1) * TV_SCALE
+    x02_time = _round(bs_time + x02 * 0.02, 2)
+    tvi2 = simpson(flow_wave, f_off, f_len, zeros, x02) * TV_SCALE
+    tve2 = simpson(flow_wave, f_off, f_len, x02, f_len - 1) * TV_SCALE
+    if tve_pos:
+        tve1 = np.abs(tve1)
+        tve2 = np.abs(tve2)
+
+    min_pressure = _round(reduce(np.minimum, pressure_wave, p_off, p_len, zeros + 5, x0), 2)
+
+    abs_bs_us = batch.abs_bs_us
+    abs_time_at_bs = abs_bs_us
+    abs_time_at_x0 = np.where(
+        abs_bs_us == NO_TIMESTAMP, NO_TIMESTAMP, abs_bs_us + _seconds_to_us(_round(x0 * .02, 2))
+    )
+    abs_time_at_be = np.where(
+        abs_bs_us == NO_TIMESTAMP, NO_TIMESTAMP, abs_bs_us + _seconds_to_us(frame_dur - dt)
+    )
+    if typed:
+        spacer = np.full(len(batch), np.nan)
+    else:
+        spacer = [''] * len(batch)
+        abs_time_at_bs, abs_time_at_x0, abs_time_at_be = [
+            _format_us(us) for us in [abs_time_at_bs, abs_time_at_x0, abs_time_at_be]
+        ]
+
+    return [
+        batch.rel_bn, batch.vent_bn, _round(bs_time, 2), _round(rel_time_at_x0, 2), _round(rel_time_at_be, 2),
+        ie_ratio, i_time, e_time, rr, tvi, tve, tv_ratio, max_f, min_f, max_p, pip,
+        maw, peep, ip_auc, ep_auc, spacer, bs_time, x01_time, tvi1, tve1, x02_time,
+        tvi2, tve2, x0, abs_time_at_bs, abs_time_at_x0, abs_time_at_be,
+        bs_time, rel_time_at_x0, rel_time_at_be, min_pressure,
+    ]
+
+
+def _parallel_columns(batch, tve_pos, n_jobs, typed=False):
+    """
+    Split the batch into one piece per thread. Most of the work is in numpy,
+    which releases the GIL, so threads are enough
+    """
+    bounds = np.linspace(0, len(batch), n_jobs + 1).astype(int)
+    pieces = [batch.slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+    with ThreadPoolExecutor(n_jobs) as executor:
+        results = list(executor.map(lambda piece: get_batch_breath_meta_columns(piece, tve_pos, typed), pieces))
+    return [
+        np.concatenate(cols) if isinstance(cols[0], np.ndarray) else sum(cols, [])
+        for cols in zip(*results)
+    ]
+
+
+def get_batch_breath_meta(batch, tve_pos=True, to_data_frame=False, n_jobs=1, typed=False):
+    """
+    Compute breath meta for every breath in a batch. Output is in the same
+    format as get_file_breath_meta.
+
+    :param batch: BreathBatch
+    :param tve_pos: Give a positive value for TVe
+    :param to_data_frame: output a pandas DataFrame instead of a list of rows
+    :param n_jobs: number of threads to use. -1 uses one per core
+    :param typed: output typed columns as a record array, or a DataFrame if
+        to_data_frame. See ventmap.typed_meta
+    """
+    n_jobs = min(multiprocessing.cpu_count() if n_jobs < 0 else n_jobs, len(batch))
+    if n_jobs > 1:
+        columns = _parallel_columns(batch, tve_pos, n_jobs, typed)
+    else:
+        columns = get_batch_breath_meta_columns(batch, tve_pos, typed)
+    if typed:
+        return to_typed_output(META_HEADER, columns, to_data_frame)
+    columns = [col.tolist() if isinstance(col, np.ndarray) else col for col in columns]
+    rows = [list(row) for row in zip(*columns)]
+    if not to_data_frame:
+        return [META_HEADER] + rows
+    else:
+        return pd.DataFrame(rows, columns=META_HEADER)
@@ -0,0 +1,212 @@
+"""
+ventmap.breath_batch
+~~~~~~~~~~~~~~~~~~~~
+
+Columnar storage for all breaths from a file. Instead of one dict holding two
+lists per breath, flow and pressure for every breath are stored back to back in
+two contiguous arrays, with offsets marking where each breath starts and ends.
+Breath metadata is stored in one array per field.
+
+Usage:
+
+    batch = PB840File(open(<filepath>)).extract_batch(False)
+    # zero copy view of the flow for the 10th breath
+    flow = batch.flow_of(9)
+    # or get breaths in the same dict format as extract_raw
+    for breath in batch:
+        ...
+"""
+import numpy as np
+
+from ventmap.processed_file import load_processed, load_raw, processed_path_for, PROCESSED_DTYPE, write_processed
+from ventmap.timestamps import NO_TIMESTAMP, OUT_FORMATTER, OUT_TIMESTAMPS
+
+
+class BreathBatch(object):
+    def __init__(self, flow, pressure, flow_offsets, pressure_offsets, rel_bn, vent_bn, bs_time, frame_dur, dt, abs_bs_us):
+        """
+        :param flow: flow observations for all breaths back to back
+        :param pressure: pressure observations for all breaths back to back
+        :param flow_offsets: breath i has flow flow[flow_offsets[i]:flow_offsets[i+1]]
+        :param pressure_offsets: breath i has pressure pressure[pressure_offsets[i]:pressure_offsets[i+1]]
+        :param rel_bn: relative breath number of each breath
+        :param vent_bn: ventilator breath number of each breath
+        :param bs_time: relative breath start time of each breath
+        :param frame_dur: duration of each breath
+        :param dt: sampling interval of each breath
+        :param abs_bs_us: absolute breath start in microseconds since epoch. NO_TIMESTAMP if unknown
+        """
+        self.flow = flow
+        self.pressure = pressure
+        self.flow_offsets = np.asarray(flow_offsets, dtype=np.int64)
+        self.pressure_offsets = np.asarray(pressure_offsets, dtype=np.int64)
+        self.rel_bn = np.asarray(rel_bn, dtype=np.int64)
+        self.vent_bn = np.asarray(vent_bn, dtype=np.int64)
+        self.bs_time = np.asarray(bs_time, dtype=np.float64)
+        self.frame_dur = np.asarray(frame_dur, dtype=np.float64)
+        self.dt = np.asarray(dt, dtype=np.float64)
+        self.abs_bs_us = np.asarray(abs_bs_us, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.rel_bn)
+
+    def __getitem__(self, idx):
+        return self.breath(idx)
+
+    def __iter__(self):
+        return self.iter_breaths()
+
+    @property
+    def offsets(self):
+        """
+        Breath offsets into the flow array. Pressure offsets only differ from
+        these for malformed rows where flow could be read but pressure could not
+        """
+        return self.flow_offsets
+
+    @property
+    def lengths(self):
+        return np.diff(self.flow_offsets)
+
+    @property
+    def abs_bs(self):
+        return [OUT_FORMATTER.format(us) if us != NO_TIMESTAMP else None for us in self.abs_bs_us.tolist()]
+
+    def flow_of(self, idx):
+        return self.flow[self.flow_offsets[idx]:self.flow_offsets[idx + 1]]
+
+    def pressure_of(self, idx):
+        return self.pressure[self.pressure_offsets[idx]:self.pressure_offsets[idx + 1]]
+
+    def breath(self, idx, as_lists=False):
+        """
+        Get a breath in the same format extract_raw uses
+
+        :param idx: position of the breath in the batch
+        :param as_lists: output flow and pressure as lists instead of array views
+        """
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('breath index out of range')
+        flow, pressure = self.flow_of(idx), self.pressure_of(idx)
+        if as_lists:
+            flow, pressure = flow.tolist(), pressure.tolist()
+        abs_bs_us = int(self.abs_bs_us[idx])
+        abs_bs_us = abs_bs_us if abs_bs_us != NO_TIMESTAMP else None
+        return {
+            "rel_bn": int(self.rel_bn[idx]),
+            "vent_bn": int(self.vent_bn[idx]),
+            "flow": flow,
+            "pressure": pressure,
+            "bs_time": float(self.bs_time[idx]),
+            "frame_dur": float(self.frame_dur[idx]),
+            "dt": float(self.dt[idx]),
+            "abs_bs": OUT_FORMATTER.format(abs_bs_us) if abs_bs_us is not None else None,
+            "abs_bs_us": abs_bs_us,
+        }
+
+    def iter_breaths(self, as_lists=False):
+        for idx in range(len(self)):
+            yield self.breath(idx, as_lists)
+
+    def slice(self, start, stop):
+        """
+        Get a batch of breaths start to stop. Flow and pressure are views into this batch
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        fo, po = self.flow_offsets, self.pressure_offsets
+        return BreathBatch(
+            self.flow[fo[start]:fo[stop]], self.pressure[po[start]:po[stop]],
+            fo[start:stop + 1] - fo[start], po[start:stop + 1] - po[start],
+            self.rel_bn[start:stop], self.vent_bn[start:stop], self.bs_time[start:stop],
+            self.frame_dur[start:stop], self.dt[start:stop], self.abs_bs_us[start:stop],
+        )
+
+    def to_breaths(self):
+        """
+        Convert to a list of breaths identical to the output of extract_raw
+        """
+        return list(self.iter_breaths(as_lists=True))
+
+    @classmethod
+    def from_breaths(cls, breaths, dtype=np.float64):
+        """
+        Build a batch out of breaths in the format output by extract_raw
+
+        :param breaths: iterable of breath dicts
+        :param dtype: dtype to store flow and pressure as
+        """
+        flow, pressure = [], []
+        flow_offsets, pressure_offsets = [0], [0]
+        meta = []
+        for breath in breaths:
+            flow.append(np.asarray(breath['flow'], dtype=dtype))
+            pressure.append(np.asarray(breath['pressure'], dtype=dtype))
+            flow_offsets.append(flow_offsets[-1] + len(flow[-1]))
+            pressure_offsets.append(pressure_offsets[-1] + len(pressure[-1]))
+            abs_bs_us = breath.get('abs_bs_us')
+            if abs_bs_us is None and breath['abs_bs']:
+                abs_bs_us = OUT_TIMESTAMPS.to_epoch_us(str(breath['abs_bs']))
+            meta.append((
+                breath['rel_bn'], breath['vent_bn'], breath['bs_time'], breath['frame_dur'], breath['dt'],
+                abs_bs_us if abs_bs_us is not None else NO_TIMESTAMP,
+            ))
+        columns = list(zip(*meta)) if meta else [[]] * 6
+        return cls(
+            np.concatenate(flow) if flow else np.array([], dtype=dtype),
+            np.concatenate(pressure) if pressure else np.array([], dtype=dtype),
+            flow_offsets, pressure_offsets, *columns
+        )
+
+    @classmethod
+    def from_processed_file(cls, raw_file):
+        """
+        Load a batch from files written by process_breath_file or BreathBatch.save
+
+        :param raw_file: filename for the raw numpy file. Should have a file suffix of '.raw.npy'
+        """
+        raw = load_raw(raw_file)
+        processed = load_processed(processed_path_for(raw_file))
+        start_idx, end_idx = processed['start_idx'], processed['end_idx']
+        if len(processed) and (start_idx[1:] == end_idx[:-1]).all():
+            keep = slice(start_idx[0], end_idx[-1])
+            offsets = np.concatenate(([0], end_idx - start_idx[0]))
+        else:
+            keep = np.concatenate([np.arange(start, end) for start, end in zip(start_idx, end_idx)] + [np.array([], dtype=np.int64)])
+            offsets = np.concatenate(([0], np.cumsum(end_idx - start_idx)))
+        return cls(
+            np.ascontiguousarray(raw[keep, 0], dtype=np.float64),
+            np.ascontiguousarray(raw[keep, 1], dtype=np.float64),
+            offsets, offsets,
+            processed['rel_bn'],
+            processed['vent_bn'],
+            processed['bs_time'],
+            processed['frame_dur'],
+            processed['dt'],
+            processed['abs_bs'],
+        )
+
+    def save(self, output_filename, encode=False, compress=False):
+        """
+        Save in the same format as process_breath_file so that the output can be
+        read back with read_processed_file. Breaths whose flow and pressure lengths
+        differ cannot be stored in this format.
+
+        :param output_filename: file prefix. Outputs <prefix>.raw.npy and <prefix>.processed.npy
+        :param encode: store flow and pressure in the compact <prefix>.raw.npz format
+        :param compress: zlib compress encoded flow and pressure
+        """
+        if not (self.flow_offsets == self.pressure_offsets).all():
+            raise ValueError('cannot save breaths that have a different number of flow and pressure observations')
+        processed = np.zeros(len(self), dtype=PROCESSED_DTYPE)
+        processed['rel_bn'] = self.rel_bn
+        processed['vent_bn'] = self.vent_bn
+        processed['abs_bs'] = self.abs_bs_us
+        processed['bs_time'] = self.bs_time
+        processed['frame_dur'] = self.frame_dur
+        processed['dt'] = self.dt
+        processed['start_idx'] = self.flow_offsets[:-1]
+        processed['end_idx'] = self.flow_offsets[1:]
+        write_processed(output_filename, processed, self.flow, self.pressure, encode, compress)
@@ -0,0 +1,487 @@
+"""
+ventmap.breath_features
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Compute selected breath meta columns for a single breath. Every column of
+EXPERIMENTAL_META_HEADER, and every intermediate value shared between columns,
+is computed by a function registered under its name. Values are computed the
+first time they are asked for and then kept, so asking for a few columns only
+computes those columns and what they depend on. For example dyn_compliance
+needs tvi, PIP and PEEP, which all need x0_index, but none of the pressure
+itime columns.
+
+get_production_breath_meta and get_experimental_breath_meta are built on top
+of this, so selected columns always match the full rows.
+
+Usage:
+
+    features = BreathFeatures(breath)
+    tvi, tve, peep = features.get(['tvi', 'tve', 'PEEP'])
+"""
+import numpy as np
+from scipy.integrate import simps
+
+from ventmap import SAM
+from ventmap.constants import EXPERIMENTAL_META_HEADER
+from ventmap.timestamps import OUT_FORMATTER, OUT_TIMESTAMPS, seconds_to_us
+
+# name -> function computing it from a BreathFeatures
+COMPUTE = {}
+
+
+def computes(*names):
+    def register(func):
+        for name in names:
+            COMPUTE[name] = func
+        return func
+    return register
+
+
+def check_features(features):
+    """
+    Raise ValueError if any of the features is not a breath meta column
+    """
+    unknown = [name for name in features if name not in EXPERIMENTAL_META_HEADER]
+    if unknown:
+        raise ValueError('unknown breath meta columns {}. Columns must be in EXPERIMENTAL_META_HEADER'.format(unknown))
+
+
+class BreathFeatures(object):
+    def __init__(self, breath, tve_pos=True):
+        """
+        :param breath: Breath information as given by raw_utils.py
+        :param tve_pos: Give a positive value for TVe
+        """
+        self.breath = breath
+        self.tve_pos = tve_pos
+        self.values = {}
+
+    def __getitem__(self, name):
+        if name in self.values:
+            return self.values[name]
+        if name not in COMPUTE:
+            raise ValueError('unknown breath meta column {}'.format(name))
+        value = self.values[name] = COMPUTE[name](self)
+        return value
+
+    def get(self, names):
+        """
+        Get a list of values for the given column names
+        """
+        return [self[name] for name in names]
+
+
+def _tv(flow, dt):
+    # The initial measurement is in liters per minutes and the
+    # typical clinical unit of measurement is milliliters per second.
+    # Thus we need the unit conversions of 1000ml/L and (60 sec/min)^(-1)
+    return simps(flow, dx=dt) * 1000 / 60
+
+
+# breath info and timing
+# ----------------------
+@computes('BN')
+def _rel_bn(f):
+    return f.breath['rel_bn']
+
+
+@computes('ventBN')
+def _vent_bn(f):
+    return f.breath['vent_bn']
+
+
+@computes('BS.1', 'rel_time_at_BS')
+def _bs_time(f):
+    return f.breath['bs_time']
+
+
+@computes('BS')
+def _rounded_bs_time(f):
+    return round(f['rel_time_at_BS'], 2)
+
+
+@computes('rel_time_at_BE')
+def _rel_time_at_be(f):
+    return f.breath['bs_time'] + f.breath['frame_dur'] - f.breath['dt']
+
+
+@computes('BE')
+def _rounded_rel_time_at_be(f):
+    return round(f['rel_time_at_BE'], 2)
+
+
+@computes('rel_time_array')
+def _rel_time_array(f):
+    if 't' not in f.breath:
+        return [i * f.breath['dt'] for i in range(len(f.breath['flow']))]
+    return f.breath['t']
+
+
+@computes(' ')
+def _blank(f):
+    return ''
+
+
+# find the one x0 and calculations based off x0
+# ---------------------------------------------
+@computes('x0_indices')
+def _x0_indices(f):
+    return SAM.find_x0s_multi_algorithms(f.breath['flow'], f['rel_time_array'], f.breath['dt'])
+
+
+@computes('x0')
+def _x0(f):
+    return SAM.x0_heuristic(f['x0_indices'], f['rel_time_array'])
+
+
+@computes('x0_index')
+def _x0_index(f):
+    return f['x0'][1]
+
+
+@computes('iTime')
+def _i_time(f):
+    return round(f['x0'][0], 2)
+
+
+@computes('eTime')
+def _e_time(f):
+    return round(f.breath['frame_dur'] - f['iTime'], 2)
+
+
+@computes('I:E ratio')
+def _ie_ratio(f):
+    return round(f['iTime'] / f['eTime'], 5)
+
+
+@computes('inst_RR')
+def _rr(f):
+    return 60 / f.breath['frame_dur']
+
+
+@computes('rel_time_at_x0')
+def _rel_time_at_x0(f):
+    return f.breath['bs_time'] + f['iTime']
+
+
+@computes('IEnd')
+def _rounded_rel_time_at_x0(f):
+    return round(f['rel_time_at_x0'], 2)
+
+
+# breaths from extract_raw carry a numeric timestamp so the string does not need parsing
+@computes('abs_bs_us')
+def _abs_bs_us(f):
+    abs_bs_us = f.breath.get('abs_bs_us')
+    if abs_bs_us is None and f.breath['abs_bs']:
+        abs_bs_us = OUT_TIMESTAMPS.to_epoch_us(f.breath['abs_bs'])
+    return abs_bs_us
+
+
+# absolute times in microseconds since epoch. None if the breath has no timestamp
+@computes('abs_us_at_BS')
+def _abs_us_at_bs(f):
+    return f['abs_bs_us']
+
+
+@computes('abs_us_at_x0')
+def _abs_us_at_x0(f):
+    if f['abs_bs_us'] is None:
+        return None
+    return f['abs_bs_us'] + seconds_to_us(round(f['x0_index'] * .02, 2))
+
+
+@computes('abs_us_at_BE')
+def _abs_us_at_be(f):
+    if f['abs_bs_us'] is None:
+        return None
+    return f['abs_bs_us'] + seconds_to_us(f.breath['frame_dur'] - f.breath['dt'])
+
+
+@computes('abs_time_at_BS')
+def _abs_time_at_bs(f):
+    if f['abs_bs_us'] is None:
+        return '-'
+    return f.breath['abs_bs'] or OUT_FORMATTER.format(f['abs_bs_us'])
+
+
+@computes('abs_time_at_x0')
+def _abs_time_at_x0(f):
+    if f['abs_us_at_x0'] is None:
+        return '-'
+    return OUT_FORMATTER.format(f['abs_us_at_x0'])
+
+
+@computes('abs_time_at_BE')
+def _abs_time_at_be(f):
+    if f['abs_us_at_BE'] is None:
+        return '-'
+    return OUT_FORMATTER.format(f['abs_us_at_BE'])
+
+
+# inspiratory and expiratory parts of the breath
+# -----------------------------------------------
+@computes('iPressure')
+def _i_pressure(f):
+    return f.breath['pressure'][0:f['x0_index']]
+
+
+@computes('ePressure')
+def _e_pressure(f):
+    return f.breath['pressure'][f['x0_index']:]
+
+
+@computes('iFlow')
+def _i_flow(f):
+    return f.breath['flow'][0:f['x0_index']]
+
+
+# technically the expiratory flow might need to start at x0_index + 1
+@computes('eFlow')
+def _e_flow(f):
+    return f.breath['flow'][f['x0_index']:]
+
+
+# pressure
+# --------
+@computes('PIP')
+def _pip(f):
+    try:
+        return max(f['iPressure'])
+    except ValueError:  # if no iPressure obs
+        return np.nan
+
+
+@computes('Maw')
+def _maw(f):
+    i_pressure = f['iPressure']
+    try:
+        return sum(i_pressure) / len(i_pressure)
+    except ZeroDivisionError:
+        return np.nan
+
+
+# calculate PEEP (pos end exp pressure)
+# -------------------------------------
+# if ePressure and not dbl trigger or suction
+# the peep is the average of the end pressure
+@computes('PEEP')
+def _peep(f):
+    e_pressure = f['ePressure']
+    if e_pressure != []:
+        last_obs = e_pressure[-5:]
+        return sum(last_obs) / len(last_obs)
+    return 0
+
+
+@computes('ipAUC')
+def _ip_auc(f):
+    i_pressure = f['iPressure']
+    if i_pressure:
+        return simps(i_pressure, dx=f.breath['dt'])
+    return 0
+
+
+@computes('epAUC')
+def _ep_auc(f):
+    e_pressure = f['ePressure']
+    if e_pressure == []:
+        return 0
+    return float(simps(e_pressure, dx=f.breath['dt']))
+
+
+@computes('maxP')
+def _max_p(f):
+    try:
+        return max(f.breath['pressure'])
+    except ValueError:
+        return np.nan
+
+
+# minimum pressure during inspiration
+@computes('min_pressure')
+def _min_pressure(f):
+    min_p_obs = f.breath['pressure'][5:f['x0_index']]
+    if min_p_obs:
+        return round(min(min_p_obs), 2)
+    return np.nan
+
+
+# flow and tidal volumes
+# ----------------------
+@computes('tvi')
+def _tvi(f):
+    i_flow = f['iFlow']
+    if i_flow:
+        return _tv(i_flow, f.breath['dt'])
+    return 0
+
+
+# if expiratory flow DNE, don't calculate expiratory TV
+@computes('tve')
+def _tve(f):
+    e_flow = f['eFlow']
+    tve = 0 if e_flow == [] else _tv(e_flow, f.breath['dt'])
+    return abs(tve) if f.tve_pos else tve
+
+
+@computes('tve:tvi ratio')
+def _tv_ratio(f):
+    try:
+        return abs(f['tve']) / f['tvi']
+    except ZeroDivisionError:
+        return np.nan
+
+
+@computes('maxF')
+def _max_f(f):
+    try:
+        return max(f.breath['flow'])
+    except ValueError:
+        return np.nan
+
+
+@computes('minF')
+def _min_f(f):
+    try:
+        return min(f.breath['flow'])
+    except ValueError:
+        return np.nan
+
+
+# calculating TVs different ways
+# ------------------------------
+def _split_tvs(f, index):
+    i_flow = f.breath['flow'][0:index]
+    e_flow = f.breath['flow'][index:-1]
+    tvi = _tv(i_flow, f.breath['dt']) if i_flow else 0
+    tve = _tv(e_flow, f.breath['dt']) if e_flow else 0
+    return tvi, abs(tve) if f.tve_pos else tve
+
+
+@computes('x01')
+def _x01_time(f):
+    return round(f.breath['bs_time'] + (int(f['x0_indices']['x01index']) * 0.02), 2)
+
+
+@computes('tv1')
+def _tv1(f):
+    return _split_tvs(f, int(f['x0_indices']['x01index']))
+
+
+@computes('tvi1')
+def _tvi1(f):
+    return f['tv1'][0]
+
+
+@computes('tve1')
+def _tve1(f):
+    return f['tv1'][1]
+
+
+@computes('x02')
+def _x02_time(f):
+    return round(f.breath['bs_time'] + (int(f['x0_indices']['x02index']) * 0.02), 2)
+
+
+@computes('tv2')
+def _tv2(f):
+    return _split_tvs(f, int(f['x0_indices']['x02index']))
+
+
+@computes('tvi2')
+def _tvi2(f):
+    return f['tv2'][0]
+
+
+@computes('tve2')
+def _tve2(f):
+    return f['tv2'][1]
+
+
+# experimental
+# ------------
+# convert tvi to liters. Units are L / cm H20
+@computes('dyn_compliance')
+def _dyn_compliance(f):
+    return (f['tvi'] / 1000) / (f['PIP'] - f['PEEP'])
+
+
+@computes('minF_to_zero')
+def _pef_to_zero(f):
+    return SAM.find_slope_from_minf_to_zero(f['rel_time_array'], f.breath['flow'], f['minF'])
+
+
+@computes('pef_+0.16_to_zero')
+def _pef_plus_16_to_zero(f):
+    return SAM.find_slope_from_minf_to_zero(f['rel_time_array'], f.breath['flow'], f['minF'], t_offset=0.16)
+
+
+@computes('mean_flow_from_pef')
+def _mean_flow_from_pef(f):
+    return SAM.find_mean_flow_from_pef(f.breath['flow'], f['minF'], 0.16)
+
+
+def _vol_at(f, seconds):
+    e_flow = f['eFlow']
+    if e_flow:
+        return _tv(e_flow[:int(seconds / f.breath['dt'])], f.breath['dt'])
+    return 0
+
+
+@computes('vol_at_.5_sec')
+def _vol_at_05(f):
+    return _vol_at(f, .5)
+
+
+@computes('vol_at_.76_sec')
+def _vol_at_076(f):
+    return _vol_at(f, .76)
+
+
+@computes('vol_at_1_sec')
+def _vol_at_1(f):
+    return _vol_at(f, 1)
+
+
+def _pressure_itime(f, threshold):
+    return SAM.calc_pressure_itime(f['rel_time_array'], f.breath['pressure'], f['PEEP'], threshold)
+
+
+def _pressure_itime_by_pip(f, threshold):
+    return SAM.calc_pressure_itime_by_pip(f['rel_time_array'], f.breath['pressure'], f['PIP'], threshold)
+
+
+@computes('pressure_itime_4')
+def _pressure_itime_4(f):
+    return _pressure_itime(f, 4)
+
+
+@computes('pressure_itime_5')
+def _pressure_itime_5(f):
+    return _pressure_itime(f, 5)
+
+
+@computes('pressure_itime_6')
+def _pressure_itime_6(f):
+    return _pressure_itime(f, 6)
+
+
+@computes('pressure_itime_by_pip5')
+def _pressure_itime_by_pip5(f):
+    return _pressure_itime_by_pip(f, 5)
+
+
+@computes('pressure_itime_by_pip6')
+def _pressure_itime_by_pip6(f):
+    return _pressure_itime_by_pip(f, 6)
+
+
+@computes('pressure_itime_from_front')
+def _pressure_itime_from_front(f):
+    return SAM.calc_pressure_itime_from_front(f['rel_time_array'], f.breath['pressure'], f['PIP'], f['PEEP'], .4)
+
+
+@computes('pressure_itime_shear')
+def _pressure_itime_shear(f):
+    return SAM.shear_transform(f.breath['pressure'], f.breath['flow'], f.breath['dt']) * f.breath['dt']
@@ -0,0 +1,286 @@
+"""
+ventmap.breath_index
+~~~~~~~~~~~~~~~~~~~~
+
+Build and load a breath offset index for raw ventilator files. The index is
+stored as a small sidecar file next to the raw file and records where every
+breath lives in the file so that specific breaths can be read without having
+to scan the file from the start. Offsets are computed by splitting the file on
+newline bytes, so files using bare carriage returns as line endings are not
+supported.
+
+Usage:
+
+    build_breath_index('/path/to/file.csv')
+    # PB840File automatically picks up the sidecar and seeks to breaths 1000 to 1010
+    PB840File(open('/path/to/file.csv')).extract_raw(False, rel_bn_interval=[1000, 1010])
+"""
+import argparse
+import os
+
+import numpy as np
+
+from ventmap.compression import detect_compression
+from ventmap.detection import detect_version_v2
+from ventmap.timestamps import NO_TIMESTAMP, THREE_COL_TIMESTAMPS
+
+INDEX_SUFFIX = '.breath_index.npz'
+# bump whenever the layout of the index changes so that old sidecars are rebuilt
+INDEX_VERSION = 2
+# amount of the file to scan at one time when building the index
+CHUNK_SIZE = 2 ** 25
+# one row per BS marker in the file.
+#
+# rel_bn/vent_bn: breath numbers. vent_bn is -1 if it could not be read off the BS line
+# bs_offset: byte offset of the start of the BS line
+# data_offset: byte offset of the first line after the BS line
+# data_end: byte offset of the line that ended the breath; a BE line, the next BS line, or EOF
+# be_end: byte offset just past the BE line, or -1 if the breath has no BE
+# n_obs: number of flow observations in the breath
+# abs_bs/abs_bs_ticks: the breath's absolute start time is abs_bs + abs_bs_ticks * dt, with
+#                      abs_bs in microseconds since the epoch and NO_TIMESTAMP if unknown
+INDEX_DTYPE = np.dtype([
+    ('rel_bn', np.int64),
+    ('vent_bn', np.int64),
+    ('bs_offset', np.int64),
+    ('data_offset', np.int64),
+    ('data_end', np.int64),
+    ('be_end', np.int64),
+    ('n_obs', np.int64),
+    ('abs_bs', np.int64),
+    ('abs_bs_ticks', np.int64),
+])
+
+
+def index_path_for(path):
+    return str(path) + INDEX_SUFFIX
+
+
+def _file_stats(path):
+    stat = os.stat(str(path))
+    return stat.st_size, stat.st_mtime_ns
+
+
+class BreathIndex(object):
+    def __init__(self, breaths, bs_col, ncol, ts_1st_col, file_size=-1, mtime_ns=-1):
+        """
+        :param breaths: structured array with INDEX_DTYPE
+        :param bs_col: column that BS/BE markers are located in
+        :param ncol: number of columns in the file
+        :param ts_1st_col: True if timestamps are located in the first column
+        :param file_size: size of the raw file the index was built from
+        :param mtime_ns: modification time of the raw file the index was built from
+        """
+        self.breaths = breaths
+        self.bs_col = bs_col
+        self.ncol = ncol
+        self.ts_1st_col = ts_1st_col
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+
+    def __len__(self):
+        return len(self.breaths)
+
+    def matches_format(self, bs_col, ncol, ts_1st_col):
+        return (self.bs_col, self.ncol, self.ts_1st_col) == (bs_col, ncol, bool(ts_1st_col))
+
+    def is_fresh(self, path):
+        """
+        Check if the index is still valid for the file found at path
+        """
+        try:
+            return _file_stats(path) == (self.file_size, self.mtime_ns)
+        except OSError:
+            return False
+
+    def abs_bs_us(self, dt_us):
+        """
+        Get the absolute start time of every breath in microseconds since the
+        epoch, or None for breaths without a timestamp.
+
+        :param dt_us: sampling interval of the ventilator in microseconds
+        """
+        times = []
+        for abs_bs, ticks in zip(self.breaths['abs_bs'].tolist(), self.breaths['abs_bs_ticks'].tolist()):
+            times.append(abs_bs + ticks * dt_us if abs_bs != NO_TIMESTAMP else None)
+        return times
+
+    def save(self, path):
+        """
+        Save index to path. The index is written to a temporary file first so
+        readers never see a partially written index.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                breaths=self.breaths,
+                version=INDEX_VERSION,
+                fmt=np.array([self.bs_col, self.ncol, int(self.ts_1st_col)]),
+                file_stats=np.array([self.file_size, self.mtime_ns]),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            if int(npz['version']) != INDEX_VERSION:
+                raise ValueError('breath index {} has an unsupported version'.format(path))
+            bs_col, ncol, ts_1st_col = npz['fmt'].tolist()
+            file_size, mtime_ns = npz['file_stats'].tolist()
+            return cls(npz['breaths'], bs_col, ncol, bool(ts_1st_col), file_size, mtime_ns)
+
+
+def _iter_chunks(descriptor, chunk_size):
+    """
+    Read a binary descriptor in chunks that always end on a line boundary.
+    Yields the byte offset of each chunk alongside the chunk.
+    """
+    offset = 0
+    leftover = b''
+    while True:
+        data = descriptor.read(chunk_size)
+        if not data:
+            break
+        data = leftover + data
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            leftover = data
+            continue
+        yield offset, data[:cut]
+        offset += cut
+        leftover = data[cut:]
+    if leftover:
+        yield offset, leftover
+
+
+def _scan_file(path, chunk_size):
+    from ventmap.bulk_parser import scan_buffer, strip_ignored_bytes
+
+    events = {'kind': [], 'line_start': [], 'line_end': [], 'vent_bn': [], 'flow_pos': [], 'tick_pos': []}
+    timestamps = []
+    n_flow = n_ticks = 0
+    fmt = None
+    with open(str(path), 'rb') as f:
+        for offset, chunk in _iter_chunks(f, chunk_size):
+            chunk, to_raw_offset = strip_ignored_bytes(chunk)
+            if fmt is None:
+                first_line = chunk.split(b'\n', 1)[0].decode('utf-8', 'surrogateescape')
+                fmt = detect_version_v2(first_line)[:3]
+            scan = scan_buffer(chunk, *fmt)
+            events['kind'].append(scan.kind)
+            events['line_start'].append(to_raw_offset(scan.line_start) + offset)
+            events['line_end'].append(to_raw_offset(scan.line_end) + offset)
+            events['vent_bn'].append(scan.vent_bn)
+            events['flow_pos'].append(scan.flow_pos + n_flow)
+            events['tick_pos'].append(scan.tick_pos + n_ticks)
+            timestamps.extend(scan.timestamps)
+            n_flow += len(scan.flow)
+            n_ticks += scan.n_ticks
+    if fmt is None:
+        fmt = detect_version_v2('')[:3]
+    events = {k: np.concatenate(v).tolist() if v else [] for k, v in events.items()}
+    return events, timestamps, n_flow, fmt
+
+
+def build_breath_index(path, save=True, chunk_size=CHUNK_SIZE):
+    """
+    Build a breath index for a raw ventilator file
+
+    :param path: path to the raw ventilator file
+    :param save: save the index to a sidecar next to the file
+    :param chunk_size: number of bytes of the file to scan at one time
+    """
+    from ventmap.bulk_parser import BS, BE, TS
+
+    if detect_compression(path) is not None:
+        raise ValueError('breath indices cannot be built for compressed files')
+    file_stats = _file_stats(path)
+    events, timestamps, n_flow, fmt = _scan_file(path, chunk_size)
+    bs_col, ncol, ts_1st_col = fmt
+    file_size = file_stats[0]
+
+    rows = []
+    cur = None
+    anchor_us, anchor_tick = NO_TIMESTAMP, 0
+
+    def finish(data_end, be_end, flow_end):
+        cur['data_end'] = data_end
+        cur['be_end'] = be_end
+        cur['n_obs'] = flow_end - cur['n_obs']
+        rows.append(tuple(cur[name] for name in INDEX_DTYPE.names))
+
+    for i, kind in enumerate(events['kind']):
+        if kind == TS:
+            anchor_us, anchor_tick = timestamps[i], events['tick_pos'][i]
+            # a timestamp in the middle of a breath overwrites its start time
+            if cur is not None:
+                cur['abs_bs'], cur['abs_bs_ticks'] = anchor_us, 0
+        elif kind == BS:
+            if cur is not None:
+                finish(events['line_start'][i], -1, events['flow_pos'][i])
+            if ts_1st_col:
+                abs_bs, ticks = THREE_COL_TIMESTAMPS.to_epoch_us(timestamps[i]), 0
+            elif anchor_us != NO_TIMESTAMP:
+                abs_bs, ticks = anchor_us, events['tick_pos'][i] - anchor_tick + 1
+            else:
+                abs_bs, ticks = NO_TIMESTAMP, 0
+            cur = {
+                'rel_bn': len(rows) + 1,
+                'vent_bn': events['vent_bn'][i],
+                'bs_offset': events['line_start'][i],
+                'data_offset': events['line_end'][i],
+                'n_obs': events['flow_pos'][i],
+                'abs_bs': abs_bs,
+                'abs_bs_ticks': ticks,
+            }
+        elif kind == BE and cur is not None:
+            finish(events['line_start'][i], events['line_end'][i], events['flow_pos'][i])
+            cur = None
+    if cur is not None:
+        finish(file_size, -1, n_flow)
+
+    index = BreathIndex(np.array(rows, dtype=INDEX_DTYPE), bs_col, ncol, bool(ts_1st_col), *file_stats)
+    if save:
+        index.save(index_path_for(path))
+    return index
+
+
+def load_breath_index(path):
+    """
+    Load the breath index sidecar for a raw file. Returns None if there is no
+    sidecar or if the raw file has changed since the index was built.
+
+    :param path: path to the raw ventilator file
+    """
+    index_path = index_path_for(path)
+    if not os.path.exists(index_path):
+        return None
+    try:
+        index = BreathIndex.load(index_path)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    return index if index.is_fresh(path) else None
+
+
+def get_breath_index(path):
+    """
+    Load the breath index for a raw file, building it first if it is missing or stale
+    """
+    index = load_breath_index(path)
+    if index is None:
+        index = build_breath_index(path)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build breath offset indices for raw ventilator files')
+    parser.add_argument('files', nargs='+', help='raw ventilator files to index')
+    args = parser.parse_args()
+    for path in args.files:
+        index = build_breath_index(path)
+        print('indexed {} breaths in {}'.format(len(index), path))
+
+
+if __name__ == "__main__":
+    main()
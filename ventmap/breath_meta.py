@@ -8,17 +8,28 @@ from argparse import ArgumentParser
 import csv
 from datetime import datetime, timedelta
 from dateutil import parser
+from functools import partial
 from io import open
+import multiprocessing
+import os
+import warnings
 
 import numpy as np
 import pandas as pd
 from scipy import var
-from scipy.integrate import simps
 
-from ventmap import SAM
+from ventmap.batch_meta import get_batch_breath_meta
+from ventmap.breath_batch import BreathBatch
+from ventmap.breath_features import BreathFeatures, check_features
+from ventmap.compression import open_vent_file
 from ventmap.constants import EXPERIMENTAL_META_HEADER, IN_DATETIME_FORMAT, META_HEADER, OUT_DATETIME_FORMAT
 from ventmap.detection import detect_version_v2
-from ventmap.raw_utils import extract_raw
+from ventmap.meta_cache import BreathMetaCache
+from ventmap.raw_utils import extract_raw, PB840File
+from ventmap.typed_meta import fill_columns, record_columns, to_typed_output, typed_breath_values
+
+# number of breaths sent to a worker process at a time when n_jobs > 1
+BREATH_META_CHUNK_SIZE = 256
 
 
 def write_breath_meta(array, outfile):
@@ -27,32 +38,187 @@ def write_breath_meta(array, outfile):
         writer.writerows(array)
 
 
-def get_file_breath_meta(file, tve_pos=True, ignore_missing_bes=True, rel_bn_interval=[], vent_bn_interval=[], to_data_frame=False, spec_vent_bns=[], spec_rel_bns=[]):
-    return _get_file_breath_meta(
-        get_production_breath_meta, file, tve_pos, ignore_missing_bes,
-        rel_bn_interval, vent_bn_interval, to_data_frame, spec_vent_bns, spec_rel_bns
+def get_file_breath_meta(file, tve_pos=True, ignore_missing_bes=True, rel_bn_interval=[], vent_bn_interval=[], to_data_frame=False, spec_vent_bns=[], spec_rel_bns=[], vectorized=False, n_jobs=1, cache=None, typed=False):
+    """
+    Get production breath meta for all breaths in a file.
+
+    :param file: path to a file, file descriptor, list of breaths or BreathBatch
+    :param vectorized: compute metadata for all breaths at once with
+        ventmap.batch_meta. Much faster on large files. Results match within
+        the precision given in ventmap.rounding_rules
+    :param n_jobs: number of processes to compute metadata with, or threads
+        if vectorized. -1 uses one per core. Output is the same for any n_jobs
+    :param cache: True to cache results in the default ventmap.meta_cache.BreathMetaCache,
+        or the BreathMetaCache to use. Only used when file is a path
+    :param typed: output typed numpy columns as a record array, or a DataFrame
+        if to_data_frame, instead of lists of python objects. Uses much less
+        memory on large files. See ventmap.typed_meta
+    """
+    def compute(to_data_frame):
+        if vectorized:
+            batch = _to_breath_batch(file, ignore_missing_bes, rel_bn_interval, vent_bn_interval, spec_vent_bns, spec_rel_bns)
+            return get_batch_breath_meta(batch, tve_pos, to_data_frame, n_jobs, typed)
+        return _get_file_breath_meta(
+            get_production_breath_meta, file, tve_pos, ignore_missing_bes,
+            rel_bn_interval, vent_bn_interval, to_data_frame, spec_vent_bns, spec_rel_bns, n_jobs, typed=typed
+        )
+    return _cached_breath_meta(
+        cache, 'production', file, compute, to_data_frame, typed, tve_pos=tve_pos, ignore_missing_bes=ignore_missing_bes,
+        rel_bn_interval=rel_bn_interval, vent_bn_interval=vent_bn_interval, spec_vent_bns=spec_vent_bns,
+        spec_rel_bns=spec_rel_bns, vectorized=vectorized,
     )
 
 
-def get_file_experimental_breath_meta(file, tve_pos=True, ignore_missing_bes=True, rel_bn_interval=[], vent_bn_interval=[], to_data_frame=False, spec_vent_bns=[], spec_rel_bns=[]):
-    return _get_file_breath_meta(
-        get_experimental_breath_meta, file, tve_pos, ignore_missing_bes,
-        rel_bn_interval, vent_bn_interval, to_data_frame, spec_vent_bns, spec_rel_bns
+def get_file_experimental_breath_meta(file, tve_pos=True, ignore_missing_bes=True, rel_bn_interval=[], vent_bn_interval=[], to_data_frame=False, spec_vent_bns=[], spec_rel_bns=[], n_jobs=1, cache=None, typed=False):
+    def compute(to_data_frame):
+        return _get_file_breath_meta(
+            get_experimental_breath_meta, file, tve_pos, ignore_missing_bes,
+            rel_bn_interval, vent_bn_interval, to_data_frame, spec_vent_bns, spec_rel_bns, n_jobs, typed=typed
+        )
+    return _cached_breath_meta(
+        cache, 'experimental', file, compute, to_data_frame, typed, tve_pos=tve_pos, ignore_missing_bes=ignore_missing_bes,
+        rel_bn_interval=rel_bn_interval, vent_bn_interval=vent_bn_interval, spec_vent_bns=spec_vent_bns,
+        spec_rel_bns=spec_rel_bns,
     )
 
 
-def _get_file_breath_meta(func, file, tve_pos, ignore_missing_bes, rel_bn_interval, vent_bn_interval, to_data_frame, spec_vent_bns, spec_rel_bns):
+def get_file_breath_meta_features(file, features, tve_pos=True, ignore_missing_bes=True, rel_bn_interval=[], vent_bn_interval=[], to_data_frame=False, spec_vent_bns=[], spec_rel_bns=[], n_jobs=1, cache=None, typed=False):
+    """
+    Get some breath meta columns for all breaths in a file. Only the columns
+    asked for and the values they depend on are computed, so this is faster
+    than computing all breath meta when only a few columns are needed.
+
+    :param file: path to a file, file descriptor, list of breaths or BreathBatch
+    :param features: list of column names from EXPERIMENTAL_META_HEADER
+    """
+    features = list(features)
+    check_features(features)
+
+    def compute(to_data_frame):
+        return _get_file_breath_meta(
+            partial(get_breath_meta_features, features=features, tve_pos=tve_pos), file, tve_pos, ignore_missing_bes,
+            rel_bn_interval, vent_bn_interval, to_data_frame, spec_vent_bns, spec_rel_bns, n_jobs, header=features,
+            typed=typed,
+        )
+    return _cached_breath_meta(
+        cache, 'features', file, compute, to_data_frame, typed, features=features, tve_pos=tve_pos,
+        ignore_missing_bes=ignore_missing_bes, rel_bn_interval=rel_bn_interval, vent_bn_interval=vent_bn_interval,
+        spec_vent_bns=spec_vent_bns, spec_rel_bns=spec_rel_bns,
+    )
+
+
+def _cached_breath_meta(cache, func_name, file, compute, to_data_frame, typed=False, **params):
+    """
+    Look up breath meta for a file in the cache, computing and caching it if it is not there
+
+    :param compute: function computing the breath meta. Takes to_data_frame
+    :param typed: compute gives typed output from ventmap.typed_meta
+    """
+    file = _as_path(file)
+    if cache is None or cache is False or not isinstance(file, str):
+        return compute(to_data_frame)
+    if cache is True:
+        cache = BreathMetaCache()
+    # intervals can hold numpy ints, which json cannot serialize
+    params = {
+        k: [int(i) if isinstance(i, np.integer) else i for i in v] if isinstance(v, (list, tuple)) else v
+        for k, v in params.items()
+    }
+    key = cache.key_for(file, func_name, typed=typed, **params)
+    if typed:
+        result = cache.get_columns(key)
+        if result is None:
+            result = record_columns(compute(False))
+            cache.put_columns(key, *result)
+        return to_typed_output(result[0], result[1], to_data_frame)
+    array = cache.get(key, to_data_frame)
+    if array is None:
+        array = compute(False)
+        if not cache.put(key, array):
+            warnings.warn('breath meta of {} holds values that cannot be cached'.format(file))
+        if to_data_frame:
+            array = pd.DataFrame(array[1:], columns=array[0])
+    return array
+
+
+def _as_path(file):
+    # pathlib paths are used just like str paths
+    return os.fspath(file) if hasattr(file, '__fspath__') else file
+
+
+def _to_breath_batch(file, ignore_missing_bes, rel_bn_interval, vent_bn_interval, spec_vent_bns, spec_rel_bns):
+    file = _as_path(file)
+    if isinstance(file, BreathBatch):
+        return file
+    elif isinstance(file, list):
+        return BreathBatch.from_breaths(file)
+    if isinstance(file, str):
+        file = open_vent_file(file)
+    return PB840File(file).extract_batch(
+        ignore_missing_bes, rel_bn_interval=rel_bn_interval, vent_bn_interval=vent_bn_interval,
+        spec_rel_bns=spec_rel_bns, spec_vent_bns=spec_vent_bns,
+    )
+
+
+def _breath_meta_chunk(args):
+    func, breaths = args
+    if isinstance(breaths, BreathBatch):
+        breaths = breaths.iter_breaths(as_lists=True)
+    return [func(b) for b in breaths]
+
+
+def _parallel_breath_meta(func, file, ignore_missing_bes, rel_bn_interval, vent_bn_interval, spec_vent_bns, spec_rel_bns, n_jobs):
+    """
+    Compute breath meta for chunks of breaths in a process pool. Files are
+    parsed into a BreathBatch first because slices of a batch are much
+    cheaper to send to workers than breath dicts.
+    """
+    if isinstance(file, list):
+        chunks = [file[i:i + BREATH_META_CHUNK_SIZE] for i in range(0, len(file), BREATH_META_CHUNK_SIZE)]
+    else:
+        batch = _to_breath_batch(file, ignore_missing_bes, rel_bn_interval, vent_bn_interval, spec_vent_bns, spec_rel_bns)
+        chunks = [batch.slice(i, i + BREATH_META_CHUNK_SIZE) for i in range(0, len(batch), BREATH_META_CHUNK_SIZE)]
+    rows = []
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        # imap keeps chunks in order
+        for chunk_rows in pool.imap(_breath_meta_chunk, [(func, chunk) for chunk in chunks]):
+            rows.extend(chunk_rows)
+    finally:
+        pool.close()
+        pool.join()
+    return rows
+
+
+def _get_file_breath_meta(func, file, tve_pos, ignore_missing_bes, rel_bn_interval, vent_bn_interval, to_data_frame, spec_vent_bns, spec_rel_bns, n_jobs=1, header=None, typed=False):
+    file = _as_path(file)
     if isinstance(file, str):
-        file = open(file, encoding='ascii', errors='ignore')
-    if "experimental" in func.__name__:
+        file = open_vent_file(file)
+    if header is not None:
+        array = [header]
+    elif "experimental" in func.__name__:
         array = [EXPERIMENTAL_META_HEADER]
     else:
         array = [META_HEADER]
 
+    if n_jobs < 0:
+        n_jobs = multiprocessing.cpu_count()
+    if typed:
+        return _get_typed_file_breath_meta(
+            array[0], file, tve_pos, ignore_missing_bes, rel_bn_interval, vent_bn_interval, to_data_frame,
+            spec_vent_bns, spec_rel_bns, n_jobs
+        )
+    if n_jobs > 1:
+        array.extend(_parallel_breath_meta(
+            func, file, ignore_missing_bes, rel_bn_interval, vent_bn_interval, spec_vent_bns, spec_rel_bns, n_jobs
+        ))
     # case that the file is just a raw_utils array of breaths
-    if isinstance(file, list):
+    elif isinstance(file, list):
         for b in file:
             array.append(func(b))
+    elif isinstance(file, BreathBatch):
+        for b in file.iter_breaths(as_lists=True):
+            array.append(func(b))
     else:  # case the file is a file descriptor
         for breath in extract_raw(file, ignore_missing_bes,
             rel_bn_interval=rel_bn_interval, vent_bn_interval=vent_bn_interval,
@@ -65,6 +231,25 @@ def _get_file_breath_meta(func, file, tve_pos, ignore_missing_bes, rel_bn_interv
         return pd.DataFrame(array[1:], columns=array[0])
 
 
+def _get_typed_file_breath_meta(header, file, tve_pos, ignore_missing_bes, rel_bn_interval, vent_bn_interval, to_data_frame, spec_vent_bns, spec_rel_bns, n_jobs):
+    """
+    Fill preallocated typed columns with breath meta. Files are parsed into a
+    BreathBatch first so the number of breaths is known up front.
+    """
+    func = partial(typed_breath_values, header=header, tve_pos=tve_pos)
+    if not isinstance(file, list):
+        file = _to_breath_batch(file, ignore_missing_bes, rel_bn_interval, vent_bn_interval, spec_vent_bns, spec_rel_bns)
+    if n_jobs > 1:
+        rows = _parallel_breath_meta(
+            func, file, ignore_missing_bes, rel_bn_interval, vent_bn_interval, spec_vent_bns, spec_rel_bns, n_jobs
+        )
+    elif isinstance(file, list):
+        rows = map(func, file)
+    else:
+        rows = map(func, file.iter_breaths(as_lists=True))
+    return to_typed_output(header, fill_columns(header, rows, len(file)), to_data_frame)
+
+
 def get_production_breath_meta(breath, tve_pos=True, calc_tv3=False, to_series=False):
     """
     Get breath meta information for a given breath. This takes a breath parameter
@@ -76,168 +261,9 @@ def get_production_breath_meta(breath, tve_pos=True, calc_tv3=False, to_series=F
 
     :param breath: Breath information as given by raw_utils.py
     :param tve_pos: Give a positive value for TVe
-    :param calc_tv3: Calculate tvi/tve3
+    :param calc_tv3: Unused. tvi3/tve3 were never part of the output
     :param to_series: output breath to a pandas Series object
     """
-    rel_bn = breath['rel_bn']
-    vent_bn = breath['vent_bn']
-    bs_time = breath["bs_time"]
-    dt = breath["dt"]
-    flow = breath["flow"]
-    pressure = breath["pressure"]
-    if 't' not in breath:
-        rel_time_array = [i * dt for i in range(len(flow))]
-    else:
-        rel_time_array = breath["t"]
-    frame_dur = breath["frame_dur"]
-    rel_time_at_BS = bs_time
-    rel_time_at_BE = bs_time + frame_dur - dt
-
-    # find the one x0 and calculations based off x0
-    # ---------------------------------------------
-    x0_indices_dict = SAM.find_x0s_multi_algorithms(flow, rel_time_array, dt)
-
-    iTime, x0_index=SAM.x0_heuristic(x0_indices_dict, rel_time_array)
-
-    iTime = round(iTime, 2)
-    eTime = round(frame_dur - iTime, 2)
-    IEratio = round((iTime) / (eTime), 5)
-    RR = 60 / (frame_dur)
-    rel_time_at_x0 = bs_time + iTime
-
-    if breath['abs_bs']:
-        abs_time_at_x0 = (datetime.strptime(breath['abs_bs'], OUT_DATETIME_FORMAT) + timedelta(seconds=round(x0_index * .02, 2))).strftime(OUT_DATETIME_FORMAT)
-        abs_time_at_BS = breath['abs_bs']
-        abs_time_at_BE = (datetime.strptime(breath['abs_bs'], OUT_DATETIME_FORMAT) + timedelta(seconds=frame_dur - dt)).strftime(OUT_DATETIME_FORMAT)
-    else:
-        abs_time_at_x0 = "-"
-        abs_time_at_BS = "-"
-        abs_time_at_BE = "-"
-
-    iPressure = pressure[0:x0_index]
-    ePressure = pressure[x0_index:]
-    wPressure = pressure[0:]
-    iFlow = flow[0:x0_index]
-    eFlow = flow[x0_index:]
-    wFlow = flow[0:]
-
-    try:
-        PIP = max(iPressure)
-    except ValueError:  # if no iPressure obs
-        PIP = np.nan
-    try:
-        Maw = sum(iPressure) / len(iPressure)
-    except ZeroDivisionError:
-        Maw = np.nan
-
-    # calculate PEEP (pos end exp pressure)
-    # -------------------------------------
-    # if ePressure and not dbl trigger or suction
-    # the peep is the average of the end pressure
-    if ePressure!=[]:
-        last_obs = ePressure[-5:]
-        peep = sum(last_obs) / len(last_obs)
-    else:
-        peep = 0
-
-    # calculate the AUCS / integral of the last breath
-    #------------------------------------------
-    # calculate inspiratory TV
-    # The initial measurement is in liters per minutes and the
-    # typical clinical unit of measurement is milliliters per second.
-    # Thus we need the unit conversions of 1000ml/L and (60 sec/min)^(-1)
-    if iFlow:
-        tvi = simps(iFlow, dx=dt) * 1000 / 60
-    else:
-        tvi = 0
-    # if expiratory flow DNE, don't calculate expiratory TV (e.g. )
-    if eFlow == []:
-        tve = 0
-    else:
-        tve = simps(eFlow, dx=dt) * 1000 / 60
-
-    if tve_pos:
-        tve=abs(tve)
-
-    try:
-        TVratio = (abs(tve)) / tvi
-    except ZeroDivisionError:
-        TVratio = np.nan
-
-    if iPressure:
-        ipAUC = simps(iPressure, dx=dt)
-    else:
-        ipAUC = 0
-
-    if ePressure == []:
-        epAUC = 0
-    else:
-        epAUC = float(simps(ePressure, dx=dt))
-    try:
-        maxP = max(wPressure) #max pressure for whole breath
-    except ValueError:
-        maxP = np.nan
-    try:
-        maxF = max(wFlow)
-    except ValueError:
-        maxF = np.nan
-    try:
-        minF = min(wFlow)
-    except ValueError:
-        minF = np.nan
-
-
-    # TODO: will probabily move this to somewhere else
-    # calculating TVs different ways
-    # ------------------------------
-
-    x01index=int(x0_indices_dict['x01index'])
-    x02index=int(x0_indices_dict['x02index'])
-
-    x01time = round(bs_time + (x01index * 0.02), 2)
-    iFlow1=flow[0:x01index]
-    eFlow1=flow[x01index:-1]
-    if iFlow1:
-        tvi1 = simps(iFlow1, dx=dt)*1000/60 #1000ml/L, 60 sec/min
-    else:
-        tvi1 = 0
-     #if expiratory flow DNE, don't calculate expiratory TV (e.g. )
-    if eFlow1:
-        tve1 = simps(eFlow1, dx=dt)*1000/60
-    else:
-        tve1=0
-    #tvi/tve2
-    x02time = round(bs_time + (x02index * 0.02), 2)
-    iFlow2=flow[0:x02index]
-    eFlow2=flow[x02index:-1]
-    if iFlow2:
-        tvi2 = simps(iFlow2, dx=dt)*1000/60 #1000ml/L, 60 sec/min
-    else:
-        tvi2 = 0
-    if eFlow2:
-        tve2 = simps(eFlow2, dx=dt)*1000/60 #1000ml/L, 60 sec/min
-    else:
-        tve2=0
-
-    #tvi/tve3
-    if calc_tv3:
-        tvi3,tve3=SAM.calcTV3(flow,dt,x02index)
-    else:
-        tvi3, tve3 = np.nan, np.nan
-
-    #make tvepos
-    if tve_pos==True:
-        tve1=abs(tve1)
-        tve2=abs(tve2)
-        tve3=abs(tve3)
-
-    # minimum pressure during inspiration
-    min_p_obs = pressure[5:x0_index]
-    if min_p_obs:
-        min_pressure = round(min(min_p_obs), 2)
-    else:
-        min_pressure = np.nan
-
     # Unfortunately pif, derived plat, resistance, and derived compliance just aren't there
     # yet. The calculations seem to work well on volume control and even pressure
     # control but I believe there are problems with pressure support.
@@ -254,13 +280,7 @@ def get_production_breath_meta(breath, tve_pos=True, calc_tv3=False, to_series=F
     # 25: x02index, 26: tvi2, 27: tve2, 28: x0_index, 29: abs_time_at_BS,
     # 30: abs_time_at_x0, 31: abs_time_at_BE, 32: rel_time_at_BS,
     # 33: rel_time_at_x0, 34: rel_time_at_BE, 35: min_pressure
-
-    breath_metaRow = [
-        rel_bn, vent_bn, round(rel_time_at_BS, 2), round(rel_time_at_x0, 2), round(rel_time_at_BE, 2), IEratio, iTime,
-        eTime, RR, tvi, tve, TVratio, maxF, minF, maxP, PIP,
-        Maw, peep, ipAUC, epAUC, '', bs_time, x01time, tvi1, tve1, x02time,
-        tvi2, tve2, x0_index, abs_time_at_BS, abs_time_at_x0, abs_time_at_BE,
-        rel_time_at_BS, rel_time_at_x0, rel_time_at_BE, min_pressure]
+    breath_metaRow = BreathFeatures(breath, tve_pos).get(META_HEADER)
 
     if not to_series:
         return breath_metaRow
@@ -272,67 +292,33 @@ def get_experimental_breath_meta(breath, tve_pos=True):
     """
     Add experimental breath meta information to the original breath meta info
     """
-    dt = breath["dt"]
-    flow = breath["flow"]
-    pressure = breath["pressure"]
-    if 't' not in breath:
-        rel_time_array = [i * dt for i in range(len(flow))]
-    else:
-        rel_time_array = breath["t"]
-    # set last data point as last value of breath
-
-    non_experimental = get_production_breath_meta(breath, tve_pos)
-    x0_index = non_experimental[28]
-    tvi = non_experimental[9]
-    minF = non_experimental[13]
-    PIP = non_experimental[15]
-    peep = non_experimental[17]
-    eFlow = flow[x0_index:]  # technically this might need to be +1
-
-    # convert tvi to liters. Units are L / cm H20
-    dyn_compliance = (tvi / 1000) / (PIP - peep)
-    pef_to_zero = SAM.find_slope_from_minf_to_zero(rel_time_array, flow, minF)
-    # XXX must add additional time params here so we can see what works best
-    pef_plus_16_to_zero = SAM.find_slope_from_minf_to_zero(
-        rel_time_array, flow, minF, t_offset=0.16)
-    mean_flow_from_pef = SAM.find_mean_flow_from_pef(flow, minF, 0.16)
-    if eFlow:
-        vol_at_05 = simps(eFlow[:int(.5 / dt)], dx=dt) * 1000 / 60
-        vol_at_076 = simps(eFlow[:int(.76 / dt)], dx=dt) * 1000 / 60
-        vol_at_1 = simps(eFlow[:int(1 / dt)], dx=dt) * 1000 / 60
-    else:
-        vol_at_05 = 0
-        vol_at_076 = 0
-        vol_at_1 = 0
-    pressure_itime4 = SAM.calc_pressure_itime(rel_time_array, pressure, peep, 4)
-    pressure_itime5 = SAM.calc_pressure_itime(rel_time_array, pressure, peep, 5)
-    pressure_itime6 = SAM.calc_pressure_itime(rel_time_array, pressure, peep, 6)
-    pressure_itime_pip5 = SAM.calc_pressure_itime_by_pip(rel_time_array, pressure, PIP, 5)
-    pressure_itime_pip6 = SAM.calc_pressure_itime_by_pip(rel_time_array, pressure, PIP, 6)
-    pressure_itime_from_front = SAM.calc_pressure_itime_from_front(rel_time_array, pressure, PIP, peep, .4)
-    shear_p_itime = SAM.shear_transform(pressure, flow, dt) * dt
-
     # The array indices go like this
     #
-    # 0: rel_bn, 1: vent_bn, 2: rel_time_at_BS, 3: rel_time_at_x0,
-    # 4: rel_time_at_BE, 5: IEratio, 6: iTime, 7: eTime, 8: RR, 9: tvi, 10: tve,
-    # 11: TVratio, 12: maxF, 13: minF, 14: maxP, 15: PIP, 16: Maw, 17: peep,
-    # 18: ipAUC, 19: epAUC, 20: '', 21: bs_time, 22: x01time, 23: tvi1, 24: tve1,
-    # 25: x02index, 26: tvi2, 27: tve2, 28: x0_index, 29: abs_time_at_BS,
-    # 30: abs_time_at_x0, 31: abs_time_at_BE, 32: rel_time_at_BS,
-    # 33: rel_time_at_x0, 34: rel_time_at_BE, 35: min_pressure
+    # 0-35: same as get_production_breath_meta
     # 36: pef_to_zero, 37: pef_plus_16_to_zero, 38: mean_flow_from_pef,
     # 39: dyn_compliance, 40: vol_at_05, 41: vol_at_076, 42: vol_at_1,
     # 43: pressure_itime4, 44: pressure_itime5, 45: pressure_itime6,
     # 46: pressure_itime_pip5, 47: pressure_itime_by_pip6, 48: pressure_itime_from_front
     # 49: pressure_itime_shear,
-    return non_experimental + [
-        pef_to_zero, pef_plus_16_to_zero,
-        mean_flow_from_pef, dyn_compliance, vol_at_05,
-        vol_at_076, vol_at_1, pressure_itime4, pressure_itime5, pressure_itime6,
-        pressure_itime_pip5, pressure_itime_pip6, pressure_itime_from_front,
-        shear_p_itime,
-    ]
+    return BreathFeatures(breath, tve_pos).get(EXPERIMENTAL_META_HEADER)
+
+
+def get_breath_meta_features(breath, features, tve_pos=True, to_series=False):
+    """
+    Get only some breath meta columns for a given breath. Only the columns
+    asked for and the values they depend on are computed.
+
+    :param breath: Breath information as given by raw_utils.py
+    :param features: list of column names from EXPERIMENTAL_META_HEADER
+    :param tve_pos: Give a positive value for TVe
+    :param to_series: output breath to a pandas Series object
+    """
+    check_features(features)
+    row = BreathFeatures(breath, tve_pos).get(features)
+    if not to_series:
+        return row
+    else:
+        return pd.Series(row, index=features)
 
 
 def main():
@@ -340,12 +326,14 @@ def main():
     parser.add_argument("input_file")
     parser.add_argument("output_file")
     parser.add_argument("--experimental", action="store_true")
+    parser.add_argument("--vectorized", action="store_true", help="compute production breath meta for all breaths at once")
+    parser.add_argument("-j", "--n-jobs", type=int, default=1, help="number of processes to use, or threads with --vectorized. -1 uses all cores")
     args = parser.parse_args()
-    with open(args.input_file) as f:
+    with open_vent_file(args.input_file, encoding=None, errors=None) as f:
         if args.experimental:
-            array = get_file_experimental_breath_meta(f)
+            array = get_file_experimental_breath_meta(f, n_jobs=args.n_jobs)
         else:
-            array = get_file_breath_meta(f)
+            array = get_file_breath_meta(f, vectorized=args.vectorized, n_jobs=args.n_jobs)
         write_breath_meta(array, args.output_file)
 
 
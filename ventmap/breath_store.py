@@ -0,0 +1,282 @@
+"""
+ventmap.breath_store
+~~~~~~~~~~~~~~~~~~~~
+
+Columnar store holding the breaths of many patients in parquet files that are
+partitioned by patient and date:
+
+    <root>/patient=<patient>/date=<YYYY-MM-DD>/<source>.parquet
+
+where <source> is the name of the ventilator file the breaths came from.
+Breaths without a timestamp go in date=unknown. Each row is one breath with
+its metadata plus flow and pressure as list columns. Breaths are written in
+row groups, so reads filtering on patient, date, abs_bs, vent_bn or rel_bn
+skip any partition or row group that cannot match.
+
+Requires pyarrow. pip install ventmap[parquet]
+
+Usage:
+
+    from ventmap.breath_store import iter_store_breaths, store_breath_file
+
+    store_breath_file('/path/to/store', '0149', '/path/to/0149_file.csv')
+    for breath in iter_store_breaths('/path/to/store', patients=['0149'], start=datetime(...), end=datetime(...)):
+        ...
+"""
+from glob import glob
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from ventmap.compression import open_vent_file, strip_compressed_suffix
+from ventmap.raw_utils import PB840File
+from ventmap.timestamps import epoch_us_to_datetime, NO_TIMESTAMP, OUT_FORMATTER, to_epoch_us
+
+# number of breaths in each parquet row group
+ROW_GROUP_SIZE = 4096
+NO_DATE = 'unknown'
+PYARROW_MSG = 'pyarrow must be installed to use the breath store. pip install ventmap[parquet]'
+
+
+def _check_pyarrow():
+    if pa is None:
+        raise ImportError(PYARROW_MSG)
+
+
+def breath_schema():
+    """
+    Schema of each parquet file. patient and date are stored in the path, not in the files.
+    abs_bs is the breath start in microseconds since the epoch and is null if unknown.
+    """
+    _check_pyarrow()
+    return pa.schema([
+        ('source', pa.string()),
+        ('rel_bn', pa.int32()),
+        ('vent_bn', pa.int32()),
+        ('abs_bs', pa.int64()),
+        ('bs_time', pa.float64()),
+        ('frame_dur', pa.float64()),
+        ('dt', pa.float64()),
+        ('flow', pa.list_(pa.float64())),
+        ('pressure', pa.list_(pa.float64())),
+    ])
+
+
+def store_partitioning():
+    _check_pyarrow()
+    return ds.partitioning(pa.schema([('patient', pa.string()), ('date', pa.string())]), flavor='hive')
+
+
+def source_name(path):
+    """
+    Name breaths from a ventilator file are stored under
+    """
+    return os.path.basename(strip_compressed_suffix(path)).replace('.csv', '')
+
+
+class BreathStoreWriter(object):
+    """
+    Write the breaths of a single source file into the store. Breaths are
+    buffered by date and written a row group at a time. Files are written
+    under temporary names and renamed into place on close, replacing
+    anything stored from the same source before.
+
+    Usage:
+
+        with BreathStoreWriter('/path/to/store', '0149', 'source_name') as writer:
+            for breath in breaths:
+                writer.add_breath(breath)
+    """
+    def __init__(self, root, patient, source, row_group_size=ROW_GROUP_SIZE):
+        """
+        :param root: root directory of the store
+        :param patient: patient id
+        :param source: name of the file the breaths come from
+        :param row_group_size: number of breaths in each row group
+        """
+        _check_pyarrow()
+        self.root = str(root)
+        self.patient = str(patient)
+        self.source = source
+        self.row_group_size = row_group_size
+        self.schema = breath_schema()
+        self.writers = {}
+        self.buffers = {}
+
+    def _path_for(self, date):
+        return os.path.join(self.root, 'patient={}'.format(self.patient), 'date={}'.format(date), self.source + '.parquet')
+
+    def _tmp_path_for(self, date):
+        # files starting with . are ignored by readers until they are renamed
+        path = self._path_for(date)
+        return os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+
+    def add_breath(self, breath):
+        """
+        :param breath: breath in the format output by extract_raw
+        """
+        abs_bs_us = breath['abs_bs_us']
+        if abs_bs_us is None or abs_bs_us == NO_TIMESTAMP:
+            abs_bs_us, date = None, NO_DATE
+        else:
+            date = epoch_us_to_datetime(abs_bs_us).date().isoformat()
+        buf = self.buffers.setdefault(date, [])
+        buf.append({
+            'source': self.source,
+            'rel_bn': breath['rel_bn'],
+            'vent_bn': breath['vent_bn'],
+            'abs_bs': abs_bs_us,
+            'bs_time': breath['bs_time'],
+            'frame_dur': breath['frame_dur'],
+            'dt': breath['dt'],
+            'flow': list(breath['flow']),
+            'pressure': list(breath['pressure']),
+        })
+        if len(buf) == self.row_group_size:
+            self._flush(date)
+
+    def _flush(self, date):
+        buf = self.buffers.pop(date, [])
+        if not buf:
+            return
+        if date not in self.writers:
+            path = self._path_for(date)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.writers[date] = pq.ParquetWriter(self._tmp_path_for(date), self.schema)
+        self.writers[date].write_table(pa.Table.from_pylist(buf, schema=self.schema))
+
+    def close(self):
+        for date in list(self.buffers):
+            self._flush(date)
+        written = set()
+        for date, writer in self.writers.items():
+            writer.close()
+            path = self._path_for(date)
+            os.replace(self._tmp_path_for(date), path)
+            written.add(path)
+        # breaths from an earlier version of the source may be stored under other dates
+        for path in glob(self._path_for('*')):
+            if path not in written:
+                os.remove(path)
+
+    def abort(self):
+        for date, writer in self.writers.items():
+            writer.close()
+            os.remove(self._tmp_path_for(date))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def store_breaths(root, patient, source, breaths, row_group_size=ROW_GROUP_SIZE):
+    """
+    Store breaths from a single source file, replacing any breaths stored
+    from it before
+
+    :param breaths: iterable of breaths in the format output by extract_raw
+    """
+    with BreathStoreWriter(root, patient, source, row_group_size) as writer:
+        for breath in breaths:
+            writer.add_breath(breath)
+
+
+def store_breath_file(root, patient, path, ignore_missing_bes=False, row_group_size=ROW_GROUP_SIZE):
+    """
+    Parse a ventilator file and store its breaths. The file may be compressed.
+
+    :param root: root directory of the store
+    :param patient: patient id
+    :param path: path to the ventilator file
+    :param ignore_missing_bes: same as for extract_raw
+    """
+    with open_vent_file(path) as f:
+        store_breaths(root, patient, source_name(path), PB840File(f).iter_breaths(ignore_missing_bes), row_group_size)
+
+
+def open_store(root):
+    """
+    Open the store as a pyarrow dataset
+    """
+    _check_pyarrow()
+    return ds.dataset(str(root), format='parquet', partitioning=store_partitioning(), schema=_dataset_schema())
+
+
+def _dataset_schema():
+    return breath_schema().append(pa.field('patient', pa.string())).append(pa.field('date', pa.string()))
+
+
+def store_filter(patients=None, start=None, end=None, rel_bn_interval=[], vent_bn_interval=[], sources=None):
+    """
+    Build a filter expression for reading breaths from the store. Returns None
+    if there is nothing to filter on.
+
+    :param patients: list of patient ids
+    :param start: only breaths starting at or after this time. datetime or microseconds since the epoch
+    :param end: only breaths starting at or before this time. datetime or microseconds since the epoch
+    :param rel_bn_interval: the relative [start, end] interval for the data
+    :param vent_bn_interval: the vent bn [start, end] interval for the data
+    :param sources: list of source names
+    """
+    _check_pyarrow()
+    conditions = []
+    if patients is not None:
+        conditions.append(ds.field('patient').isin([str(p) for p in patients]))
+    if sources is not None:
+        conditions.append(ds.field('source').isin(list(sources)))
+    # date conditions only exist so whole partitions can be skipped
+    if start is not None:
+        start = to_epoch_us(start)
+        conditions.append(ds.field('date') >= epoch_us_to_datetime(start).date().isoformat())
+        conditions.append(ds.field('abs_bs') >= start)
+    if end is not None:
+        end = to_epoch_us(end)
+        conditions.append(ds.field('date') <= epoch_us_to_datetime(end).date().isoformat())
+        conditions.append(ds.field('abs_bs') <= end)
+    if rel_bn_interval:
+        conditions.append((ds.field('rel_bn') >= rel_bn_interval[0]) & (ds.field('rel_bn') <= rel_bn_interval[1]))
+    if vent_bn_interval:
+        conditions.append((ds.field('vent_bn') >= vent_bn_interval[0]) & (ds.field('vent_bn') <= vent_bn_interval[1]))
+    if not conditions:
+        return None
+    expr = conditions[0]
+    for condition in conditions[1:]:
+        expr = expr & condition
+    return expr
+
+
+def read_store(root, columns=None, **filters):
+    """
+    Read breaths from the store into a pyarrow Table. Filters are the same as
+    for store_filter.
+
+    :param columns: list of columns to read. All columns are read if None
+    """
+    return open_store(root).to_table(columns=columns, filter=store_filter(**filters))
+
+
+def iter_store_breaths(root, **filters):
+    """
+    Yield breaths from the store in the same format as extract_raw, with
+    patient and source added. Filters are the same as for store_filter.
+    Breaths of each source are output in order, one source file at a time.
+    """
+    scanner = open_store(root).scanner(filter=store_filter(**filters))
+    for batch in scanner.to_batches():
+        for row in batch.to_pylist():
+            abs_bs_us = row.pop('abs_bs')
+            row['abs_bs_us'] = abs_bs_us
+            row['abs_bs'] = OUT_FORMATTER.format(abs_bs_us) if abs_bs_us is not None else None
+            del row['date']
+            yield row
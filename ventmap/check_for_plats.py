@@ -6,10 +6,10 @@ Check specific raw file for plateau pressure areas. This script can either be us
 of checking for the plat in file or improving the plat algo.
 """
 import argparse
-from io import open
 
 from prettytable import PrettyTable
 
+from ventmap.compression import open_vent_file
 from ventmap.raw_utils import extract_raw
 from ventmap.SAM import check_if_plat_occurs
 
@@ -21,7 +21,7 @@ def main():
     parser.add_argument('--flow-bound', default=0.2, type=float)
     args = parser.parse_args()
 
-    gen = extract_raw(open(args.file, errors='ignore', encoding='ascii'), False)
+    gen = extract_raw(open_vent_file(args.file), False)
     table = PrettyTable()
     table.field_names = ['rel_bn', 'abs_bs']
     for br in gen:
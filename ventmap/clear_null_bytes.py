@@ -5,33 +5,160 @@ clear_null_bytes
 Self explanatory; clears null bytes from files
 """
 import argparse
-import os
+import io
 from io import BufferedReader, open, StringIO
 
+from ventmap.compression import open_vent_file
 
-def clear_descriptor_null_bytes(descriptor):
-    text = str(descriptor.read()).replace('\x00', '')
+NULL_BYTE = b'\x00'
+CHUNK_SIZE = 2 ** 20
+
+
+class NullByteFilter(io.RawIOBase):
+    """
+    Read only stream that removes null bytes from an underlying binary stream
+    chunk by chunk as it is read. Chunks without any null bytes are passed
+    through untouched.
+    """
+    def __init__(self, raw):
+        """
+        :param raw: binary stream to filter
+        """
+        super(NullByteFilter, self).__init__()
+        self.raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            data = self.raw.read(len(buf))
+            if not data:
+                return 0
+            if NULL_BYTE in data:
+                data = data.translate(None, NULL_BYTE)
+            # a chunk made up entirely of null bytes is not EOF
+            if data:
+                break
+        buf[:len(data)] = data
+        return len(data)
+
+
+def has_null_bytes(descriptor, chunk_size=CHUNK_SIZE):
+    """
+    Check whether a seekable descriptor contains null bytes from its current
+    position onwards. The descriptor is returned to its original position.
+    """
+    start = descriptor.tell()
+    raw = getattr(descriptor, 'buffer', descriptor)
+    null = '\x00' if isinstance(raw, io.TextIOBase) else NULL_BYTE
     try:
-        text = text.decode('utf-8', 'ignore')
-    except AttributeError:
-        pass
-    reader = StringIO(text)
+        while True:
+            chunk = raw.read(chunk_size)
+            if not chunk:
+                return False
+            if null in chunk:
+                return True
+    finally:
+        descriptor.seek(start)
+
+
+def strip_null_bytes(descriptor):
+    """
+    Wrap a descriptor so that null bytes are removed while it is being read.
+    Reading starts at the current position of the descriptor. Text descriptors
+    are wrapped using the same encoding and error handling as the original.
+
+    Descriptors that are not backed by a binary stream, like StringIO, are
+    copied instead.
+    """
+    if isinstance(descriptor, io.TextIOWrapper):
+        filtered = NullByteFilter(descriptor.buffer)
+        # the underlying buffer would be closed if the text descriptor were garbage collected
+        filtered.descriptor = descriptor
+        return io.TextIOWrapper(
+            BufferedReader(filtered, CHUNK_SIZE),
+            encoding=descriptor.encoding,
+            errors=descriptor.errors,
+        )
+    elif isinstance(descriptor, (io.BufferedIOBase, io.RawIOBase)):
+        return BufferedReader(NullByteFilter(descriptor), CHUNK_SIZE)
+    return clear_descriptor_null_bytes(descriptor)
+
+
+def clear_descriptor_null_bytes(descriptor):
+    """
+    Copy the contents of a descriptor into a StringIO object without null bytes
+    """
+    reader = StringIO()
+    while True:
+        chunk = descriptor.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if isinstance(chunk, bytes):
+            chunk = chunk.translate(None, NULL_BYTE).decode('utf-8', 'ignore')
+        else:
+            chunk = chunk.replace('\x00', '')
+        reader.write(chunk)
     reader.seek(0)
     return reader
 
 
 def clear_null_bytes(input_file):
-    with open(input_file, "rU") as old:
+    with open_vent_file(input_file, encoding=None, errors=None) as old:
         return clear_descriptor_null_bytes(old)
 
 
+def clear_null_bytes_in_place(input_file, chunk_size=CHUNK_SIZE):
+    """
+    Remove null bytes from a file without loading the whole file into memory.
+    Chunks are read ahead of where cleaned data is written back and the file is
+    truncated at the end. Nothing is written until the first null byte is found.
+
+    Returns the number of null bytes removed.
+    """
+    read_pos = write_pos = 0
+    with open(input_file, 'r+b') as f:
+        while True:
+            f.seek(read_pos)
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            read_pos += len(chunk)
+            if NULL_BYTE in chunk:
+                chunk = chunk.translate(None, NULL_BYTE)
+            elif write_pos + len(chunk) == read_pos:
+                write_pos = read_pos
+                continue
+            f.seek(write_pos)
+            f.write(chunk)
+            write_pos += len(chunk)
+        f.truncate(write_pos)
+    return read_pos - write_pos
+
+
+def clear_null_bytes_to_file(input_file, output_file, chunk_size=CHUNK_SIZE):
+    """
+    Write a copy of input_file without null bytes to output_file chunk by chunk
+    """
+    with open(input_file, 'rb') as old, open(output_file, 'wb') as new:
+        filtered = NullByteFilter(old)
+        while True:
+            chunk = filtered.read(chunk_size)
+            if not chunk:
+                break
+            new.write(chunk)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("input_file", help="rel path to input file")
+    parser.add_argument("-o", "--output-file", help="write cleaned file here instead of rewriting input file in place")
     args = parser.parse_args()
-    stringio = clear_null_bytes(args.input_file)
-    with open(new_file, "w") as new:
-        new.write(stringio.read())
+    if args.output_file:
+        clear_null_bytes_to_file(args.input_file, args.output_file)
+    else:
+        clear_null_bytes_in_place(args.input_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+"""
+ventmap.compression
+~~~~~~~~~~~~~~~~~~~
+
+Open ventilator files that may be compressed. The compression is detected
+from the first bytes of the file, not its name, and data is decompressed as
+it is read so nothing is written to disk.
+
+gzip, bzip2 and xz are supported out of the box. zstd requires the zstandard
+package.
+
+Usage:
+
+    from ventmap.compression import open_vent_file
+
+    with open_vent_file('/path/to/file.csv.gz') as f:
+        breaths = extract_raw(f, False)
+"""
+import bz2
+import gzip
+import io
+import lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+XZ = 'xz'
+ZSTD = 'zstd'
+MAGIC_BYTES = [
+    (b'\x1f\x8b', GZIP),
+    (b'BZh', BZIP2),
+    (b'\xfd7zXZ\x00', XZ),
+    (b'\x28\xb5\x2f\xfd', ZSTD),
+]
+COMPRESSED_SUFFIXES = ['.gz', '.bz2', '.xz', '.zst']
+# number of bytes to decompress at a time when skipping forward in a zstd file
+SKIP_CHUNK_SIZE = 2 ** 20
+
+
+def detect_compression(path):
+    """
+    Detect the compression of a file from its magic bytes. Returns None if the
+    file is not compressed.
+    """
+    with io.open(str(path), 'rb') as f:
+        magic = f.read(max(len(m) for m, _ in MAGIC_BYTES))
+    for prefix, compression in MAGIC_BYTES:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def strip_compressed_suffix(path):
+    """
+    Remove a compression suffix like .gz from a path if it has one
+    """
+    path = str(path)
+    for suffix in COMPRESSED_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+class ZstdFile(io.RawIOBase):
+    """
+    Read only zstd file. zstandard readers can only seek forward, so seeking
+    backwards restarts decompression from the start of the file.
+    """
+    def __init__(self, path):
+        if zstandard is None:
+            raise ImportError('zstandard must be installed to read zstd compressed files. pip install zstandard')
+        self.name = path
+        self._file = None
+        self._restart()
+
+    def _restart(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = io.open(self.name, 'rb')
+        self._reader = zstandard.ZstdDecompressor().stream_reader(self._file)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buf):
+        n = self._reader.readinto(buf)
+        self._pos += n
+        return n
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('zstd files cannot be seeked from the end')
+        if offset < self._pos:
+            self._restart()
+        while self._pos < offset:
+            data = self._reader.read(min(offset - self._pos, SKIP_CHUNK_SIZE))
+            if not data:
+                break
+            self._pos += len(data)
+        return self._pos
+
+    def close(self):
+        if self._file is not None:
+            self._reader.close()
+            self._file.close()
+            self._file = None
+        super(ZstdFile, self).close()
+
+
+def open_decompressed(path):
+    """
+    Open a file in binary mode, decompressing it if needed
+
+    :param path: path to the file. Can be str or pathlib.Path obj
+    """
+    path = str(path)
+    compression = detect_compression(path)
+    if compression == GZIP:
+        return gzip.open(path, 'rb')
+    elif compression == BZIP2:
+        return bz2.open(path, 'rb')
+    elif compression == XZ:
+        return lzma.open(path, 'rb')
+    elif compression == ZSTD:
+        return io.BufferedReader(ZstdFile(path))
+    return io.open(path, 'rb')
+
+
+def open_vent_file(path, encoding='ascii', errors='ignore'):
+    """
+    Open a ventilator file in text mode, decompressing it if needed. Files
+    are opened with ascii encoding and undecodable bytes ignored like the
+    rest of ventmap expects by default.
+
+    :param path: path to the file. Can be str or pathlib.Path obj
+    :param encoding: text encoding. None uses the platform default like io.open
+    :param errors: how to handle decoding errors. Same as for io.open
+    """
+    path = str(path)
+    if detect_compression(path) is None:
+        return io.open(path, encoding=encoding, errors=errors)
+    return io.TextIOWrapper(open_decompressed(path), encoding=encoding, errors=errors)
@@ -5,10 +5,16 @@ from io import open, StringIO
 from operator import itemgetter
 
 from ventmap.detection import detect_version_v2
-from ventmap.clear_null_bytes import clear_null_bytes
+from ventmap.clear_null_bytes import clear_null_bytes, has_null_bytes
+from ventmap.compression import open_vent_file
+from ventmap.raw_utils import find_breath_index, read_span
 
+CUT_ERROR_MSG = ("Something went wrong. The input breath numbers seem to "
+                 "be incorrect or the file format does not match a raw "
+                 "ventilator waveform file")
 
-def cut_breath_section(descriptor, bn_start, bn_end, start_abs_bs):
+
+def cut_breath_section(descriptor, bn_start, bn_end, start_abs_bs, breath_index=None):
     """
     Cut up a file by relative breath number
 
@@ -16,6 +22,7 @@ def cut_breath_section(descriptor, bn_start, bn_end, start_abs_bs):
     :param bn_start: starting (inclusive) relative breath number
     :param bn_end: ending (inclusive) relative breath number
     :param start_abs_bs: because this function cuts off the absolute breath start timestamp we can provide a new one for the file if we need. If we dont care we can just provide None
+    :param breath_index: BreathIndex for the file descriptor was opened from. If not provided we look for an up to date sidecar next to the file
     """
     try:
         bn_start = int(bn_start)
@@ -32,6 +39,11 @@ def cut_breath_section(descriptor, bn_start, bn_end, start_abs_bs):
             datetime.strptime(start_abs_bs, '%Y-%m-%d-%H-%M-%S.%f')
         except:
             raise Exception('start_abs_bs must be in format %Y-%m-%d-%H-%M-%S.%f')
+    if breath_index is None:
+        breath_index = find_breath_index(descriptor)
+    if breath_index is not None:
+        return _cut_indexed_section(descriptor, breath_index, bn_start, bn_end, start_abs_bs)
+
     record_lines = False
     end_next = False
     lines_to_keep = []
@@ -58,9 +70,39 @@ def cut_breath_section(descriptor, bn_start, bn_end, start_abs_bs):
 
         i += 1
     else:
-        raise Exception("Something went wrong. The input breath numbers seem to "
-                        "be incorrect or the file format does not match a raw "
-                        "ventilator waveform file")
+        raise Exception(CUT_ERROR_MSG)
+
+
+def _cut_indexed_section(descriptor, breath_index, bn_start, bn_end, start_abs_bs):
+    """
+    Cut a breath section by seeking straight to the BS of bn_start and reading
+    through the BE of bn_end.
+    """
+    breaths = breath_index.breaths
+    if not 1 <= bn_start <= bn_end <= len(breaths) or breaths['be_end'][bn_end - 1] < 0:
+        raise Exception(CUT_ERROR_MSG)
+    text = read_span(descriptor, breaths['bs_offset'][bn_start - 1], breaths['be_end'][bn_end - 1])
+    if text.endswith('\n'):
+        text = text[:-1]
+    text = start_abs_bs + '\n' + text if start_abs_bs else text
+    return StringIO(text)
+
+
+def open_for_cut(path):
+    """
+    Open a file to cut. If the file has an up to date breath index it is opened
+    directly so cut_breath_section can seek. Otherwise files with null bytes are
+    cleaned into memory first.
+
+    Returns the descriptor and the BreathIndex, which is None if there is none
+    """
+    descriptor = open_vent_file(path)
+    breath_index = find_breath_index(descriptor)
+    # read_span removes null bytes, so indexed files do not need to be cleaned
+    if breath_index is None and has_null_bytes(descriptor):
+        descriptor.close()
+        descriptor = clear_null_bytes(path)
+    return descriptor, breath_index
 
 
 def cut_breath_section_wrapper(raw_file, out_file, relBN_start, relBN_end):
@@ -69,8 +111,9 @@ def cut_breath_section_wrapper(raw_file, out_file, relBN_start, relBN_end):
     2017-05-19: written
     """
 
-    descriptor = clear_null_bytes(raw_file)
-    stringio = cut_breath_section(descriptor, relBN_start, relBN_end, None)
+    descriptor, breath_index = open_for_cut(raw_file)
+    with descriptor:
+        stringio = cut_breath_section(descriptor, relBN_start, relBN_end, None, breath_index)
     open(out_file, 'w').write(stringio.read())
 
 
@@ -81,8 +124,9 @@ def main():
     parser.add_argument("-e", "--bn-end", type=int, required=True, help="relative ending breath number")
     parser.add_argument("-o", "--outfile", required=True, help="name of file to output results to")
     args = parser.parse_args()
-    descriptor = clear_null_bytes(args.file)
-    stringio = cut_breath_section(descriptor, args.bn_start, args.bn_end, None)
+    descriptor, breath_index = open_for_cut(args.file)
+    with descriptor:
+        stringio = cut_breath_section(descriptor, args.bn_start, args.bn_end, None, breath_index)
     open(args.outfile, "w").write(stringio.read())
 
 
@@ -0,0 +1,229 @@
+"""
+ventmap.follow
+~~~~~~~~~~~~~~
+
+Parse breaths out of a ventilator file while it is still being written to.
+Only bytes appended since the last read are parsed, and parser state, including
+any partially written breath, is kept between reads. A breath is output as soon
+as its BE line has been written.
+
+Usage:
+
+    for breath in follow_breaths('/path/to/capture.csv', idle_timeout=60):
+        ...
+"""
+import io
+import os
+import time
+
+from ventmap.raw_utils import PB840File
+
+# seconds to wait between checks for new data
+POLL_INTERVAL = 0.05
+# most bytes read at once, so a large file is not read whole on the first poll
+READ_CHUNK_SIZE = 2 ** 20
+
+
+class LatencyStats(object):
+    """
+    Time in seconds between a breath's BE line being written and the breath
+    being output. The time a line was written is not known, so the
+    modification time of the file when the BE line was read is used instead.
+    A BE line is written no later than that, so each latency is a lower bound.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.last = None
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.last = latency
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class ChunkParser(object):
+    """
+    Parse breaths out of raw bytes that arrive in arbitrarily sized chunks.
+    Chunks do not need to end on a line boundary, an incomplete line is held
+    until the rest of it arrives.
+    """
+    def __init__(self,
+                 skip_breaths_without_be=False,
+                 rel_bn_interval=[],
+                 vent_bn_interval=[],
+                 spec_rel_bns=[],
+                 spec_vent_bns=[],
+                 vent_cls=PB840File):
+        """
+        :param vent_cls: ventilator class to parse the data with
+
+        Other arguments are the same as extract_raw
+        """
+        self.skip_breaths_without_be = skip_breaths_without_be
+        self.filters = (rel_bn_interval, vent_bn_interval, spec_rel_bns, spec_vent_bns)
+        self.vent_cls = vent_cls
+        # an incomplete line at the end of the data fed so far
+        self.pending = b''
+        self.vent_file = None
+        self.state = None
+
+    @property
+    def done(self):
+        """
+        True once no more breaths can be output because of the filters used
+        """
+        return self.state is not None and self.state.done
+
+    def feed(self, data):
+        """
+        Parse a chunk of bytes. Returns a list of breaths that were completed.
+        """
+        if self.done:
+            return []
+        data = self.pending + data
+        # only whole lines are parsed
+        cut = data.rfind(b'\n') + 1
+        self.pending = data[cut:]
+        return self._parse(data[:cut])
+
+    def close(self):
+        """
+        Signal that there is no more data. Returns a list with the last breath
+        if it has no BE and breaths without BE are being kept.
+        """
+        breaths = [] if self.done else self._parse(self.pending)
+        self.pending = b''
+        if self.state is not None:
+            breaths.extend(self.vent_file.finish_parse(self.state))
+        return breaths
+
+    def _parse(self, data):
+        if not data:
+            return []
+        if b'\x00' in data:
+            data = data.translate(None, b'\x00')
+        # stray bytes are dropped just like open_vent_file does, so one bad byte does not end a stream
+        text = data.decode('ascii', errors='ignore')
+        if self.vent_file is None:
+            # file version is detected off of the first line
+            self.vent_file = self.vent_cls(io.StringIO(text.split('\n', 1)[0]))
+            self.state = self.vent_file.start_parse(self.skip_breaths_without_be, *self.filters)
+        lines = text.split('\n')
+        # reading a file line by line does not give an empty line after the last newline
+        if text.endswith('\n'):
+            lines.pop()
+        return self.vent_file.parse_lines(self.state, lines)
+
+
+class FileFollower(object):
+    def __init__(self,
+                 path,
+                 skip_breaths_without_be=False,
+                 rel_bn_interval=[],
+                 vent_bn_interval=[],
+                 spec_rel_bns=[],
+                 spec_vent_bns=[],
+                 vent_cls=PB840File,
+                 poll_interval=POLL_INTERVAL):
+        """
+        :param path: path to the file being written
+        :param skip_breaths_without_be: skip the final breath if it has no BE when following stops
+        :param vent_cls: ventilator class to parse the file with
+        :param poll_interval: seconds to wait between checks for new data
+
+        Other arguments are the same as extract_raw
+        """
+        self.path = path
+        self.skip_breaths_without_be = skip_breaths_without_be
+        self.poll_interval = poll_interval
+        self.descriptor = io.open(path, 'rb')
+        # number of bytes of the file that have been read
+        self.offset = 0
+        self.parser = ChunkParser(skip_breaths_without_be, rel_bn_interval, vent_bn_interval,
+                                  spec_rel_bns, spec_vent_bns, vent_cls)
+        self.latency = LatencyStats()
+
+    @property
+    def done(self):
+        return self.parser.done
+
+    def poll(self):
+        """
+        Parse any data appended to the file since the last poll. Returns a list
+        of breaths that were completed. Does not wait for new data.
+        """
+        return list(self.iter_poll())
+
+    def iter_poll(self):
+        """
+        Generator version of poll. New data is read READ_CHUNK_SIZE bytes at a
+        time and breaths are yielded as soon as the chunk holding their BE has
+        been parsed.
+        """
+        stat = os.fstat(self.descriptor.fileno())
+        if stat.st_size < self.offset:
+            raise IOError('{} was truncated while it was being followed'.format(self.path))
+        self.descriptor.seek(self.offset)
+        while self.offset < stat.st_size and not self.done:
+            data = self.descriptor.read(min(stat.st_size - self.offset, READ_CHUNK_SIZE))
+            if not data:
+                break
+            self.offset += len(data)
+            breaths = self.parser.feed(data)
+            now = time.time()
+            for breath in breaths:
+                self.latency.add(max(now - stat.st_mtime, 0))
+                yield breath
+
+    def finish(self):
+        """
+        Stop following the file. Returns a list with the last breath if it has
+        no BE and breaths without BE are being kept.
+        """
+        self.descriptor.close()
+        return self.parser.close()
+
+    def follow(self, idle_timeout=None):
+        """
+        Yield breaths as they are written to the file
+
+        :param idle_timeout: stop once the file has not grown for this many seconds.
+                             If None the file is followed forever
+        """
+        last_growth = time.time()
+        while not self.done:
+            offset = self.offset
+            for breath in self.iter_poll():
+                yield breath
+            now = time.time()
+            if self.offset != offset:
+                last_growth = now
+            elif idle_timeout is not None and now - last_growth >= idle_timeout:
+                break
+            time.sleep(self.poll_interval)
+        for breath in self.finish():
+            yield breath
+
+
+def follow_breaths(path,
+                   skip_breaths_without_be=False,
+                   rel_bn_interval=[],
+                   vent_bn_interval=[],
+                   spec_rel_bns=[],
+                   spec_vent_bns=[],
+                   vent_cls=PB840File,
+                   poll_interval=POLL_INTERVAL,
+                   idle_timeout=None):
+    """
+    Yield breaths from a file as it is being written. See FileFollower for arguments.
+    """
+    follower = FileFollower(path, skip_breaths_without_be, rel_bn_interval, vent_bn_interval,
+                            spec_rel_bns, spec_vent_bns, vent_cls, poll_interval)
+    return follower.follow(idle_timeout)
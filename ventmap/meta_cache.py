@@ -0,0 +1,266 @@
+"""
+ventmap.meta_cache
+~~~~~~~~~~~~~~~~~~
+
+On disk cache of breath metadata. Results are keyed by a hash of the
+contents of the ventilator file, the breath meta function, the parameters it
+was called with and the version of ventmap. Each result is saved as a
+compressed npz file holding one array per column, plus the type of each value
+for columns that mix ints and floats, so cached results are identical to
+computed ones. The least recently used results are evicted once the cache
+grows over its size limit.
+
+To avoid hashing a file on every lookup, the cache keeps an index of the
+size, modification time and content hash of every file it has seen. A file
+is only hashed again if its size or modification time changed.
+
+Usage:
+
+    from ventmap.breath_meta import get_file_breath_meta
+
+    # uses the default cache in ~/.cache/ventmap or $VENTMAP_CACHE_DIR
+    meta = get_file_breath_meta('/path/to/file.csv', cache=True)
+    # or a cache somewhere else
+    meta = get_file_breath_meta('/path/to/file.csv', cache=BreathMetaCache('/path/to/cache'))
+"""
+import hashlib
+from io import open
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from ventmap import __version__
+from ventmap.preprocess_all_files import hash_file
+
+# bump whenever the way results are stored changes
+META_CACHE_VERSION = 2
+DEFAULT_MAX_BYTES = 2 * 2 ** 30
+INDEX_NAME = 'index.json'
+CACHE_SUFFIX = '.npz'
+
+
+def default_cache_dir():
+    return os.environ.get('VENTMAP_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'ventmap', 'breath_meta')
+
+
+# types numbers in breath meta can have. Columns mixing them, like tve1 which is
+# 0 when there is no expiratory flow and a numpy float otherwise, are stored as
+# float64 along with the index of each value's type in this list. New types go
+# at the end so the indices of stored results stay valid
+NUMBER_TYPES = [int, float, np.float64, np.int64, np.int32, np.float32, bool, np.bool_]
+INT_TYPES = (int, np.int64)
+# larger ints cannot be stored exactly as float64
+MAX_EXACT_INT = 2 ** 53
+
+
+def _column_array(values):
+    """
+    Convert a column of breath meta to an array. Returns (array, kinds) where
+    kinds is None if the column holds a single type, or else an array giving
+    the index in NUMBER_TYPES of each value. Returns None if the column cannot
+    be stored without pickling, like when it mixes strings and numbers.
+    """
+    types = set(type(v) for v in values)
+    if types == {str}:
+        return np.array(values, dtype=str), None
+    if types == {int}:
+        return np.array(values, dtype=np.int64), None
+    if not types.issubset(NUMBER_TYPES):
+        return None
+    if any(type(v) in INT_TYPES and abs(v) > MAX_EXACT_INT for v in values):
+        return None
+    kinds = None
+    if types != {float}:
+        kinds = np.array([NUMBER_TYPES.index(type(v)) for v in values], dtype=np.int8)
+    return np.array(values, dtype=np.float64), kinds
+
+
+def _column_values(array, kinds):
+    """
+    Convert a stored column back into a list of values with their original types
+    """
+    if kinds is None:
+        return array.tolist()
+    return [NUMBER_TYPES[kind](value) for kind, value in zip(kinds.tolist(), array.tolist())]
+
+
+class BreathMetaCache(object):
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param cache_dir: directory to store results in. Created if it does not exist
+        :param max_bytes: total size results can take up before the least recently used are evicted
+        """
+        self.dir = str(cache_dir or default_cache_dir())
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        self.index_path = os.path.join(self.dir, INDEX_NAME)
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = {}
+            try:
+                with open(self.index_path) as f:
+                    index = json.load(f)
+                if index.get('version') == META_CACHE_VERSION:
+                    self._index = index['files']
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        return self._index
+
+    def _save_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        with open(fd, 'w') as f:
+            f.write(json.dumps({'version': META_CACHE_VERSION, 'files': self.index}, indent=1, sort_keys=True))
+        os.replace(tmp_path, self.index_path)
+
+    def content_hash(self, path):
+        """
+        Get the sha256 of a file, only hashing it if it changed since it was last seen
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.index.get(path)
+        if entry is not None and (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return entry['sha256']
+        sha256 = hash_file(path)
+        self.index[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+        self._save_index()
+        return sha256
+
+    def key_for(self, path, func_name, **params):
+        """
+        Get the key results for a file are stored under
+
+        :param path: path to the ventilator file
+        :param func_name: name of the function computing the metadata
+        :param params: parameters the function was called with. Must be json serializable
+        """
+        key = json.dumps({
+            'sha256': self.content_hash(path),
+            'func': func_name,
+            'params': params,
+            'ventmap_version': __version__,
+            'cache_version': META_CACHE_VERSION,
+        }, sort_keys=True)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _path_for(self, key):
+        return os.path.join(self.dir, key + CACHE_SUFFIX)
+
+    def _load(self, key):
+        path = self._path_for(key)
+        try:
+            with np.load(path) as data:
+                header = data['header'].tolist()
+                columns = [data['col_{}'.format(i)] for i in range(len(header))]
+                kinds = [
+                    data['kinds_{}'.format(i)] if 'kinds_{}'.format(i) in data.files else None
+                    for i in range(len(header))
+                ]
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        # modification time is the last use of a result
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return header, columns, kinds
+
+    def get_columns(self, key):
+        """
+        Get the header and list of column arrays cached under key. Returns None
+        if nothing is cached under key.
+        """
+        result = self._load(key)
+        if result is None:
+            return None
+        return result[0], result[1]
+
+    def get(self, key, to_data_frame=False):
+        """
+        Get cached breath metadata in the format output by get_file_breath_meta.
+        Returns None if nothing is cached under key.
+        """
+        result = self._load(key)
+        if result is None:
+            return None
+        header, columns, kinds = result
+        rows = [list(row) for row in zip(*[_column_values(col, k) for col, k in zip(columns, kinds)])]
+        if not to_data_frame:
+            return [header] + rows
+        else:
+            return pd.DataFrame(rows, columns=header)
+
+    def put_columns(self, key, header, columns, kinds=None):
+        """
+        Cache breath metadata given as a header and a list of column arrays
+
+        :param kinds: list with the types of the values in each column, as given by _column_array
+        """
+        arrays = {'col_{}'.format(i): col for i, col in enumerate(columns)}
+        arrays.update({'kinds_{}'.format(i): k for i, k in enumerate(kinds or []) if k is not None})
+        fd, tmp_path = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        with open(fd, 'wb') as f:
+            np.savez_compressed(f, header=np.array(header, dtype=str), version=np.array(__version__), **arrays)
+        os.replace(tmp_path, self._path_for(key))
+        self.evict()
+
+    def put(self, key, array):
+        """
+        Cache breath metadata in the list format output by get_file_breath_meta.
+        Returns False if the metadata cannot be stored.
+        """
+        header, rows = array[0], array[1:]
+        columns = [_column_array(list(col)) for col in zip(*rows)] if rows else [(np.array([]), None)] * len(header)
+        if any(col is None for col in columns):
+            return False
+        self.put_columns(key, header, [col for col, _ in columns], [kinds for _, kinds in columns])
+        return True
+
+    def entries(self):
+        """
+        Paths of all cached results, least recently used first
+        """
+        paths = [os.path.join(self.dir, name) for name in os.listdir(self.dir) if name.endswith(CACHE_SUFFIX)]
+        return sorted(paths, key=lambda p: os.stat(p).st_mtime_ns)
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in self.entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Remove the least recently used results until the cache fits in max_bytes
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        sizes = [os.path.getsize(path) for path in entries]
+        total = sum(sizes)
+        for path, size in zip(entries, sizes):
+            if total <= max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def invalidate(self, version=None):
+        """
+        Remove results computed by a version of ventmap. If version is None
+        every result not computed by the installed version is removed.
+        """
+        for path in self.entries():
+            try:
+                with np.load(path) as data:
+                    result_version = str(data['version'])
+            except (IOError, OSError, ValueError, KeyError):
+                result_version = None
+            if (result_version == version) if version is not None else (result_version != __version__):
+                os.remove(path)
+
+    def clear(self):
+        for path in self.entries():
+            os.remove(path)
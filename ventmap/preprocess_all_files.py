@@ -3,25 +3,200 @@ preprocess_all_files
 ~~~~~~~~~~~~~~~~~~~~
 
 Preprocess all files in a given directory so they can be loaded in the future more quickly
+
+A manifest is kept in each directory recording the size, modification time and
+content hash of every file that was preprocessed along with the version of
+ventmap that processed it. Files that have not changed since they were last
+processed are skipped, and the manifest is updated after every file so an
+interrupted run picks up where it left off.
 """
 import argparse
 from glob import glob
+import hashlib
 from io import open
+import json
+import multiprocessing
 import os
+import sys
+import traceback
 
+from ventmap import __version__
+from ventmap.compression import COMPRESSED_SUFFIXES, open_vent_file, strip_compressed_suffix
+from ventmap.processed_file import PROCESSED_SUFFIX, PROCESSED_VERSION, RAW_SUFFIX
 from ventmap.raw_utils import process_breath_file
 
+MANIFEST_NAME = '.ventmap_manifest.json'
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 2 ** 20
+
+
+def output_filename_for(filename):
+    return os.path.splitext(strip_compressed_suffix(filename))[0]
+
+
+def hash_file(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_file_info(filename):
+    """
+    Get the information about a file that is stored in the manifest
+    """
+    stat = os.stat(filename)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': hash_file(filename),
+        'ventmap_version': __version__,
+        'processed_version': PROCESSED_VERSION,
+    }
+
+
+class Manifest(object):
+    def __init__(self, path):
+        """
+        :param path: path to the manifest file. It is created if it does not exist
+        """
+        self.path = path
+        self.files = {}
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.files = manifest['files']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    @classmethod
+    def for_dir(cls, dir):
+        return cls(os.path.join(dir, MANIFEST_NAME))
+
+    def is_current(self, filename):
+        """
+        Check if the preprocessed output of a file is up to date. The file is
+        only hashed if its modification time changed without its size changing.
+        """
+        entry = self.files.get(os.path.basename(filename))
+        if entry is None:
+            return False
+        if (entry['ventmap_version'], entry['processed_version']) != (__version__, PROCESSED_VERSION):
+            return False
+        output_filename = output_filename_for(filename)
+        if not (os.path.exists(output_filename + RAW_SUFFIX) and os.path.exists(output_filename + PROCESSED_SUFFIX)):
+            return False
+        stat = os.stat(filename)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime_ns']:
+            return True
+        # the file was touched but its contents may still be the same
+        if hash_file(filename) != entry['sha256']:
+            return False
+        entry['mtime_ns'] = stat.st_mtime_ns
+        return True
+
+    def record(self, filename, file_info):
+        self.files[os.path.basename(filename)] = file_info
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'version': MANIFEST_VERSION, 'files': self.files}, indent=1, sort_keys=True))
+        os.replace(tmp_path, self.path)
+
+
+def preprocess_file(filename):
+    """
+    Preprocess a single file. Output is saved next to the file with the
+    same name minus the .csv suffix and any compression suffix.
+    """
+    output_filename = output_filename_for(filename)
+    with open_vent_file(filename) as f:
+        process_breath_file(f, False, output_filename)
+    return output_filename
+
+
+def _preprocess_file_catch_errors(filename):
+    try:
+        # file info is taken before processing so that a file modified while
+        # it is being processed is processed again on the next run
+        file_info = get_file_info(filename)
+        preprocess_file(filename)
+    except Exception:
+        return filename, None, traceback.format_exc()
+    return filename, file_info, None
+
+
+def preprocess_files(files, workers=1, use_manifest=True):
+    """
+    Preprocess a list of files. Files are processed largest first so that
+    big files do not end up running alone at the end when using multiple
+    workers. A file that fails to process does not stop the rest of the files.
+
+    Returns a dict mapping each file that failed to its traceback.
+
+    :param files: list of files to preprocess
+    :param workers: number of processes to use
+    :param use_manifest: skip files that are unchanged according to the manifest in their
+                         directory. If False every file is processed, and manifests are
+                         still updated
+    """
+    manifests = {}
+    for filename in files:
+        dir = os.path.dirname(os.path.abspath(filename))
+        if dir not in manifests:
+            manifests[dir] = Manifest.for_dir(dir)
+    if use_manifest:
+        files = [f for f in files if not manifests[os.path.dirname(os.path.abspath(f))].is_current(f)]
+
+    files = sorted(files, key=os.path.getsize, reverse=True)
+    errors = {}
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_preprocess_file_catch_errors, files)
+    else:
+        pool = None
+        results = map(_preprocess_file_catch_errors, files)
+    try:
+        for filename, file_info, error in results:
+            if error is not None:
+                print('failed to preprocess {}:\n{}'.format(filename, error))
+                errors[filename] = error
+                continue
+            manifest = manifests[os.path.dirname(os.path.abspath(filename))]
+            manifest.record(filename, file_info)
+            manifest.save()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    # save updated modification times of files that were touched but not changed
+    for manifest in manifests.values():
+        if manifest.files:
+            manifest.save()
+    return errors
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('dir')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes to preprocess files with')
+    parser.add_argument('-f', '--force', action='store_true', help='preprocess all files even if they have not changed since they were last preprocessed')
     args = parser.parse_args()
 
     files = glob(os.path.join(args.dir, '*.csv'))
-    for filename in files:
-        output_filename = os.path.splitext(filename)[0]
-
-        process_breath_file(open(filename, encoding='ascii', errors='ignore'), False, output_filename)
+    for suffix in COMPRESSED_SUFFIXES:
+        files.extend(glob(os.path.join(args.dir, '*.csv' + suffix)))
+    errors = preprocess_files(files, args.workers, use_manifest=not args.force)
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
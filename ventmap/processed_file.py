@@ -0,0 +1,530 @@
+"""
+ventmap.processed_file
+~~~~~~~~~~~~~~~~~~~~~~
+
+On disk layout of files written by process_breath_file. Each processed file
+is stored as two .npy files:
+
+    <prefix>.raw.npy: float64 array of shape (n_obs, 2) holding flow, pressure
+    <prefix>.processed.npy: structured array with one row per breath
+
+Neither file needs pickle to be read, so both are memory mapped on load
+instead of being read into memory.
+
+Flow and pressure can instead be stored encoded in <prefix>.raw.npz. Samples
+are read from files with 2 decimals, so they are stored as integer hundredths
+in int16 or int32, delta encoded within each breath, and the file can
+optionally be zlib compressed. Decoding gives back exactly the same float64
+values. Data that does not round trip exactly is stored as float64 instead.
+Encoded files are decoded into memory on load.
+
+Older versions of ventmap wrote .processed.npy as an object or unicode array
+of [rel_bn, vent_bn, abs_bs, bs_time, frame_dur, dt, start_idx, end_idx]
+rows. These files are converted to the structured layout when they are read.
+"""
+import os
+import struct
+import sys
+import zipfile
+
+import numpy as np
+
+from ventmap.timestamps import NO_TIMESTAMP, OUT_FORMATTER, OUT_TIMESTAMPS
+
+RAW_SUFFIX = '.raw.npy'
+ENCODED_RAW_SUFFIX = '.raw.npz'
+PROCESSED_SUFFIX = '.processed.npy'
+# encoded samples are stored in units of 1 / RAW_SCALE
+RAW_SCALE = 100
+# abs_bs: breath start in microseconds since the epoch, NO_TIMESTAMP if unknown
+# start_idx/end_idx: the breath is found in raw[start_idx:end_idx]
+PROCESSED_DTYPE_V1 = np.dtype([
+    ('rel_bn', np.int32),
+    ('vent_bn', np.int32),
+    ('abs_bs', np.int64),
+    ('bs_time', np.float64),
+    ('frame_dur', np.float64),
+    ('dt', np.float64),
+    ('start_idx', np.int64),
+    ('end_idx', np.int64),
+])
+# the dtype stored in the .npy header identifies the version of a processed
+# file. Add a new entry here whenever the layout changes.
+PROCESSED_DTYPES = {
+    1: PROCESSED_DTYPE_V1,
+}
+PROCESSED_VERSION = 1
+PROCESSED_DTYPE = PROCESSED_DTYPES[PROCESSED_VERSION]
+# number of breaths of metadata ProcessedWriter holds in memory between writes
+WRITER_BUFFER_SIZE = 4096
+# number of rows copied at a time when ProcessedWriter writes an encoded file
+ENCODE_CHUNK_SIZE = 2 ** 20
+
+
+def processed_path_for(raw_file):
+    if raw_file.endswith(ENCODED_RAW_SUFFIX):
+        return raw_file[:-len(ENCODED_RAW_SUFFIX)] + PROCESSED_SUFFIX
+    return raw_file.replace(RAW_SUFFIX, PROCESSED_SUFFIX)
+
+
+def get_processed_version(processed):
+    """
+    Get the layout version of a loaded .processed.npy array. Legacy
+    object/unicode arrays are version 0.
+    """
+    if processed.dtype.names is None:
+        return 0
+    for version, dtype in PROCESSED_DTYPES.items():
+        if processed.dtype == dtype:
+            return version
+    raise ValueError('processed file has an unsupported layout: {}'.format(processed.dtype))
+
+
+def convert_legacy_processed(processed):
+    """
+    Convert rows from a legacy .processed.npy array into the structured layout
+    """
+    converted = np.zeros(len(processed), dtype=PROCESSED_DTYPE)
+    for i, row in enumerate(processed):
+        abs_bs = row[2]
+        # unicode arrays store missing timestamps as the string 'None'
+        if abs_bs is None or abs_bs == 'None':
+            abs_bs = NO_TIMESTAMP
+        else:
+            abs_bs = OUT_TIMESTAMPS.to_epoch_us(str(abs_bs))
+        converted[i] = (
+            int(row[0]), int(row[1]), abs_bs, float(row[3]), float(row[-4]), float(row[-3]), int(row[-2]), int(row[-1])
+        )
+    return converted
+
+
+def load_processed(processed_file, mmap_mode='r'):
+    """
+    Load a .processed.npy file as a structured array with PROCESSED_DTYPE.
+    Files in the current layout are memory mapped, legacy files are converted
+    in memory.
+
+    :param processed_file: path to the .processed.npy file
+    :param mmap_mode: mmap_mode to pass to np.load. None reads the file into memory
+    """
+    try:
+        processed = np.load(processed_file, mmap_mode=mmap_mode)
+    except ValueError:
+        # legacy object arrays hold python objects and cannot be mapped
+        processed = np.load(processed_file, allow_pickle=True)
+    if get_processed_version(processed) == 0:
+        return convert_legacy_processed(processed)
+    return processed
+
+
+def load_raw(raw_file, mmap_mode='r'):
+    """
+    Load a .raw.npy or .raw.npz file. Returns an array of shape (n_obs, 2) holding
+    flow and pressure. Encoded .raw.npz files are always decoded into memory.
+    """
+    if raw_file.endswith(ENCODED_RAW_SUFFIX):
+        with np.load(raw_file) as npz:
+            return decode_raw(npz)
+    return np.load(raw_file, mmap_mode=mmap_mode).reshape(-1, 2)
+
+
+def encode_raw(raw, starts):
+    """
+    Encode flow and pressure as integer hundredths delta encoded within each
+    breath. Returns a dict of arrays to save in a .raw.npz file. If the
+    samples do not round trip exactly they are stored as float64.
+
+    :param raw: float64 array of shape (n_obs, 2)
+    :param starts: index of the first sample of each breath
+    """
+    raw = np.asarray(raw, dtype=np.float64).reshape(-1, 2)
+    starts = np.asarray(starts, dtype=np.int64)
+    # breaths without samples at the end of the file start past the last sample
+    starts = starts[starts < len(raw)]
+    scaled = _scale_raw(raw)
+    if scaled is None:
+        return {'raw': raw}
+    # -0.00 shows up in ventilator files but has no integer equivalent, so its positions are kept
+    neg_zeros = np.flatnonzero((raw == 0) & np.signbit(raw))
+    deltas = scaled.copy()
+    deltas[1:] -= scaled[:-1]
+    # the first sample of each breath is stored as is
+    deltas[starts] = scaled[starts]
+    limit = np.abs(deltas).max(initial=0)
+    dtype = np.int16 if limit <= np.iinfo(np.int16).max else np.int32
+    if limit > np.iinfo(np.int32).max:
+        return {'raw': raw}
+    return {'deltas': deltas.astype(dtype), 'starts': starts, 'neg_zeros': neg_zeros, 'scale': np.array(RAW_SCALE)}
+
+
+def _scale_raw(raw):
+    """
+    Get raw samples as int64 hundredths, or None if they do not round trip exactly
+    """
+    with np.errstate(invalid='ignore'):
+        scaled = np.rint(raw * RAW_SCALE)
+    fits = np.isfinite(scaled).all() and np.abs(scaled).max(initial=0) < 2 ** 31
+    if not fits or not np.array_equal((scaled / RAW_SCALE).view(np.int64), raw.view(np.int64)):
+        return None
+    return scaled.astype(np.int64)
+
+
+def decode_raw(encoded):
+    """
+    Decode arrays written by encode_raw back into a float64 array of shape (n_obs, 2)
+    """
+    if 'raw' in encoded:
+        return encoded['raw']
+    deltas, starts = encoded['deltas'], encoded['starts']
+    values = np.cumsum(deltas, axis=0, dtype=np.int64)
+    if len(starts):
+        # each breath restarts from its first sample, so subtract the sum of everything before it
+        bases = np.zeros((len(starts), 2), dtype=np.int64)
+        bases[starts > 0] = values[starts[starts > 0] - 1]
+        lengths = np.diff(np.append(starts, len(values)))
+        values[starts[0]:] -= np.repeat(bases, lengths, axis=0)
+    raw = values / float(encoded['scale'])
+    raw.reshape(-1)[encoded['neg_zeros']] = -0.0
+    return raw
+
+
+def _save_encoded_atomic(path, raw, starts, compress):
+    tmp_path = path + '.tmp'
+    save = np.savez_compressed if compress else np.savez
+    with open(tmp_path, 'wb') as f:
+        save(f, **encode_raw(raw, starts))
+    os.replace(tmp_path, path)
+
+
+def _save_npz_chunked(path, arrays, compress):
+    """
+    Save arrays to a .npz file like np.savez, copying ENCODE_CHUNK_SIZE rows at
+    a time so memory mapped arrays are never read into memory all at once.
+
+    :param path: path of the .npz file to write
+    :param arrays: list of (name, array, dtype) to save. array is cast to dtype as it is written
+    :param compress: zlib compress the arrays
+    """
+    tmp_path = path + '.tmp'
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(tmp_path, 'w', compression=compression, allowZip64=True) as zf:
+        for name, array, dtype in arrays:
+            with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                    'fortran_order': False,
+                    'shape': array.shape,
+                })
+                if array.ndim == 0:
+                    f.write(np.asarray(array, dtype=dtype).tobytes())
+                    continue
+                for i in range(0, len(array), ENCODE_CHUNK_SIZE):
+                    f.write(np.ascontiguousarray(array[i:i + ENCODE_CHUNK_SIZE], dtype=dtype).tobytes())
+    os.replace(tmp_path, path)
+
+
+def _save_atomic(path, array):
+    # write to a temporary file first so that readers never see a partially written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def write_processed(output_filename, processed, flow, pressure, encode=False, compress=False):
+    """
+    Each file is written to a temporary file and then renamed into place.
+
+    :param output_filename: file prefix. Outputs <prefix>.raw.npy and <prefix>.processed.npy
+    :param processed: structured array with PROCESSED_DTYPE
+    :param flow: flow observations for all breaths back to back
+    :param pressure: pressure observations for all breaths back to back
+    :param encode: write flow and pressure encoded to <prefix>.raw.npz instead of <prefix>.raw.npy
+    :param compress: zlib compress encoded flow and pressure
+    """
+    processed = np.asarray(processed, dtype=PROCESSED_DTYPE)
+    raw = np.array([flow, pressure], dtype=np.float64).transpose()
+    if encode:
+        _save_encoded_atomic(output_filename + ENCODED_RAW_SUFFIX, raw, processed['start_idx'], compress)
+    else:
+        _save_atomic(output_filename + RAW_SUFFIX, raw)
+    _save_atomic(output_filename + PROCESSED_SUFFIX, processed)
+
+
+class NpyAppender(object):
+    """
+    Write a .npy file by appending rows to the end of it, so the array never
+    has to be held in memory. Room is left in the header for any number of
+    rows and the final shape is filled in on close. Rows are written to a
+    temporary file that is renamed into place on close.
+    """
+    def __init__(self, path, dtype, row_shape=()):
+        """
+        :param path: path of the .npy file to write
+        :param dtype: dtype of the array
+        :param row_shape: shape of each row. () for a 1 dimensional array
+        """
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.n_rows = 0
+        # the header is padded to the size needed for the largest possible shape
+        max_len = len(np.lib.format.magic(1, 0)) + 3 + len(self._header_dict(sys.maxsize))
+        self.header_len = -(-max_len // np.lib.format.ARRAY_ALIGN) * np.lib.format.ARRAY_ALIGN
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(self._header(0))
+
+    def _header_dict(self, n_rows):
+        return "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(self.dtype), (n_rows,) + self.row_shape
+        )
+
+    def _header(self, n_rows):
+        magic = np.lib.format.magic(1, 0)
+        header = self._header_dict(n_rows).ljust(self.header_len - len(magic) - 3) + '\n'
+        return magic + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != self.row_shape:
+            raise ValueError('expected rows of shape {} but got {}'.format(self.row_shape, rows.shape[1:]))
+        self.file.write(rows.tobytes())
+        self.n_rows += len(rows)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self._header(self.n_rows))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Stop writing and remove the partially written file
+        """
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class ProcessedWriter(object):
+    """
+    Write a processed file one breath at a time. Flow and pressure are
+    appended to the .raw.npy file as each breath is added and breath
+    metadata is buffered in a small structured array, so memory use does
+    not grow with the number of breaths written.
+
+    With encode=True each breath is also delta encoded as it is added and
+    the deltas are appended to a temporary file. On close the deltas are
+    copied into the .raw.npz file in chunks, so encoding does not grow
+    memory use either.
+
+    Usage:
+
+        with ProcessedWriter('new_filename') as writer:
+            for breath in breaths:
+                writer.add_breath(breath['rel_bn'], breath['vent_bn'], breath['abs_bs_us'], ...)
+    """
+    def __init__(self, output_filename, buffer_size=WRITER_BUFFER_SIZE, encode=False, compress=False):
+        """
+        :param output_filename: file prefix. Outputs <prefix>.raw.npy and <prefix>.processed.npy
+        :param buffer_size: number of breaths of metadata to hold in memory between writes
+        :param encode: write flow and pressure encoded to <prefix>.raw.npz instead of <prefix>.raw.npy.
+                       The .raw.npy file is still written in case the samples cannot be encoded
+                       exactly, and is removed on close
+        :param compress: zlib compress encoded flow and pressure
+        """
+        self.output_filename = output_filename
+        self.encode = encode
+        self.compress = compress
+        self.raw = NpyAppender(output_filename + RAW_SUFFIX, np.float64, (2,))
+        self.processed = NpyAppender(output_filename + PROCESSED_SUFFIX, PROCESSED_DTYPE)
+        self.buffer = np.zeros(buffer_size, dtype=PROCESSED_DTYPE)
+        self.n_buffered = 0
+        self.n_obs = 0
+        self.deltas = None
+        self.neg_zeros = None
+        if encode:
+            self.deltas = NpyAppender(output_filename + '.deltas.npy', np.int64, (2,))
+            self.neg_zeros = NpyAppender(output_filename + '.neg_zeros.npy', np.int64)
+            # largest absolute delta so far. None once a sample cannot be encoded exactly
+            self.delta_limit = 0
+
+    def add_breath(self, rel_bn, vent_bn, abs_bs_us, bs_time, frame_dur, dt, flow, pressure):
+        """
+        :param abs_bs_us: breath start in microseconds since the epoch. Can be None
+        """
+        if len(flow) != len(pressure):
+            raise ValueError('flow and pressure must be the same length')
+        raw = np.array([flow, pressure], dtype=np.float64).reshape(2, -1).transpose()
+        self.raw.append(raw)
+        if self.encode and self.delta_limit is not None:
+            self._encode_breath(raw)
+        self.buffer[self.n_buffered] = (
+            rel_bn, vent_bn, abs_bs_us if abs_bs_us is not None else NO_TIMESTAMP,
+            bs_time, frame_dur, dt, self.n_obs, self.n_obs + len(flow)
+        )
+        self.n_obs += len(flow)
+        self.n_buffered += 1
+        if self.n_buffered == len(self.buffer):
+            self.flush()
+
+    def _encode_breath(self, raw):
+        """
+        Delta encode the samples of a breath the same way encode_raw does
+        """
+        scaled = _scale_raw(raw)
+        if scaled is None:
+            self.delta_limit = None
+            return
+        deltas = scaled.copy()
+        deltas[1:] -= scaled[:-1]
+        self.delta_limit = max(self.delta_limit, np.abs(deltas).max(initial=0))
+        self.deltas.append(deltas)
+        self.neg_zeros.append(np.flatnonzero((raw == 0) & np.signbit(raw)) + 2 * self.n_obs)
+
+    def flush(self):
+        self.processed.append(self.buffer[:self.n_buffered])
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.raw.close()
+        self.processed.close()
+        if self.encode:
+            self._close_encoded()
+
+    def _close_encoded(self):
+        self.deltas.close()
+        self.neg_zeros.close()
+        raw_file = self.output_filename + RAW_SUFFIX
+        if self.delta_limit is None or self.delta_limit > np.iinfo(np.int32).max:
+            arrays = [('raw', load_raw(raw_file), np.float64)]
+        else:
+            start_idx = load_processed(self.output_filename + PROCESSED_SUFFIX)['start_idx']
+            dtype = np.int16 if self.delta_limit <= np.iinfo(np.int16).max else np.int32
+            arrays = [
+                ('deltas', np.load(self.deltas.path, mmap_mode='r'), dtype),
+                # breaths without samples at the end of the file start past the last sample
+                ('starts', start_idx[:np.searchsorted(start_idx, self.n_obs)], np.int64),
+                ('neg_zeros', np.load(self.neg_zeros.path, mmap_mode='r'), np.int64),
+                ('scale', np.array(RAW_SCALE), np.int64),
+            ]
+        _save_npz_chunked(self.output_filename + ENCODED_RAW_SUFFIX, arrays, self.compress)
+        del arrays
+        for path in [raw_file, self.deltas.path, self.neg_zeros.path]:
+            os.remove(path)
+
+    def abort(self):
+        self.raw.abort()
+        self.processed.abort()
+        if self.encode:
+            self.deltas.abort()
+            self.neg_zeros.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ProcessedFile(object):
+    """
+    Lazy reader for files written by process_breath_file. Nothing is read until
+    a breath is requested, and the flow and pressure of each breath are views
+    into the memory mapped .raw.npy file.
+
+    Usage:
+
+        processed = ProcessedFile('new_filename.raw.npy')
+        len(processed)
+        processed[100], processed[100:110]
+        processed.get_rel_bn(100), processed.get_vent_bn(65427)
+        for breath in processed:
+            ...
+    """
+    def __init__(self, raw_file, as_lists=False):
+        """
+        :param raw_file: filename for the raw numpy file. Should have a file suffix of '.raw.npy',
+                         or '.raw.npz' for encoded files
+        :param as_lists: output flow and pressure as lists like read_processed_file did
+                         instead of as array views
+        """
+        self.raw_file = raw_file
+        self.as_lists = as_lists
+        self.raw = load_raw(raw_file)
+        self.processed = load_processed(processed_path_for(raw_file))
+
+    def _subset(self, processed):
+        subset = object.__new__(self.__class__)
+        subset.__dict__.update(self.__dict__)
+        subset.processed = processed
+        return subset
+
+    def __len__(self):
+        return len(self.processed)
+
+    def __getitem__(self, rel_bn):
+        """
+        Index breaths by relative breath number, like get_rel_bn. Slicing returns a ProcessedFile
+        holding the breaths with relative breath numbers in [start, stop).
+        """
+        if isinstance(rel_bn, slice):
+            if rel_bn.step is not None:
+                raise ValueError('breaths can not be sliced with a step')
+            rel_bns = self.processed['rel_bn']
+            start = 0 if rel_bn.start is None else np.searchsorted(rel_bns, rel_bn.start)
+            stop = len(self) if rel_bn.stop is None else np.searchsorted(rel_bns, rel_bn.stop)
+            return self._subset(self.processed[start:stop])
+        return self.get_rel_bn(rel_bn)
+
+    def __iter__(self):
+        for row in self.processed.tolist():
+            yield self._make_breath(row)
+
+    def get_rel_bn(self, rel_bn):
+        """
+        Get the breath with a specific relative breath number
+        """
+        idx = np.searchsorted(self.processed['rel_bn'], rel_bn)
+        if idx == len(self) or self.processed['rel_bn'][idx] != rel_bn:
+            raise KeyError(rel_bn)
+        return self._make_breath(self.processed[idx].item())
+
+    def get_rel_bn_interval(self, start, end):
+        """
+        Get the breaths with relative breath numbers in [start, end]
+        """
+        rel_bns = self.processed['rel_bn']
+        return self._subset(self.processed[np.searchsorted(rel_bns, start):np.searchsorted(rel_bns, end, side='right')])
+
+    def get_vent_bn(self, vent_bn):
+        """
+        Get the first breath with a specific ventilator breath number
+        """
+        matches = np.flatnonzero(self.processed['vent_bn'] == vent_bn)
+        if len(matches) == 0:
+            raise KeyError(vent_bn)
+        return self._make_breath(self.processed[matches[0]].item())
+
+    def _make_breath(self, row):
+        rel_bn, vent_bn, abs_bs_us, bs_time, frame_dur, dt, start_idx, end_idx = row
+        raw_breath_data = self.raw[start_idx:end_idx]
+        breath = {
+            "rel_bn": rel_bn,
+            "vent_bn": vent_bn,
+            "flow": raw_breath_data[:, 0],
+            "pressure": raw_breath_data[:, 1],
+            "abs_bs": OUT_FORMATTER.format(abs_bs_us) if abs_bs_us != NO_TIMESTAMP else None,
+            "bs_time": bs_time,
+            "frame_dur": frame_dur,
+            "dt": dt,
+        }
+        if self.as_lists:
+            breath['flow'], breath['pressure'] = list(breath['flow']), list(breath['pressure'])
+        else:
+            breath['abs_bs_us'] = abs_bs_us if abs_bs_us != NO_TIMESTAMP else None
+        return breath
@@ -6,8 +6,8 @@ Extract raw data from a text file and return it in some kind of presentable form
 """
 import csv
 from datetime import datetime, timedelta
-from dateutil import parser
 import io
+import os
 import re
 from operator import xor
 from io import StringIO
@@ -17,19 +17,109 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 
+from ventmap.breath_batch import BreathBatch
+from ventmap.compression import open_vent_file, strip_compressed_suffix
 from ventmap.clear_null_bytes import clear_descriptor_null_bytes
 from ventmap.constants import IN_DATETIME_FORMAT, OUT_DATETIME_FORMAT
 from ventmap.detection import detect_version_v2
+from ventmap.processed_file import ProcessedFile, PROCESSED_DTYPE, ProcessedWriter, write_processed
+from ventmap.timestamps import (
+    epoch_us_to_datetime, IN_FORMATTER, IN_TIMESTAMPS, NO_TIMESTAMP, OUT_FORMATTER, seconds_to_us, THREE_COL_TIMESTAMPS
+)
+
+
+BAD_DESCRIPTOR_MSG = 'You seem to have opened a file with garbled bytes. you should open it using io.open(file, encoding="ascii", errors="ignore"'
+DATE_SEARCH = re.compile(r"^2\d{3}-\d{2}-")
+VENT_BN_REGEX = re.compile(r"S:(\d+)")
+# approximate number of bytes of lines to read from a descriptor at a time
+LINE_CHUNK_SIZE = 2 ** 16
 
 
 class BadDescriptorError(Exception):
     pass
 
 
+def _is_seekable(descriptor):
+    try:
+        return descriptor.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def parse_1st_col_ts(ts):
+    """
+    Parse the timestamp found in the first column of 3 column files
+    """
+    return THREE_COL_TIMESTAMPS.to_datetime(ts)
+
+
+def read_span(descriptor, start, end):
+    """
+    Read the text between two byte offsets of a file descriptor. Null bytes are
+    removed and, for text descriptors, the descriptor's encoding and newline
+    handling are applied just like they would be for a sequential read.
+
+    :param descriptor: descriptor opened with io.open. Can be in text or binary mode
+    :param start: byte offset to start reading from
+    :param end: byte offset to stop reading at
+    """
+    raw = getattr(descriptor, 'buffer', descriptor)
+    raw.seek(start)
+    data = raw.read(end - start)
+    try:
+        if raw is not descriptor:
+            data = data.decode(descriptor.encoding, descriptor.errors).replace('\r\n', '\n')
+        else:
+            data = data.decode('ascii')
+    except UnicodeDecodeError:
+        raise BadDescriptorError(BAD_DESCRIPTOR_MSG)
+    return data.replace('\x00', '')
+
+
+def find_breath_index(descriptor):
+    """
+    Load the breath index sidecar for the file a descriptor was opened from.
+    Returns None if the descriptor is not backed by a named file or if no up to
+    date index exists.
+    """
+    from ventmap.breath_index import load_breath_index
+
+    name = getattr(descriptor, 'name', None)
+    if not isinstance(name, str) or not _is_seekable(descriptor):
+        return None
+    # index offsets are for the bytes on disk, which a decompressed stream does not match
+    if not isinstance(getattr(getattr(descriptor, 'buffer', descriptor), 'raw', None), io.FileIO):
+        return None
+    return load_breath_index(name)
+
+
+class ParseState(object):
+    """
+    State of an incremental parse that is not stored on the ventilator object.
+    This is the breath currently being collected along with the breath filters.
+    """
+    def __init__(self, dt, ticks, skip_breaths_without_be, rel_bn_interval, vent_bn_interval, spec_rel_bns, spec_vent_bns):
+        self.skip_breaths_without_be = skip_breaths_without_be
+        self.rel_bn_interval = rel_bn_interval
+        self.vent_bn_interval = vent_bn_interval
+        self.spec_rel_bns = sorted(spec_rel_bns)
+        self.spec_vent_bns = sorted(spec_vent_bns)
+        self.last_breath_time = dt
+        self.has_bs = False
+        self.flow, self.pressure = [], []
+        self.ticks = ticks
+        # set once the requested breaths have all been seen or the parse is finished
+        self.done = False
+
+
 class VentilatorBase(object):
-    def __init__(self, descriptor):
+    def __init__(self, descriptor, breath_index=None, format_timestamps=True):
         """
         :param descriptor: The file descriptor to use
+        :param breath_index: BreathIndex to use for seeking straight to requested breaths. If
+                             not provided we look for an up to date sidecar next to the file
+        :param format_timestamps: output abs_bs as a formatted string. If False abs_bs is set
+                                  to None and only the numeric abs_bs_us is output
         """
         self.descriptor = descriptor
         if not  isinstance(self.descriptor, StringIO) and \
@@ -37,22 +127,75 @@ class VentilatorBase(object):
         and not isinstance(self.descriptor, io.TextIOWrapper) \
         and not isinstance(self.descriptor, io.BufferedReader):
             raise ValueError("Provide a file descriptor as input! Make sure you are using a Python3 compatible descriptor such as io.open.")
+        self.format_timestamps = format_timestamps
         self.rel_bs_time = 0
-        self.abs_bs_time = None
-        self.cur_abs_time = None
+        # absolute time is kept as integer microseconds since the epoch. Between
+        # timestamps the clock is advanced by counting data rows since the last one
+        self.dt_us = seconds_to_us(self.dt)
+        self.abs_bs_us = None
+        self.anchor_us = None
+        self.ticks_since_anchor = 0
         self.vent_bn = 0
         self.rel_bn = 0
         try:
-            self.descriptor = clear_descriptor_null_bytes(self.descriptor)
+            # seekable descriptors are read lazily line by line in iter_breaths. Anything
+            # else has to be buffered up front so that we can rewind after version detection
+            if not _is_seekable(self.descriptor):
+                self.descriptor = clear_descriptor_null_bytes(self.descriptor)
+            self.descriptor.seek(0)
+            first_line = self._decode_line(self.descriptor.readline()).replace('\x00', '')
         except UnicodeDecodeError:
-            raise BadDescriptorError('You seem to have opened a file with garbled bytes. you should open it using io.open(file, encoding="ascii", errors="ignore"')
+            raise BadDescriptorError(BAD_DESCRIPTOR_MSG)
 
-        self.descriptor.seek(0)
-        first_line = self.descriptor.readline()
         self.bs_col, self.ncol, self.ts_1st_col, self.ts_1st_row = detect_version_v2(first_line)
         self.descriptor.seek(0)
+        # the index holds byte offsets into the original file so it cannot be used on a copy
+        if self.descriptor is not descriptor:
+            self.breath_index = None
+        elif breath_index is not None:
+            self.breath_index = breath_index
+        else:
+            self.breath_index = find_breath_index(self.descriptor)
+        if self.breath_index is not None and not self.breath_index.matches_format(self.bs_col, self.ncol, self.ts_1st_col):
+            self.breath_index = None
+
+    @staticmethod
+    def _decode_line(line):
+        if isinstance(line, bytes):
+            line = line.decode('ascii')
+        return line
+
+    def _iter_line_chunks(self):
+        try:
+            while True:
+                lines = self.descriptor.readlines(LINE_CHUNK_SIZE)
+                if not lines:
+                    break
+                if isinstance(lines[0], bytes):
+                    lines = [self._decode_line(line) for line in lines]
+                # null bytes are never line separators, so they can be removed from each line of
+                # the chunks that have any, just as if they were filtered out of the stream
+                if '\x00' in ''.join(lines):
+                    lines = [line for line in (line.replace('\x00', '') for line in lines) if line]
+                yield lines
+        except UnicodeDecodeError:
+            raise BadDescriptorError(BAD_DESCRIPTOR_MSG)
+
+    @property
+    def abs_bs_time(self):
+        return epoch_us_to_datetime(self.abs_bs_us)
+
+    @property
+    def cur_abs_time(self):
+        if self.anchor_us is None:
+            return None
+        return epoch_us_to_datetime(self.anchor_us + self.ticks_since_anchor * self.dt_us)
 
     def get_data(self, flow, pressure):
+        if self.abs_bs_us is not None and self.format_timestamps:
+            abs_bs = OUT_FORMATTER.format(self.abs_bs_us)
+        else:
+            abs_bs = None
         return {
             "rel_bn": self.rel_bn,
             "vent_bn": self.vent_bn,
@@ -61,32 +204,29 @@ class VentilatorBase(object):
             "bs_time": round(self.rel_bs_time, 2),
             "frame_dur": round(len(flow) * self.dt, 2),
             "dt": self.dt,
-            'abs_bs': self.abs_bs_time.strftime(OUT_DATETIME_FORMAT) if self.abs_bs_time else None,
+            'abs_bs': abs_bs,
+            'abs_bs_us': self.abs_bs_us,
         }
 
     def set_rel_bs_time(self, last_t):
         self.rel_bs_time = self.rel_bs_time + last_t
 
     def try_parse_1st_col_ts(self, ts):
-        if len(ts) == 29:  # if extra 3 digits on end of microsecond
-            ts = ts[:-3]
-        try:
-            self.abs_bs_time = parser.parse(ts)
-        except:
-            self.abs_bs_time = datetime.strptime(ts, IN_DATETIME_FORMAT)
+        self.abs_bs_us = THREE_COL_TIMESTAMPS.to_epoch_us(ts)
 
     def set_abs_bs_time(self, row):
         if self.ts_1st_col:
             self.try_parse_1st_col_ts(row[0])
         else:
-            self.abs_bs_time = datetime.strptime(row[0], IN_DATETIME_FORMAT)
-        self.cur_abs_time = self.abs_bs_time
+            self.abs_bs_us = IN_TIMESTAMPS.to_epoch_us(row[0])
+        self.anchor_us = self.abs_bs_us
+        self.ticks_since_anchor = 0
 
     def set_abs_bs_time_if_bs(self, row):
         if self.ts_1st_col:
             self.try_parse_1st_col_ts(row[0])
-        elif self.abs_bs_time is not None:
-            self.abs_bs_time = self.cur_abs_time + timedelta(seconds=self.dt)
+        elif self.abs_bs_us is not None:
+            self.abs_bs_us = self.anchor_us + (self.ticks_since_anchor + 1) * self.dt_us
 
     def extract_raw(self,
                     skip_breaths_without_be,
@@ -112,39 +252,120 @@ class VentilatorBase(object):
         :param spec_rel_bns: The specific relative bns that we want eg: [1, 10, 20]
         :param spec_vent_bns: The specific vent bns that we want eg: [1, 10, 20]
         """
-        spec_rel_bns = sorted(spec_rel_bns)
-        spec_vent_bns = sorted(spec_vent_bns)
+        return list(self.iter_breaths(skip_breaths_without_be, rel_bn_interval, vent_bn_interval, spec_rel_bns, spec_vent_bns))
+
+    def extract_batch(self,
+                      skip_breaths_without_be,
+                      rel_bn_interval=[],
+                      vent_bn_interval=[],
+                      spec_rel_bns=[],
+                      spec_vent_bns=[],
+                      dtype=np.float64):
+        """
+        Columnar version of extract_raw. Takes the same arguments as extract_raw
+        and returns a BreathBatch holding the same breaths.
+
+        :param dtype: dtype to store flow and pressure as
+        """
+        return BreathBatch.from_breaths(
+            self.iter_breaths(skip_breaths_without_be, rel_bn_interval, vent_bn_interval, spec_rel_bns, spec_vent_bns),
+            dtype=dtype,
+        )
+
+    def iter_breaths(self,
+                     skip_breaths_without_be,
+                     rel_bn_interval=[],
+                     vent_bn_interval=[],
+                     spec_rel_bns=[],
+                     spec_vent_bns=[]):
+        """
+        Generator version of extract_raw. The descriptor is read line by line and
+        each breath is yielded as soon as its BE marker is seen, so memory stays
+        bounded by a single breath no matter how large the file is.
+
+        Takes the same arguments as extract_raw and yields breaths in the same format.
+        If a breath index is available and a subset of breaths is requested then only
+        the requested breaths are read from the file.
+        """
+        if self.breath_index is not None and (rel_bn_interval or vent_bn_interval or spec_rel_bns or spec_vent_bns):
+            for breath in self.iter_indexed_breaths(skip_breaths_without_be, rel_bn_interval, vent_bn_interval,
+                                                    spec_rel_bns, spec_vent_bns):
+                yield breath
+            return
+
+        state = self.start_parse(skip_breaths_without_be, rel_bn_interval, vent_bn_interval, spec_rel_bns, spec_vent_bns)
+        for lines in self._iter_line_chunks():
+            for breath in self.parse_lines(state, lines):
+                yield breath
+            if state.done:
+                return
+        for breath in self.finish_parse(state):
+            yield breath
+
+    def start_parse(self,
+                    skip_breaths_without_be,
+                    rel_bn_interval=[],
+                    vent_bn_interval=[],
+                    spec_rel_bns=[],
+                    spec_vent_bns=[]):
+        """
+        Start parsing breaths incrementally. Lines are pushed in with parse_lines
+        as they become available, and finish_parse is called once there are no
+        more lines. Takes the same arguments as extract_raw.
+
+        Parsing incrementally gives exactly the same breaths as iter_breaths, no
+        matter how the lines are split up between calls to parse_lines.
+        """
+        return ParseState(
+            self.dt, self.ticks_since_anchor, skip_breaths_without_be, rel_bn_interval,
+            vent_bn_interval, spec_rel_bns, spec_vent_bns
+        )
+
+    def parse_lines(self, state, lines):
+        """
+        Parse a list of complete lines. Returns a list of breaths that were completed.
+
+        :param state: ParseState from start_parse
+        :param lines: list of lines from the file
+        """
+        breaths = []
+        if state.done:
+            return breaths
+        skip_breaths_without_be = state.skip_breaths_without_be
+        rel_bn_interval, vent_bn_interval = state.rel_bn_interval, state.vent_bn_interval
+        spec_rel_bns, spec_vent_bns = state.spec_rel_bns, state.spec_vent_bns
         # this is a var used to keep track of time incase we dont see a datetime to update us
-        last_breath_time = self.dt
-        has_bs = False
-        date_search = re.compile("^2\d{3}-\d{2}-")
-        flow, pressure, data_list = [], [], []
-        vent_bn_regex = re.compile("S:(\d+)")
-        td = timedelta(seconds=self.dt)
+        last_breath_time = state.last_breath_time
+        has_bs = state.has_bs
+        flow, pressure = state.flow, state.pressure
+        # data rows seen since the last timestamp
+        ticks = state.ticks
 
-        for row in self.descriptor.readlines():
+        for row in lines:
             row = row.strip().split(',')
             try:
                 row[self.bs_col]
             except IndexError:
                 continue
 
-            if date_search.search(row[0]) and not self.ts_1st_col:
+            if DATE_SEARCH.search(row[0]) and not self.ts_1st_col:
                 self.set_abs_bs_time(row)
+                ticks = 0
                 continue
 
             if row[self.bs_col].strip() == "BS":
                 if not skip_breaths_without_be and has_bs:
                     if len(flow) > 0:
                         last_breath_time = self.dt * len(flow)
-                        data_list.append(self.get_data(flow, pressure))
+                        breaths.append(self.get_data(flow, pressure))
                 self.set_rel_bs_time(last_breath_time)
+                self.ticks_since_anchor = ticks
                 self.set_abs_bs_time_if_bs(row)
                 self.rel_bn += 1
                 has_bs = True
                 flow, pressure = [], []
                 try:
-                    match = vent_bn_regex.search(row[self.bs_col + 1])
+                    match = VENT_BN_REGEX.search(row[self.bs_col + 1])
                 except IndexError:
                     has_bs = False
                     continue
@@ -154,13 +375,17 @@ class VentilatorBase(object):
                     continue
                 self.vent_bn = int(match.groups()[0])
                 if rel_bn_interval and self.rel_bn > rel_bn_interval[1]:
-                    return data_list
+                    state.done = True
+                    break
                 elif vent_bn_interval and self.vent_bn > vent_bn_interval[1]:
-                    return data_list
+                    state.done = True
+                    break
                 elif spec_rel_bns and self.rel_bn > spec_rel_bns[-1]:
-                    return data_list
+                    state.done = True
+                    break
                 elif spec_vent_bns and self.vent_bn > spec_vent_bns[-1]:
-                    return data_list
+                    state.done = True
+                    break
                 elif vent_bn_interval and not (vent_bn_interval[0] <= self.vent_bn <= vent_bn_interval[1]):
                     has_bs = False
                 elif rel_bn_interval and not (rel_bn_interval[0] <= self.rel_bn <= rel_bn_interval[1]):
@@ -174,11 +399,10 @@ class VentilatorBase(object):
                 has_bs = False
                 if len(flow) > 0:
                     last_breath_time = self.dt * len(flow)
-                    data_list.append(self.get_data(flow, pressure))
+                    breaths.append(self.get_data(flow, pressure))
                     flow, pressure = [], []
             else:
-                if self.cur_abs_time is not None:
-                    self.cur_abs_time += td
+                ticks += 1
                 if not has_bs:
                     continue
                 try:
@@ -186,13 +410,102 @@ class VentilatorBase(object):
                     pressure.append(round(float(row[self.ncol - 1]), 2))
                 except (IndexError, ValueError):
                     continue
-        else:
-            if not skip_breaths_without_be:
-                if len(flow) > 0:
-                    last_breath_time = self.dt * len(flow)
-                    data_list.append(self.get_data(flow, pressure))
 
-        return data_list
+        state.last_breath_time = last_breath_time
+        state.has_bs = has_bs
+        state.flow, state.pressure = flow, pressure
+        state.ticks = ticks
+        return breaths
+
+    def finish_parse(self, state):
+        """
+        Signal that there are no more lines to parse. Returns a list holding the
+        last breath if it has no BE and breaths without BE are being kept.
+        """
+        breaths = []
+        if not state.done and not state.skip_breaths_without_be:
+            if len(state.flow) > 0:
+                breaths.append(self.get_data(state.flow, state.pressure))
+        state.done = True
+        return breaths
+
+    def iter_indexed_breaths(self,
+                             skip_breaths_without_be,
+                             rel_bn_interval=[],
+                             vent_bn_interval=[],
+                             spec_rel_bns=[],
+                             spec_vent_bns=[]):
+        """
+        Version of iter_breaths that uses self.breath_index to pick out the
+        breaths to output and then seeks straight to them. Output is the same
+        as iter_breaths.
+        """
+        breaths = self.breath_index.breaths
+        rel_bns, vent_bns = breaths['rel_bn'], breaths['vent_bn']
+        has_vent_bn = vent_bns >= 0
+        # iter_breaths stops reading as soon as it passes the requested range
+        past_end = np.zeros(len(breaths), dtype=bool)
+        if rel_bn_interval:
+            past_end |= rel_bns > rel_bn_interval[1]
+        if vent_bn_interval:
+            past_end |= vent_bns > vent_bn_interval[1]
+        if spec_rel_bns:
+            past_end |= rel_bns > max(spec_rel_bns)
+        if spec_vent_bns:
+            past_end |= vent_bns > max(spec_vent_bns)
+        past_end &= has_vent_bn
+        stop = np.argmax(past_end) if past_end.any() else len(breaths)
+
+        wanted = has_vent_bn.copy()
+        if vent_bn_interval:
+            wanted &= (vent_bns >= vent_bn_interval[0]) & (vent_bns <= vent_bn_interval[1])
+        if rel_bn_interval:
+            wanted &= (rel_bns >= rel_bn_interval[0]) & (rel_bns <= rel_bn_interval[1])
+        if spec_rel_bns:
+            wanted &= np.isin(rel_bns, spec_rel_bns)
+        if spec_vent_bns:
+            wanted &= np.isin(vent_bns, spec_vent_bns)
+        wanted &= breaths['n_obs'] > 0
+        if skip_breaths_without_be:
+            wanted &= breaths['be_end'] >= 0
+        wanted[stop:] = False
+
+        n_obs = breaths['n_obs'].tolist()
+        abs_bs_us = self.breath_index.abs_bs_us(self.dt_us)
+        # bs_time is accumulated with exactly the same float additions iter_breaths makes
+        last_breath_time = self.dt
+        n_added = 0
+        for idx in np.flatnonzero(wanted).tolist():
+            while n_added <= idx:
+                self.set_rel_bs_time(last_breath_time)
+                n_added += 1
+            self.rel_bn = int(rel_bns[idx])
+            self.vent_bn = int(vent_bns[idx])
+            self.abs_bs_us = abs_bs_us[idx]
+            text = read_span(self.descriptor, breaths['data_offset'][idx], breaths['data_end'][idx])
+            flow, pressure = self.parse_breath_lines(text.split('\n'))
+            last_breath_time = self.dt * n_obs[idx]
+            yield self.get_data(flow, pressure)
+
+    def parse_breath_lines(self, lines):
+        """
+        Parse the data rows found between a breath's BS and BE markers
+        """
+        flow, pressure = [], []
+        for row in lines:
+            row = row.strip().split(',')
+            try:
+                row[self.bs_col]
+            except IndexError:
+                continue
+            if DATE_SEARCH.search(row[0]) and not self.ts_1st_col:
+                continue
+            try:
+                flow.append(round(float(row[self.ncol - 2]), 2))
+                pressure.append(round(float(row[self.ncol - 1]), 2))
+            except (IndexError, ValueError):
+                continue
+        return flow, pressure
 
 
 class PB840File(VentilatorBase):
@@ -352,145 +665,121 @@ def process_breath_file(descriptor,
                         rel_bn_interval=[],
                         vent_bn_interval=[],
                         spec_rel_bns=[],
-                        spec_vent_bns=[]):
+                        spec_vent_bns=[],
+                        encode=False,
+                        compress=False):
     """
     Performs similar action to extract_raw but also requires an output filename to be
     designated. This filename will serve as storage for two files to be output. First
     a file of all the raw data from a file in simple linear format. Second a file with
     some basic metadata information of the breath including how to access it in the procesed
     file
+
+    Set encode=True to store the raw data in the compact <output_filename>.raw.npz format
+    instead, and compress=True to also zlib compress it. See ventmap.processed_file
     """
     generator = extract_raw(descriptor, ignore_missing_bes, rel_bn_interval, vent_bn_interval, spec_rel_bns, spec_vent_bns)
     cur_idx = 0
-    raw_filename = output_filename + '.raw.npy'
-    proc_filename = output_filename + '.processed.npy'
     # for raw it will be structured as flow,pressure
-    # for processed it will be structured as 'rel_bn', 'vent_bn', 'abs_bs', 'bs_time', 'frame_dur', 'dt', 'start_idx', 'end_idx'
+    # for processed see ventmap.processed_file.PROCESSED_DTYPE
     flow = []
     pressure = []
     processed_rows = []
     for breath in generator:
-        timestamp = breath['abs_bs']
-        processed_row = [breath['rel_bn'], breath['vent_bn'], timestamp, breath['bs_time'], breath['frame_dur'], breath['dt'], cur_idx]
+        timestamp = breath['abs_bs_us'] if breath['abs_bs_us'] is not None else NO_TIMESTAMP
+        start_idx = cur_idx
         for i, val in enumerate(breath['flow']):
             flow.append(breath['flow'][i])
             pressure.append(breath['pressure'][i])
             cur_idx += 1
-        processed_row.append(cur_idx)
-        processed_rows.append(processed_row)
-    np.save(proc_filename, processed_rows)
-    np.save(raw_filename, np.array([flow, pressure]).transpose())
+        processed_rows.append((
+            breath['rel_bn'], breath['vent_bn'], timestamp, breath['bs_time'], breath['frame_dur'], breath['dt'], start_idx, cur_idx
+        ))
+    write_processed(output_filename, np.array(processed_rows, dtype=PROCESSED_DTYPE), flow, pressure, encode, compress)
 
 
 def read_processed_file(raw_file, processed_file=None):
     """
     After a file has been processed into its constituent parts, this function will then
-    re-read it and output it in similar format to extract_raw
+    re-read it and output it in similar format to extract_raw. Files written by older
+    versions of ventmap can be read as well. Use ventmap.processed_file.ProcessedFile
+    for random access to breaths and zero copy flow/pressure arrays.
 
-    :param raw_file: filename for the raw numpy pickled file. Should have a file prefix of '.raw.npy'
+    :param raw_file: filename for the raw numpy file. Should have a file suffix of '.raw.npy'
     :param processed_file: stale argument around for backwards compatibility sake
     """
-    raw = np.load(raw_file, allow_pickle=True)
-    processed = np.load(raw_file.replace('.raw.npy', '.processed.npy'), allow_pickle=True)
-    for breath_info in processed:
-        # for processed it will be structured as 'rel_bn', 'vent_bn', 'abs_bs', 'bs_time', 'frame_dur', 'dt', 'start_idx', 'end_idx'
-        end_idx = int(breath_info[-1])
-        start_idx = int(breath_info[-2])
-        raw_breath_data = raw[start_idx:end_idx]
-        dt = float(breath_info[-3])
-        bs_time = float(breath_info[3])
-        abs_bs = breath_info[2]
-        # The output here is slightly different because we are just simplifying keys
-        yield {
-            "rel_bn": int(breath_info[0]),
-            "vent_bn": int(breath_info[1]),
-            "flow": list(raw_breath_data[:,0]),
-            "pressure": list(raw_breath_data[:,1]),
-            "abs_bs": abs_bs,
-            "bs_time": bs_time,
-            "frame_dur": float(breath_info[-4]),
-            "dt": dt,
-        }
+    for breath in ProcessedFile(raw_file, as_lists=True):
+        yield breath
 
 
-def consolidate_files(paths, ignore_missing_bes, output_dir, to_npy=True, to_csv=False):
+def consolidate_files(paths, ignore_missing_bes, output_dir, to_npy=True, to_csv=False, encode=False, compress=False):
     """
-    Consolidate a number of previously separate files together.
+    Consolidate a number of previously separate files together. Breaths are
+    written out as they are read, so memory use does not grow with the number
+    or size of files consolidated.
 
     :param paths: Can be a list of strs of pathlib.Path objects
     :param ignore_missing_bes: Should we not care if BE marker exists?
     :param output_dir: output directory to place new file(s). can be str or pathlib.Path obj
     :param to_npy: (bool) create npy processed output
     :param to_csv: (bool) create csv output for file in traditional format
+    :param encode: (bool) store npy raw data in the compact .raw.npz format
+    :param compress: (bool) zlib compress encoded raw data
     """
 
     paths = sorted(paths)
-    flow = []
-    pressure = []
-    processed_rows = []
-
-    # absolute idx for new file
-    abs_idx = 0
-    rel_bn = 1
-    bs_time = 0.02
-    prior_ts = None
-    for path in paths:
-        descriptor = io.open(str(path), errors='ignore', encoding='ascii')
-        generator = extract_raw(descriptor, ignore_missing_bes)
-        # relative idx for currently iterated file
-        for breath in generator:
-            # sanity check. If somehow the breath is malformed
-            if len(breath['flow']) != len(breath['pressure']):
-                continue
-
-            # bs_time is a bit unknown here. I can do my best with it using abs
-            # timestamps tho. The downside is that this method will error out if
-            # no timestamps are present.
-            timestamp = breath['abs_bs']
-            if prior_ts is not None:
-                bs_delta = (datetime.strptime(timestamp, OUT_DATETIME_FORMAT) - datetime.strptime(prior_ts, OUT_DATETIME_FORMAT))
-                bs_time += round(bs_delta.total_seconds(), 2)
-            processed_row = [
-                rel_bn, breath['vent_bn'], timestamp, bs_time,
-                breath['frame_dur'], breath['dt'], abs_idx
-            ]
-
-            for i, val in enumerate(breath['flow']):
-                flow.append(val)
-                pressure.append(breath['pressure'][i])
-                abs_idx += 1
-            processed_row.append(abs_idx)
-            processed_rows.append(processed_row)
-            rel_bn += 1
-            prior_ts = timestamp
-
-    output_filename = str(paths[0]).replace('.csv', '')
-
-    if to_csv:
-        output_buf = []
-        for breath_info in processed_rows:
-            rel_bn = int(breath_info[0])
-            vent_bn = int(breath_info[1])
-            end_idx = int(breath_info[-1])
-            start_idx = int(breath_info[-2])
-            flow_data = flow[start_idx:end_idx]
-            pressure_data = pressure[start_idx:end_idx]
-            abs_bs = datetime.strptime(breath_info[2], OUT_DATETIME_FORMAT).strftime(IN_DATETIME_FORMAT)
-            bs_line = ['BS', ' S:{}'.format(vent_bn), '']
-            be_line = ['BE']
-            output_buf.append([abs_bs])
-            output_buf.append(bs_line)
-            for i, val in enumerate(flow_data):
-                output_buf.append([round(val, 2), round(pressure_data[i], 2)])
-            output_buf.append(be_line)
-
-        output_path = str(Path(output_dir).joinpath(Path(output_filename+'.csv').name))
-        with open(output_path, 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows(output_buf)
-
+    output_filename = strip_compressed_suffix(paths[0]).replace('.csv', '')
+    npy_writer = None
+    csv_file = None
     if to_npy:
-        raw_filename = Path(output_filename + '.raw.npy').name
-        proc_filename = Path(output_filename + '.processed.npy').name
-        np.save(str(Path(output_dir).joinpath(proc_filename)), processed_rows)
-        np.save(str(Path(output_dir).joinpath(raw_filename)), np.array([flow, pressure]).transpose())
+        npy_writer = ProcessedWriter(str(Path(output_dir).joinpath(Path(output_filename).name)), encode=encode, compress=compress)
+    if to_csv:
+        # written to a temporary file in case the output overwrites one of the inputs
+        csv_path = str(Path(output_dir).joinpath(Path(output_filename+'.csv').name))
+        csv_file = open(csv_path + '.tmp', 'w')
+        writer = csv.writer(csv_file)
+
+    try:
+        rel_bn = 1
+        bs_time = 0.02
+        prior_us = None
+        for path in paths:
+            with open_vent_file(path) as descriptor:
+                for breath in PB840File(descriptor).iter_breaths(ignore_missing_bes):
+                    # sanity check. If somehow the breath is malformed
+                    if len(breath['flow']) != len(breath['pressure']):
+                        continue
+
+                    # bs_time is a bit unknown here. I can do my best with it using abs
+                    # timestamps tho. The downside is that this method will error out if
+                    # no timestamps are present.
+                    if prior_us is not None:
+                        bs_time += round((breath['abs_bs_us'] - prior_us) / 1e6, 2)
+
+                    if npy_writer is not None:
+                        npy_writer.add_breath(
+                            rel_bn, breath['vent_bn'], breath['abs_bs_us'], bs_time,
+                            breath['frame_dur'], breath['dt'], breath['flow'], breath['pressure']
+                        )
+                    if csv_file is not None:
+                        writer.writerow([IN_FORMATTER.format(breath['abs_bs_us'])])
+                        writer.writerow(['BS', ' S:{}'.format(breath['vent_bn']), ''])
+                        writer.writerows(
+                            [round(flow, 2), round(pressure, 2)] for flow, pressure in zip(breath['flow'], breath['pressure'])
+                        )
+                        writer.writerow(['BE'])
+                    rel_bn += 1
+                    prior_us = breath['abs_bs_us']
+    except BaseException:
+        if npy_writer is not None:
+            npy_writer.abort()
+        if csv_file is not None:
+            csv_file.close()
+            os.remove(csv_path + '.tmp')
+        raise
+
+    if npy_writer is not None:
+        npy_writer.close()
+    if csv_file is not None:
+        csv_file.close()
+        os.replace(csv_path + '.tmp', csv_path)
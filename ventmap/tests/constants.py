@@ -33,3 +33,5 @@ PT0149_SUBDIR = join(dirname(__file__), "samples", "0149")
 PT0149_BREATH_META = join(PT0149_SUBDIR, "0149_2016-02-17-08-38-13_1_v5_1_0__breath_meta.csv_test")
 PT0149_BREATH_META_200TO300 = join(dirname(__file__), "samples", "0149_2016-02-17-08-38-13_1_v5_1_0__breath_meta.csv_test")
 FAILING_ABS_BS = join(dirname(__file__), "samples", "failing_abs_bs_data.csv.test")
+EXTRACT_RAW_BASELINE = NO_BOILERPLATE('extract_raw_baseline.json')
+PT0017_CSV = NO_BOILERPLATE('0017_02_55_40_1to1000.csv_test')
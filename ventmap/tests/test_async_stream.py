@@ -0,0 +1,79 @@
+import asyncio
+from io import open
+
+from nose.tools import eq_
+
+from ventmap.async_stream import chunk_breaths, stream_breaths
+from ventmap.raw_utils import PB840File
+from ventmap.tests.constants import *
+
+open_func = lambda f: open(f, encoding='ascii', errors='ignore')
+
+
+async def collect(breaths):
+    return [breath async for breath in breaths]
+
+
+async def replay_server(filename, chunk_size):
+    """
+    Stand in for a ventilator gateway. Replays a file to every client in small chunks
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    async def replay(reader, writer):
+        for i in range(0, len(data), chunk_size):
+            writer.write(data[i:i + chunk_size])
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(replay, '127.0.0.1', 0)
+
+
+def test_stream_breaths():
+    async def run(filename):
+        server = await replay_server(filename, 517)
+        port = server.sockets[0].getsockname()[1]
+
+        async def client(skip):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            breaths = await collect(stream_breaths(reader, skip, read_size=1024))
+            writer.close()
+            return breaths
+
+        try:
+            return await asyncio.gather(*[client(i % 2 == 0) for i in range(6)])
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    for filename in [RAW_UTILS_TEST2, RAW_UTILS_3_COLUMNS_TEST, BE_NOT_AT_END]:
+        results = asyncio.run(run(filename))
+        for i, breaths in enumerate(results):
+            eq_(breaths, PB840File(open_func(filename)).extract_raw(i % 2 == 0))
+
+
+def test_chunk_breaths():
+    with open(WITH_TIMESTAMP, 'rb') as f:
+        data = f.read()
+    chunks = [data[i:i + 100] for i in range(0, len(data), 100)]
+
+    async def async_chunks():
+        for chunk in chunks:
+            yield chunk
+
+    expected = PB840File(open_func(WITH_TIMESTAMP)).extract_raw(False)
+    eq_(asyncio.run(collect(chunk_breaths(chunks))), expected)
+    eq_(asyncio.run(collect(chunk_breaths(async_chunks()))), expected)
+    expected = PB840File(open_func(WITH_TIMESTAMP)).extract_raw(False, rel_bn_interval=[2, 4])
+    eq_(asyncio.run(collect(chunk_breaths(async_chunks(), rel_bn_interval=[2, 4]))), expected)
+
+
+def test_chunk_breaths_ignores_non_ascii():
+    with open(WITH_TIMESTAMP, 'rb') as f:
+        data = f.read()
+    # a stray byte in the middle of a line, and one at the edge of a chunk
+    data = data[:150] + b'\xff' + data[150:299] + b'\xff' + data[299:]
+    chunks = [data[i:i + 100] for i in range(0, len(data), 100)]
+    expected = PB840File(open_func(WITH_TIMESTAMP)).extract_raw(False)
+    eq_(asyncio.run(collect(chunk_breaths(chunks))), expected)
@@ -0,0 +1,58 @@
+from io import open
+import math
+
+from nose.tools import eq_
+import numpy as np
+from scipy.integrate import simps
+
+from ventmap.batch_meta import get_batch_breath_meta, segment_simpson
+from ventmap.breath_meta import get_file_breath_meta
+from ventmap.constants import META_HEADER
+from ventmap.raw_utils import HundredHzFile, PB840File
+from ventmap.tests.constants import *
+
+open_func = lambda f: open(f, encoding='ascii', errors='ignore')
+
+
+def assert_meta_close(expected, result):
+    eq_(expected[0], result[0])
+    eq_(len(expected), len(result))
+    for expected_row, row in zip(expected[1:], result[1:]):
+        for name, a, b in zip(META_HEADER, expected_row, row):
+            if isinstance(a, str):
+                eq_(a, b, name)
+            elif math.isnan(a):
+                assert math.isnan(b), name
+            else:
+                assert abs(a - b) <= 1e-9 * max(1, abs(a)), (name, a, b)
+
+
+def test_segment_simpson():
+    y = np.random.RandomState(0).normal(size=100)
+    starts = np.array([0, 3, 10, 10, 20, 50, 60, 99, 99])
+    lengths = np.array([3, 6, 0, 1, 2, 9, 40, 1, 0])
+    result = segment_simpson(y, starts, lengths, 0.02)
+    expected = [simps(y[s:s + n].tolist(), dx=0.02) if n else 0 for s, n in zip(starts, lengths)]
+    np.testing.assert_allclose(result, expected, rtol=1e-12, atol=1e-15)
+
+
+def test_batch_meta_matches_breath_meta():
+    for filename in [BREATH_META1, WITH_TIMESTAMP, PT0149_CSV, MALFORMED_BREATH]:
+        for skip in [True, False]:
+            batch = PB840File(open_func(filename)).extract_batch(skip)
+            assert_meta_close(get_file_breath_meta(batch), get_batch_breath_meta(batch))
+    batch = HundredHzFile(open_func(ARDS_AND_COPD)).extract_batch(True)
+    assert_meta_close(get_file_breath_meta(batch), get_batch_breath_meta(batch))
+
+
+def test_vectorized_file_breath_meta():
+    expected = get_file_breath_meta(PT0149_CSV, rel_bn_interval=[200, 249])
+    assert_meta_close(expected, get_file_breath_meta(PT0149_CSV, rel_bn_interval=[200, 249], vectorized=True))
+    df = get_file_breath_meta(open_func(WITH_TIMESTAMP), vectorized=True, to_data_frame=True)
+    eq_(list(df.columns), META_HEADER)
+    eq_(len(df), len(PB840File(open_func(WITH_TIMESTAMP)).extract_raw(True)))
+
+
+def test_batch_meta_threads():
+    batch = PB840File(open_func(PT0149_CSV)).extract_batch(True)
+    eq_(get_batch_breath_meta(batch, n_jobs=3), get_batch_breath_meta(batch))
@@ -0,0 +1,68 @@
+from io import open
+import os
+import tempfile
+
+from nose.tools import eq_
+import numpy as np
+
+from ventmap.breath_batch import BreathBatch
+from ventmap.breath_meta import get_file_breath_meta
+from ventmap.bulk_parser import BulkPB840File
+from ventmap.raw_utils import PB840File, process_breath_file, read_processed_file
+from ventmap.tests.constants import *
+
+open_func = lambda f: open(f, encoding='ascii', errors='ignore')
+
+
+def test_batch_matches_extract_raw():
+    for filename in [RAW_UTILS_TEST, RAW_UTILS_3_COLUMNS_TEST, WITH_TIMESTAMP, MALFORMED_BREATH]:
+        for skip in [True, False]:
+            breaths = PB840File(open_func(filename)).extract_raw(skip)
+            for cls in [PB840File, BulkPB840File]:
+                batch = cls(open_func(filename)).extract_batch(skip)
+                eq_(len(batch), len(breaths))
+                eq_(batch.to_breaths(), breaths)
+
+
+def test_batch_views():
+    batch = PB840File(open_func(RAW_UTILS_TEST)).extract_batch(False)
+    eq_(batch.offsets[-1], len(batch.flow))
+    eq_(batch.lengths.tolist(), [len(batch.flow_of(i)) for i in range(len(batch))])
+    breath = batch[3]
+    # breaths are views into the batch arrays instead of copies
+    assert np.shares_memory(breath['flow'], batch.flow)
+    assert np.shares_memory(breath['pressure'], batch.pressure)
+    eq_(breath['flow'].tolist(), batch.to_breaths()[3]['flow'])
+    eq_(batch[-1]['rel_bn'], batch.rel_bn[-1])
+
+
+def test_batch_slice():
+    batch = PB840File(open_func(MALFORMED_BREATH)).extract_batch(False)
+    breaths = batch.to_breaths()
+    for start, stop in [(0, len(batch)), (1, 3), (2, 2), (-2, None)]:
+        eq_(batch.slice(start, stop).to_breaths(), breaths[start:stop])
+
+
+def test_batch_float32():
+    batch = BulkPB840File(open_func(RAW_UTILS_TEST)).extract_batch(False, dtype=np.float32)
+    eq_(batch.flow.dtype, np.float32)
+    eq_(batch.pressure.dtype, np.float32)
+
+
+def test_batch_processed_file_round_trip():
+    breaths = PB840File(open_func(RAW_UTILS_TEST)).extract_raw(False)
+    batch = BreathBatch.from_breaths(breaths)
+    tmpdir = tempfile.mkdtemp()
+    batch.save(os.path.join(tmpdir, 'batch'))
+    process_breath_file(open_func(RAW_UTILS_TEST), False, os.path.join(tmpdir, 'orig'))
+    eq_(
+        str(list(read_processed_file(os.path.join(tmpdir, 'batch.raw.npy')))),
+        str(list(read_processed_file(os.path.join(tmpdir, 'orig.raw.npy')))),
+    )
+    loaded = BreathBatch.from_processed_file(os.path.join(tmpdir, 'orig.raw.npy'))
+    eq_(loaded.to_breaths(), breaths)
+
+
+def test_batch_breath_meta():
+    batch = PB840File(open_func(RAW_UTILS_TEST)).extract_batch(True)
+    eq_(get_file_breath_meta(batch), get_file_breath_meta(open_func(RAW_UTILS_TEST)))
@@ -0,0 +1,54 @@
+from io import open
+
+from nose.tools import assert_raises, eq_
+import numpy as np
+import pandas as pd
+
+from ventmap.breath_features import BreathFeatures
+from ventmap.breath_meta import (
+    get_breath_meta_features, get_experimental_breath_meta, get_file_breath_meta_features,
+    get_file_experimental_breath_meta
+)
+from ventmap.constants import EXPERIMENTAL_META_HEADER
+from ventmap.raw_utils import extract_raw
+from ventmap.tests.constants import *
+
+FEATURES = ['dyn_compliance', 'tvi', 'x0_index', 'abs_time_at_x0', 'pressure_itime_by_pip5', 'tve2']
+
+
+def test_features_match_experimental_meta():
+    for breath in extract_raw(open(WITH_TIMESTAMP), False):
+        expected = pd.Series(get_experimental_breath_meta(breath), index=EXPERIMENTAL_META_HEADER)
+        pd.testing.assert_series_equal(expected[FEATURES], get_breath_meta_features(breath, FEATURES, to_series=True))
+
+
+def test_only_dependencies_computed():
+    breath = extract_raw(open(BREATH_META1), False)[0]
+    features = BreathFeatures(breath)
+    features.get(['dyn_compliance'])
+    eq_(sorted(features.values), sorted([
+        'ePressure', 'iFlow', 'iPressure', 'PEEP', 'PIP', 'dyn_compliance', 'rel_time_array', 'tvi',
+        'x0', 'x0_index', 'x0_indices',
+    ]))
+    features = BreathFeatures(breath)
+    features.get(['maxF', 'inst_RR'])
+    eq_(sorted(features.values), ['inst_RR', 'maxF'])
+
+
+def test_unknown_feature():
+    breath = extract_raw(open(BREATH_META1), False)[0]
+    assert_raises(ValueError, get_breath_meta_features, breath, ['tvi', 'tvi3'])
+    # intermediate values are not columns
+    assert_raises(ValueError, get_file_breath_meta_features, BREATH_META1, ['x0'])
+
+
+def test_file_breath_meta_features():
+    expected = get_file_experimental_breath_meta(PT0149_CSV, rel_bn_interval=[200, 249], to_data_frame=True)
+    for n_jobs in [1, 2]:
+        df = get_file_breath_meta_features(
+            PT0149_CSV, FEATURES, rel_bn_interval=[200, 249], to_data_frame=True, n_jobs=n_jobs
+        )
+        pd.testing.assert_frame_equal(expected[FEATURES], df)
+    array = get_file_breath_meta_features(PT0149_CSV, ['tvi', 'tve'], rel_bn_interval=[200, 249])
+    eq_(array[0], ['tvi', 'tve'])
+    np.testing.assert_array_equal(expected[['tvi', 'tve']].values, array[1:])
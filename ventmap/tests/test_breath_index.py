@@ -0,0 +1,119 @@
+from io import open
+import os
+import shutil
+import sys
+import tempfile
+
+from nose.tools import assert_dict_equal, eq_
+
+from ventmap.breath_index import build_breath_index, index_path_for, load_breath_index
+from ventmap import cut_breath_section as cut_module
+from ventmap.cut_breath_section import cut_breath_section, cut_breath_section_wrapper
+from ventmap.raw_utils import PB840File
+from ventmap.tests.constants import *
+
+open_func = lambda f: open(f, encoding='ascii', errors='ignore')
+
+
+def copy_to_tmp(filename):
+    path = os.path.join(tempfile.mkdtemp(), os.path.basename(filename))
+    shutil.copy(filename, path)
+    return path
+
+
+def sequential_extract(path, skip, **kwargs):
+    pb840 = PB840File(open_func(path))
+    pb840.breath_index = None
+    return pb840.extract_raw(skip, **kwargs)
+
+
+def test_indexed_extract_matches_sequential():
+    for filename in [RAW_UTILS_TEST, RAW_UTILS_TEST2, RAW_UTILS_3_COLUMNS_TEST, BE_NOT_AT_END]:
+        path = copy_to_tmp(filename)
+        index = build_breath_index(path)
+        vent_bns = [bn for bn in index.breaths['vent_bn'].tolist() if bn >= 0]
+        for kwargs in [
+            dict(rel_bn_interval=[3, 7]),
+            dict(vent_bn_interval=[vent_bns[2], vent_bns[4]]),
+            dict(spec_rel_bns=[2, 5, len(index)]),
+            dict(spec_vent_bns=[vent_bns[1], vent_bns[-1]]),
+        ]:
+            for skip in [True, False]:
+                pb840 = PB840File(open_func(path))
+                assert pb840.breath_index is not None
+                indexed = pb840.extract_raw(skip, **kwargs)
+                orig = sequential_extract(path, skip, **kwargs)
+                eq_(len(orig), len(indexed))
+                for b, b_match in zip(orig, indexed):
+                    assert_dict_equal(b, b_match)
+
+
+def test_indexed_extract_ignores_non_ascii():
+    path = copy_to_tmp(RAW_UTILS_TEST2)
+    with open(path, 'rb') as f:
+        data = f.read()
+    # stray bytes in data rows and next to markers, in several chunks of the scan
+    for pos in sorted([100, 5000, data.find(b'BS', 20000), data.find(b'BE', 60000) + 2, 250000, 400000], reverse=True):
+        data = data[:pos] + b'\xe9\xff' + data[pos:]
+    with open(path, 'wb') as f:
+        f.write(data)
+    index = build_breath_index(path, chunk_size=2 ** 16)
+    eq_(len(index), len(build_breath_index(RAW_UTILS_TEST2, save=False)))
+    for kwargs in [dict(rel_bn_interval=[3, 7]), dict(rel_bn_interval=[len(index) - 10, len(index)])]:
+        for skip in [True, False]:
+            pb840 = PB840File(open_func(path))
+            assert pb840.breath_index is not None
+            indexed = pb840.extract_raw(skip, **kwargs)
+            orig = sequential_extract(path, skip, **kwargs)
+            eq_(len(orig), len(indexed))
+            for b, b_match in zip(orig, indexed):
+                assert_dict_equal(b, b_match)
+
+
+def test_stale_index_is_ignored():
+    path = copy_to_tmp(RAW_UTILS_TEST)
+    build_breath_index(path)
+    assert os.path.exists(index_path_for(path))
+    assert load_breath_index(path) is not None
+    with open(path, 'a') as f:
+        f.write(u'1.0, 2.0\n')
+    assert load_breath_index(path) is None
+    assert PB840File(open_func(path)).breath_index is None
+
+
+def test_indexed_cut_breath_section():
+    path = copy_to_tmp(RAW_UTILS_TEST)
+    index = build_breath_index(path, save=False)
+    indexed = cut_breath_section(open_func(path), 2, 5, '2018-10-17-13-15-45.844796', breath_index=index).read()
+    orig = cut_breath_section(open_func(path), 2, 5, '2018-10-17-13-15-45.844796').read()
+    eq_(indexed, orig)
+    breaths = PB840File(open_func(path)).extract_raw(True, rel_bn_interval=[2, 5])
+    eq_(len(sequential_extract(path, True, rel_bn_interval=[2, 5])), len(breaths))
+
+
+def test_cut_breath_section_cli_uses_index():
+    calls = []
+    cut_indexed_section = cut_module._cut_indexed_section
+
+    def record_indexed_cut(*args):
+        calls.append(args)
+        return cut_indexed_section(*args)
+
+    path = copy_to_tmp(RAW_UTILS_TEST)
+    unindexed_out = os.path.join(tempfile.mkdtemp(), 'unindexed.csv')
+    cut_breath_section_wrapper(path, unindexed_out, 2, 5)
+    build_breath_index(path)
+    out = os.path.join(tempfile.mkdtemp(), 'out.csv')
+    old_argv = sys.argv
+    cut_module._cut_indexed_section = record_indexed_cut
+    sys.argv = ['cut_breath_section', path, '-s', '2', '-e', '5', '-o', out]
+    try:
+        cut_module.main()
+        eq_(len(calls), 1)
+        cut_breath_section_wrapper(path, out + '.wrapper', 2, 5)
+        eq_(len(calls), 2)
+    finally:
+        cut_module._cut_indexed_section = cut_indexed_section
+        sys.argv = old_argv
+    for filename in [out, out + '.wrapper']:
+        eq_(open(filename).read(), open(unindexed_out).read())
@@ -87,3 +87,12 @@ class TestBreathMeta(object):
             bm_orig = get_production_breath_meta(breath)
             bm_new = get_production_breath_meta(gen_processed[i])
             assert_list_equal(bm_orig, bm_new)
+
+    def test_n_jobs_keeps_order(self):
+        expected = get_file_breath_meta(PT0149_CSV)
+        eq_(get_file_breath_meta(PT0149_CSV, n_jobs=2), expected)
+        breaths = extract_raw(open(PT0149_CSV), True)
+        eq_(get_file_breath_meta(breaths, n_jobs=2), expected)
+        expected = get_file_experimental_breath_meta(open(BREATH_META1), to_data_frame=True)
+        result = get_file_experimental_breath_meta(open(BREATH_META1), to_data_frame=True, n_jobs=2)
+        assert_dfs_equal(expected, result)
@@ -0,0 +1,71 @@
+from datetime import datetime
+from glob import glob
+from io import open
+import os
+import tempfile
+
+from nose import SkipTest
+from nose.tools import eq_
+
+from ventmap import breath_store
+from ventmap.raw_utils import extract_raw
+from ventmap.tests.constants import *
+from ventmap.timestamps import datetime_to_epoch_us
+
+open_func = lambda f: open(f, encoding='ascii', errors='ignore')
+
+
+def setup_module():
+    if breath_store.pa is None:
+        raise SkipTest('pyarrow is not installed')
+
+
+def make_store():
+    root = tempfile.mkdtemp()
+    breath_store.store_breath_file(root, '0149', PT0149_CSV, row_group_size=50)
+    breath_store.store_breath_file(root, '0149', RAW_UTILS_TEST2, row_group_size=50)
+    breath_store.store_breath_file(root, '0201', WITH_TIMESTAMP, row_group_size=50)
+    return root
+
+
+def strip_store_fields(breaths):
+    for breath in breaths:
+        del breath['patient']
+        del breath['source']
+    return breaths
+
+
+def test_store_round_trip():
+    root = make_store()
+    breaths = list(breath_store.iter_store_breaths(root, sources=[breath_store.source_name(PT0149_CSV)]))
+    eq_(strip_store_fields(breaths), extract_raw(open_func(PT0149_CSV), False))
+    eq_(len(glob(os.path.join(root, 'patient=0149', 'date=*', '*.parquet'))), 2)
+    eq_(glob(os.path.join(root, '*', '*', '.*')), [])
+
+
+def test_store_filters():
+    root = make_store()
+    expected = extract_raw(open_func(PT0149_CSV), False)
+    start, end = expected[10]['abs_bs_us'], expected[40]['abs_bs_us']
+    breaths = list(breath_store.iter_store_breaths(root, patients=['0149'], start=start, end=end))
+    eq_(strip_store_fields(breaths), expected[10:41])
+    # datetimes work as well as microseconds
+    start_dt = datetime.strptime(expected[10]['abs_bs'], '%Y-%m-%d %H-%M-%S.%f')
+    eq_(datetime_to_epoch_us(start_dt), start)
+    eq_(len(breath_store.read_store(root, patients=['0149'], start=start_dt, end=end)), 31)
+
+    table = breath_store.read_store(
+        root, columns=['vent_bn'], sources=[breath_store.source_name(PT0149_CSV)], rel_bn_interval=[5, 9]
+    )
+    eq_(table.column('vent_bn').to_pylist(), [b['vent_bn'] for b in expected[4:9]])
+    vent_bns = [expected[3]['vent_bn'], expected[6]['vent_bn']]
+    breaths = list(breath_store.iter_store_breaths(root, patients=['0149'], vent_bn_interval=vent_bns))
+    eq_(strip_store_fields(breaths), expected[3:7])
+    eq_(len(breath_store.read_store(root, patients=['0201'])), len(extract_raw(open_func(WITH_TIMESTAMP), False)))
+
+
+def test_store_replaces_source():
+    root = make_store()
+    n_breaths = len(breath_store.read_store(root))
+    breath_store.store_breath_file(root, '0149', PT0149_CSV)
+    eq_(len(breath_store.read_store(root)), n_breaths)
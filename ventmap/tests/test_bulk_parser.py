@@ -0,0 +1,155 @@
+from io import open
+import os
+import tempfile
+
+from nose.tools import assert_dict_equal, eq_
+import numpy as np
+
+from ventmap.bulk_parser import (
+    BS, BulkHundredHzFile, BulkPB840File, parallel_extract, round_samples, scan_chunks, shared_samples,
+    split_on_breaths,
+)
+from ventmap.raw_utils import HundredHzFile, PB840File
+from ventmap.tests.constants import *
+
+open_func = lambda f: open(f, encoding='ascii', errors='ignore')
+CONFORMANCE_FILES = [
+    ARDS_AND_COPD, BE_NOT_AT_END, FAILING_ABS_BS, JIMMY_TEST, MALFORMED_BREATH, PT0149_CSV, RAW_UTILS_TEST,
+    RAW_UTILS_TEST2, RAW_UTILS_3_COLUMNS_TEST, REAL_TIME_TEST, SPEEDUP_BAD_ROW_ERROR_CASE,
+    SPEEDUP_EXTRA_COLS_ERROR_CASE, SPEEDUP_MULTI_BAD_FIRST_LINES_ERROR_CASE, SPEEDUP_NULL_COLS_ERROR_CASE,
+    SPEEDUP_EMPTY_FILE_ERROR_CASE, WITH_TIMESTAMP,
+]
+
+
+def assert_same_breaths(orig, new):
+    eq_(len(orig), len(new))
+    for b, b_match in zip(orig, new):
+        assert_dict_equal(b, b_match)
+
+
+def test_bulk_parser_conformance():
+    for filename in CONFORMANCE_FILES:
+        for skip in [True, False]:
+            orig = PB840File(open_func(filename)).extract_raw(skip)
+            new = BulkPB840File(open_func(filename)).extract_raw(skip)
+            assert_same_breaths(orig, new)
+
+
+def test_bulk_parser_with_filters():
+    for kwargs in [
+        dict(rel_bn_interval=[3, 7]),
+        dict(vent_bn_interval=[65427, 65428]),
+        dict(spec_rel_bns=[2, 5, 9]),
+        dict(spec_vent_bns=[65426, 65428]),
+    ]:
+        orig = PB840File(open_func(RAW_UTILS_TEST)).extract_raw(False, **kwargs)
+        new = BulkPB840File(open_func(RAW_UTILS_TEST)).extract_raw(False, **kwargs)
+        assert new
+        assert_same_breaths(orig, new)
+
+
+def test_bulk_hundred_hz():
+    orig = HundredHzFile(open_func(ARDS_AND_COPD)).extract_raw(True)
+    new = BulkHundredHzFile(open_func(ARDS_AND_COPD)).extract_raw(True)
+    assert_same_breaths(orig, new)
+
+
+def test_bulk_parser_tricky_fields():
+    fields = [
+        '1', '-1', '.5', '-.5', '5.', '  3.25', '3.25 ', '1.234', '-0.00', '12345678', '123456789', '1.2.3', '--1',
+        '1-', '', ' ', 'nan', '1e5', '+1', '\t1', '/5', '\x1c2',
+    ]
+    for three_cols in [False, True]:
+        for newline in ['\n', '\r\n']:
+            rows = ['2015-06-03 17:33:08.000000000, 1.0, 2.0'] if three_cols else []
+            for i, field in enumerate(fields):
+                ts = '2015-06-03 17:33:08.{:09d}, '.format(i) if three_cols else ''
+                extra = ', 7' if three_cols and i % 2 else ''
+                rows.append(ts + ('BS, S:{},' if i % 3 else ' BS, S:{},').format(100 + i))
+                rows.extend([
+                    ts + '{}, 2.5{}'.format(field, extra), ts + '1.5, ' + field, ts + '{0}, {0}'.format(field), ts + 'BE'
+                ])
+            path = os.path.join(tempfile.mkdtemp(), 'tricky_fields.csv')
+            with open(path, 'wb') as f:
+                f.write((newline.join(rows) + newline).encode('ascii'))
+            for skip in [True, False]:
+                orig = PB840File(open_func(path)).extract_raw(skip)
+                eq_(len(orig), len(fields))
+                pb840 = BulkPB840File.from_path(path)
+                # repr so nan samples compare equal
+                eq_(repr(pb840.extract_raw(skip)), repr(orig))
+                pb840.close()
+                eq_(repr(BulkPB840File(open_func(path)).extract_raw(skip)), repr(orig))
+
+
+def test_shared_samples():
+    flow = round_samples(np.array([1.25, -0.0, 0.0, -3.1, 0.07, 1.25]))
+    pressure = round_samples(np.array([-7.5, 12.0]))
+    shared = shared_samples(flow, pressure)
+    eq_(repr(shared[0].tolist()), repr(flow.tolist()))
+    eq_(repr(shared[1].tolist()), repr(pressure.tolist()))
+    # too far apart for a table
+    far = np.array([0.5, 1e15])
+    eq_(shared_samples(far, pressure)[0].tolist(), far.tolist())
+    eq_(shared_samples(far[:0])[0].tolist(), [])
+
+
+def test_round_samples_matches_round():
+    vals = np.array([0.125, 0.135, 2.675, -1.005, 1.0049999, 3.14159, -0.001])
+    eq_(round_samples(vals).tolist(), [round(v, 2) for v in vals.tolist()])
+
+
+def test_bulk_parser_from_path():
+    # non ascii bytes are dropped like the text readers do
+    for filename in CONFORMANCE_FILES + [BAD_UNICODE_ERROR]:
+        for skip in [True, False]:
+            orig = PB840File(open_func(filename)).extract_raw(skip)
+            pb840 = BulkPB840File.from_path(filename)
+            new = pb840.extract_raw(skip)
+            pb840.close()
+            assert_same_breaths(orig, new)
+
+
+def test_scan_chunks():
+    with open(RAW_UTILS_TEST2, 'rb') as f:
+        data = f.read()
+    # ignored bytes in a few of the chunks only
+    for pos in sorted([10, data.find(b'BS', 100000) + 1, 300000, 300001], reverse=True):
+        data = data[:pos] + b'\x00\xe9' + data[pos:]
+    path = os.path.join(tempfile.mkdtemp(), 'ignored_bytes.csv')
+    with open(path, 'wb') as f:
+        f.write(data)
+    orig = PB840File(open_func(path)).extract_raw(False)
+    for chunk_size in [2 ** 12, 2 ** 16, len(data)]:
+        scan = scan_chunks(data, 0, 2, False, chunk_size=chunk_size)
+        for start in scan.line_start[scan.kind == BS].tolist():
+            eq_(data[start:start + 4].replace(b'\x00\xe9', b'')[:2], b'BS')
+        eq_(len(scan.flow), sum(len(b['flow']) for b in orig))
+    pb840 = BulkPB840File.from_path(path)
+    assert_same_breaths(orig, pb840.extract_raw(False))
+    pb840.close()
+    assert_same_breaths(orig, parallel_extract(path, False, workers=3))
+
+
+def test_split_on_breaths():
+    with open(RAW_UTILS_TEST2, 'rb') as f:
+        data = f.read()
+    ranges = split_on_breaths(data, 7)
+    eq_(ranges[0][0], 0)
+    eq_(ranges[-1][1], len(data))
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        eq_(end, start)
+        assert data[start:].startswith(b'BS')
+
+
+def test_parallel_extract():
+    for filename in [
+        RAW_UTILS_TEST2, RAW_UTILS_3_COLUMNS_TEST, WITH_TIMESTAMP, BE_NOT_AT_END, BAD_UNICODE_ERROR,
+        SPEEDUP_EXTRA_COLS_ERROR_CASE,
+    ]:
+        for skip in [True, False]:
+            orig = PB840File(open_func(filename)).extract_raw(skip)
+            for workers in [2, 5]:
+                assert_same_breaths(orig, parallel_extract(filename, skip, workers=workers))
+    orig = PB840File(open_func(RAW_UTILS_TEST2)).extract_raw(False, rel_bn_interval=[4, 12])
+    assert_same_breaths(orig, parallel_extract(RAW_UTILS_TEST2, False, rel_bn_interval=[4, 12], workers=3))
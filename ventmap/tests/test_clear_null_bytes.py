@@ -0,0 +1,61 @@
+from io import BytesIO, open, StringIO
+import os
+import tempfile
+
+from nose.tools import assert_dict_equal, eq_
+
+from ventmap.clear_null_bytes import (
+    clear_null_bytes_in_place, has_null_bytes, NullByteFilter, strip_null_bytes
+)
+from ventmap.raw_utils import PB840File
+from ventmap.tests.constants import *
+
+
+def write_with_null_bytes(filename):
+    data = open(filename, 'rb').read()
+    with_nulls = b'\x00' * 10 + data[:500] + b'\x00' + data[500:1000] + b'\x00\x00' + data[1000:]
+    path = os.path.join(tempfile.mkdtemp(), os.path.basename(filename))
+    with open(path, 'wb') as f:
+        f.write(with_nulls)
+    return path, data
+
+
+def test_null_byte_filter():
+    filtered = NullByteFilter(BytesIO(b'\x00\x00ab\x00c\n\x00'))
+    eq_(filtered.read(), b'abc\n')
+
+
+def test_has_null_bytes():
+    desc = StringIO(u'BS, S:1\n1.0, 2.0\n')
+    assert not has_null_bytes(desc)
+    desc = BytesIO(b'BS, S:1\n1.0,\x00 2.0\n')
+    desc.readline()
+    assert has_null_bytes(desc)
+    eq_(desc.tell(), 8)
+
+
+def test_strip_null_bytes_keeps_text_settings():
+    path, data = write_with_null_bytes(RAW_UTILS_TEST)
+    desc = strip_null_bytes(open(path, encoding='ascii', errors='ignore'))
+    eq_(desc.read(), data.decode('ascii'))
+    eq_(strip_null_bytes(open(path, 'rb')).read(), data)
+
+
+def test_extract_file_with_null_bytes():
+    for filename in [RAW_UTILS_TEST, RAW_UTILS_TEST2]:
+        path, data = write_with_null_bytes(filename)
+        # also past the first chunk of lines read
+        with open(path, 'ab') as f:
+            f.write(b'\x00\x00')
+        expected = PB840File(open(filename, encoding='ascii', errors='ignore')).extract_raw(False)
+        for desc in [open(path, encoding='ascii', errors='ignore'), open(path, 'rb')]:
+            breaths = PB840File(desc).extract_raw(False)
+            eq_(len(breaths), len(expected))
+            for b, b_match in zip(breaths, expected):
+                assert_dict_equal(b, b_match)
+
+
+def test_clear_null_bytes_in_place():
+    path, data = write_with_null_bytes(RAW_UTILS_TEST)
+    eq_(clear_null_bytes_in_place(path, chunk_size=64), 13)
+    eq_(open(path, 'rb').read(), data)
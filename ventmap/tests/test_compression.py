@@ -0,0 +1,106 @@
+import bz2
+import gzip
+from io import open
+import lzma
+import os
+import shutil
+import tempfile
+
+from nose import SkipTest
+from nose.tools import assert_raises, eq_
+
+from ventmap.breath_index import build_breath_index
+from ventmap.bulk_parser import BulkPB840File
+from ventmap.compression import detect_compression, open_vent_file, strip_compressed_suffix, zstandard
+from ventmap.preprocess_all_files import preprocess_file
+from ventmap.raw_utils import consolidate_files, extract_raw, read_processed_file
+from ventmap.tests.constants import *
+
+open_func = lambda f: open(f, encoding='ascii', errors='ignore')
+COMPRESSORS = {
+    '.gz': gzip.compress,
+    '.bz2': bz2.compress,
+    '.xz': lzma.compress,
+}
+
+
+def compress_to(filename, dir, suffix):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if suffix == '.zst':
+        data = zstandard.ZstdCompressor().compress(data)
+    else:
+        data = COMPRESSORS[suffix](data)
+    path = os.path.join(dir, os.path.basename(filename) + suffix)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def check_compressed_extract(suffix, compression):
+    dir = tempfile.mkdtemp()
+    for filename in [RAW_UTILS_TEST2, RAW_UTILS_3_COLUMNS_TEST, WITH_TIMESTAMP]:
+        path = compress_to(filename, dir, suffix)
+        eq_(detect_compression(path), compression)
+        expected = list(extract_raw(open_func(filename), False))
+        with open_vent_file(path) as f:
+            eq_(list(extract_raw(f, False)), expected)
+        with open_vent_file(path) as f:
+            eq_(list(extract_raw(f, False, spec_rel_bns=[2, 5])), list(extract_raw(open_func(filename), False, spec_rel_bns=[2, 5])))
+        pb840 = BulkPB840File.from_path(path)
+        eq_(pb840.extract_raw(False), expected)
+        pb840.close()
+
+
+def test_compressed_extract():
+    for suffix, compression in [('.gz', 'gzip'), ('.bz2', 'bzip2'), ('.xz', 'xz')]:
+        check_compressed_extract(suffix, compression)
+
+
+def test_zstd_extract():
+    if zstandard is None:
+        raise SkipTest('zstandard is not installed')
+    check_compressed_extract('.zst', 'zstd')
+
+
+def test_uncompressed_file():
+    eq_(detect_compression(RAW_UTILS_TEST2), None)
+    with open_vent_file(RAW_UTILS_TEST2) as f:
+        eq_(list(extract_raw(f, False)), list(extract_raw(open_func(RAW_UTILS_TEST2), False)))
+
+
+def test_strip_compressed_suffix():
+    eq_(strip_compressed_suffix('/foo/bar.csv.gz'), '/foo/bar.csv')
+    eq_(strip_compressed_suffix('/foo/bar.csv.zst'), '/foo/bar.csv')
+    eq_(strip_compressed_suffix('/foo/bar.csv'), '/foo/bar.csv')
+
+
+def test_breath_index_not_built_for_compressed_file():
+    path = compress_to(RAW_UTILS_TEST2, tempfile.mkdtemp(), '.gz')
+    assert_raises(ValueError, build_breath_index, path)
+
+
+def test_consolidate_compressed_files():
+    dir = tempfile.mkdtemp()
+    plain_dir = os.path.join(dir, 'plain')
+    compressed_dir = os.path.join(dir, 'compressed')
+    os.mkdir(plain_dir)
+    os.mkdir(compressed_dir)
+    shutil.copy(RAW_UTILS_TEST2, os.path.join(plain_dir, 'vent.csv'))
+    shutil.copy(compress_to(RAW_UTILS_TEST2, dir, '.gz'), os.path.join(compressed_dir, 'vent.csv.gz'))
+    consolidate_files([os.path.join(plain_dir, 'vent.csv')], False, plain_dir, to_csv=True)
+    consolidate_files([os.path.join(compressed_dir, 'vent.csv.gz')], False, compressed_dir, to_csv=True)
+    with open(os.path.join(plain_dir, 'vent.csv')) as plain, open(os.path.join(compressed_dir, 'vent.csv')) as compressed:
+        eq_(plain.read(), compressed.read())
+    eq_(list(read_processed_file(os.path.join(plain_dir, 'vent.raw.npy'))),
+        list(read_processed_file(os.path.join(compressed_dir, 'vent.raw.npy'))))
+
+
+def test_preprocess_compressed_file():
+    dir = tempfile.mkdtemp()
+    shutil.copy(RAW_UTILS_TEST2, os.path.join(dir, 'plain.csv'))
+    shutil.copy(compress_to(RAW_UTILS_TEST2, dir, '.xz'), os.path.join(dir, 'compressed.csv.xz'))
+    eq_(preprocess_file(os.path.join(dir, 'compressed.csv.xz')), os.path.join(dir, 'compressed'))
+    preprocess_file(os.path.join(dir, 'plain.csv'))
+    eq_(list(read_processed_file(os.path.join(dir, 'compressed.raw.npy'))),
+        list(read_processed_file(os.path.join(dir, 'plain.raw.npy'))))
@@ -0,0 +1,95 @@
+from io import open
+import os
+import tempfile
+import threading
+import time
+
+from nose.tools import eq_
+
+from ventmap import follow
+from ventmap.follow import FileFollower, follow_breaths
+from ventmap.raw_utils import PB840File
+from ventmap.tests.constants import *
+
+open_func = lambda f: open(f, encoding='ascii', errors='ignore')
+
+
+def make_empty_file():
+    path = os.path.join(tempfile.mkdtemp(), 'capture.csv')
+    open(path, 'wb').close()
+    return path
+
+
+def test_follower_matches_extract_raw():
+    for filename in [RAW_UTILS_TEST2, RAW_UTILS_3_COLUMNS_TEST, WITH_TIMESTAMP, BE_NOT_AT_END]:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        for skip in [True, False]:
+            path = make_empty_file()
+            follower = FileFollower(path, skip)
+            breaths = []
+            with open(path, 'ab') as f:
+                # split writes in the middle of lines
+                for i in range(0, len(data), 333):
+                    f.write(data[i:i + 333])
+                    f.flush()
+                    breaths.extend(follower.poll())
+            breaths.extend(follower.finish())
+            eq_(breaths, PB840File(open_func(filename)).extract_raw(skip))
+            eq_(follower.offset, len(data))
+
+
+def test_first_poll_reads_in_chunks():
+    with open(RAW_UTILS_TEST2, 'rb') as f:
+        data = f.read()
+    path = make_empty_file()
+    with open(path, 'wb') as f:
+        f.write(data)
+    read_chunk_size = follow.READ_CHUNK_SIZE
+    follow.READ_CHUNK_SIZE = 10000
+    try:
+        follower = FileFollower(path)
+        breaths = follower.iter_poll()
+        first = next(breaths)
+        eq_(follower.offset, 10000)
+        breaths = [first] + list(breaths)
+    finally:
+        follow.READ_CHUNK_SIZE = read_chunk_size
+    eq_(follower.latency.count, len(breaths))
+    eq_(breaths + follower.finish(), PB840File(open_func(RAW_UTILS_TEST2)).extract_raw(False))
+
+
+def test_breath_output_when_be_written():
+    path = make_empty_file()
+    follower = FileFollower(path)
+    with open(path, 'a') as f:
+        f.write(u'2016-12-15-11-54-58.672431\nBS, S:1,\n1.0, 2.0\n3.0, ')
+        f.flush()
+        eq_(follower.poll(), [])
+        f.write(u'4.0\nBE\n')
+        f.flush()
+        breaths = follower.poll()
+    eq_(len(breaths), 1)
+    eq_(breaths[0]['flow'], [1.0, 3.0])
+    eq_(breaths[0]['pressure'], [2.0, 4.0])
+    eq_(follower.latency.count, 1)
+    eq_(follower.finish(), [])
+
+
+def test_follow_breaths():
+    path = make_empty_file()
+    with open(RAW_UTILS_TEST2, 'rb') as f:
+        lines = f.readlines()
+
+    def write():
+        with open(path, 'ab') as f:
+            for i in range(0, len(lines), 200):
+                f.writelines(lines[i:i + 200])
+                f.flush()
+                time.sleep(0.01)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    breaths = list(follow_breaths(path, poll_interval=0.005, idle_timeout=0.5))
+    writer.join()
+    eq_(breaths, PB840File(open_func(RAW_UTILS_TEST2)).extract_raw(False))
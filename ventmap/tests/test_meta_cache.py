@@ -0,0 +1,131 @@
+import os
+import pathlib
+import shutil
+import tempfile
+import warnings
+
+from nose.tools import eq_
+import numpy as np
+import pandas as pd
+
+from ventmap import meta_cache
+from ventmap.breath_meta import get_file_breath_meta, get_file_experimental_breath_meta
+from ventmap.meta_cache import BreathMetaCache
+from ventmap.tests.constants import *
+
+
+def assert_frames_equal(expected, result):
+    pd.testing.assert_frame_equal(expected, result, check_dtype=False)
+
+
+def copy_to_tmp(filename):
+    path = os.path.join(tempfile.mkdtemp(), 'vent.csv')
+    shutil.copy(filename, path)
+    return path
+
+
+def test_cache_hit_matches_computed():
+    cache = BreathMetaCache(tempfile.mkdtemp())
+    path = copy_to_tmp(WITH_TIMESTAMP)
+    expected = get_file_breath_meta(path, to_data_frame=True)
+    for _ in range(2):
+        assert_frames_equal(expected, get_file_breath_meta(path, to_data_frame=True, cache=cache))
+    eq_(len(cache.entries()), 1)
+    array = get_file_breath_meta(path, cache=cache)
+    eq_(array[0], expected.columns.tolist())
+    assert_frames_equal(expected, pd.DataFrame(array[1:], columns=array[0]))
+
+    # different functions and parameters are cached separately
+    expected = get_file_experimental_breath_meta(path, to_data_frame=True)
+    assert_frames_equal(expected, get_file_experimental_breath_meta(path, to_data_frame=True, cache=cache))
+    get_file_breath_meta(path, rel_bn_interval=[np.int64(1), np.int64(2)], cache=cache)
+    eq_(len(cache.entries()), 3)
+
+
+def test_cache_hit_keeps_types():
+    # tve1, tvi and other columns mix int 0 with python and numpy floats
+    cache = BreathMetaCache(tempfile.mkdtemp())
+    for filename in [PT0017_CSV, MALFORMED_BREATH]:
+        path = copy_to_tmp(filename)
+        for func in [get_file_breath_meta, get_file_experimental_breath_meta]:
+            expected = func(path)
+            func(path, cache=cache)
+            result = func(path, cache=cache)
+            eq_(len(expected), len(result))
+            for expected_row, row in zip(expected, result):
+                eq_([(type(v), repr(v)) for v in expected_row], [(type(v), repr(v)) for v in row])
+    eq_(len(cache.entries()), 4)
+
+
+def test_cache_numpy_scalars():
+    cache = BreathMetaCache(tempfile.mkdtemp())
+    array = [
+        ['a', 'b', 'c'],
+        [np.int64(3), np.float32(0.5), True],
+        [2 ** 40, 1.25, np.bool_(False)],
+        [np.int32(-7), np.float64(2.5), False],
+    ]
+    assert cache.put('numpy', array)
+    result = cache.get('numpy')
+    eq_([[(type(v), repr(v)) for v in row] for row in result], [[(type(v), repr(v)) for v in row] for row in array])
+    assert not cache.put('too_large', [['a'], [np.int64(2 ** 60)], [1.5]])
+
+
+def test_cache_pathlib_paths():
+    cache = BreathMetaCache(tempfile.mkdtemp())
+    path = copy_to_tmp(WITH_TIMESTAMP)
+    expected = get_file_breath_meta(path, to_data_frame=True)
+    for _ in range(2):
+        assert_frames_equal(expected, get_file_breath_meta(pathlib.Path(path), to_data_frame=True, cache=cache))
+    get_file_breath_meta(path, cache=cache)
+    eq_(len(cache.entries()), 1)
+
+
+def test_warn_when_not_cached():
+    cache = BreathMetaCache(tempfile.mkdtemp())
+    path = copy_to_tmp(WITH_TIMESTAMP)
+    cache.put = lambda key, array: False
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        get_file_breath_meta(path, cache=cache)
+    eq_(len([w for w in caught if 'cannot be cached' in str(w.message)]), 1)
+    eq_(cache.entries(), [])
+
+
+def test_cache_modified_file():
+    cache = BreathMetaCache(tempfile.mkdtemp())
+    path = copy_to_tmp(WITH_TIMESTAMP)
+    get_file_breath_meta(path, cache=cache)
+    shutil.copy(PT0149_CSV, path)
+    assert_frames_equal(
+        get_file_breath_meta(PT0149_CSV, to_data_frame=True), get_file_breath_meta(path, to_data_frame=True, cache=cache)
+    )
+    eq_(len(cache.entries()), 2)
+
+
+def test_cache_eviction_and_invalidation():
+    cache = BreathMetaCache(tempfile.mkdtemp())
+    paths = [copy_to_tmp(f) for f in [WITH_TIMESTAMP, PT0149_CSV, BREATH_META1]]
+    for path in paths:
+        get_file_breath_meta(path, cache=cache)
+    entries = cache.entries()
+    for i, path in enumerate(entries):
+        os.utime(path, (0, 1000 + i))
+    # using the first result makes the second the least recently used
+    cache.get(os.path.basename(entries[0]).replace(meta_cache.CACHE_SUFFIX, ''))
+    cache.evict(cache.size() - 1)
+    eq_(sorted(cache.entries()), sorted([entries[0], entries[2]]))
+
+    cache.invalidate('0.0.0')
+    eq_(len(cache.entries()), 2)
+    old_version = meta_cache.__version__
+    meta_cache.__version__ = '0.0.0'
+    try:
+        get_file_breath_meta(paths[1], cache=cache)
+    finally:
+        meta_cache.__version__ = old_version
+    eq_(len(cache.entries()), 3)
+    cache.invalidate()
+    eq_(len(cache.entries()), 2)
+    cache.clear()
+    eq_(cache.entries(), [])
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import eq_
+
+from ventmap.preprocess_all_files import Manifest, preprocess_files
+from ventmap.tests.constants import *
+
+
+def make_patient_dir():
+    patient_dir = tempfile.mkdtemp()
+    files = []
+    for i, filename in enumerate([RAW_UTILS_TEST, RAW_UTILS_TEST2, WITH_TIMESTAMP]):
+        files.append(os.path.join(patient_dir, '{}.csv'.format(i)))
+        shutil.copy(filename, files[-1])
+    return patient_dir, files
+
+
+def read_outputs(patient_dir):
+    outputs = {}
+    for filename in sorted(os.listdir(patient_dir)):
+        if filename.endswith('.npy'):
+            with open(os.path.join(patient_dir, filename), 'rb') as f:
+                outputs[filename] = f.read()
+    return outputs
+
+
+def test_parallel_preprocessing_matches_serial():
+    serial_dir, serial_files = make_patient_dir()
+    parallel_dir, parallel_files = make_patient_dir()
+    eq_(preprocess_files(serial_files), {})
+    eq_(preprocess_files(parallel_files, workers=2), {})
+    serial = read_outputs(serial_dir)
+    eq_(len(serial), 2 * len(serial_files))
+    eq_(serial, read_outputs(parallel_dir))
+
+
+def test_preprocessing_errors_do_not_stop_batch():
+    patient_dir, files = make_patient_dir()
+    bad_file = os.path.join(patient_dir, 'bad.csv')
+    os.mkdir(bad_file)
+    errors = preprocess_files(files + [bad_file], workers=2)
+    eq_(list(errors), [bad_file])
+    eq_(len(read_outputs(patient_dir)), 2 * len(files))
+
+
+def output_mtimes(patient_dir):
+    return {
+        filename: os.stat(os.path.join(patient_dir, filename)).st_mtime_ns
+        for filename in os.listdir(patient_dir) if filename.endswith('.npy')
+    }
+
+
+def test_manifest_skips_unchanged_files():
+    patient_dir, files = make_patient_dir()
+    eq_(preprocess_files(files), {})
+    manifest = Manifest.for_dir(patient_dir)
+    eq_(sorted(manifest.files), ['0.csv', '1.csv', '2.csv'])
+    assert all(manifest.is_current(f) for f in files)
+
+    first_run = output_mtimes(patient_dir)
+    # touching a file without changing its contents does not reprocess it
+    os.utime(files[0], ns=(0, 0))
+    # a changed file is reprocessed
+    with open(files[1], 'a') as f:
+        f.write('BS, S:1,\n0.0, 0.0\nBE\n')
+    # a file whose output is missing is reprocessed
+    os.remove(os.path.join(patient_dir, '2.raw.npy'))
+    time.sleep(0.01)
+    eq_(preprocess_files(files), {})
+    second_run = output_mtimes(patient_dir)
+    eq_(second_run['0.raw.npy'], first_run['0.raw.npy'])
+    assert second_run['1.raw.npy'] != first_run['1.raw.npy']
+    assert second_run['2.processed.npy'] != first_run['2.processed.npy']
+    eq_(Manifest.for_dir(patient_dir).files['0.csv']['mtime_ns'], 0)
+
+    # outputs are always rewritten if the manifest is not used
+    preprocess_files(files, use_manifest=False)
+    assert output_mtimes(patient_dir)['0.raw.npy'] != second_run['0.raw.npy']
@@ -1,12 +1,20 @@
 from copy import copy
+import hashlib
 from io import open
+import json
 import os
+from os.path import dirname, join
+import tempfile
 
 from nose.tools import assert_dict_equal, assert_list_equal, assert_raises, eq_
+import numpy as np
 
-from ventmap.raw_utils import BadDescriptorError, extract_raw, HundredHzFile, PB840File, process_breath_file, read_processed_file, real_time_extractor
+from ventmap import processed_file
+from ventmap.processed_file import decode_raw, encode_raw, load_processed, load_raw, ProcessedFile, PROCESSED_DTYPE, ProcessedWriter
+from ventmap.raw_utils import BadDescriptorError, consolidate_files, extract_raw, HundredHzFile, PB840File, process_breath_file, read_processed_file, real_time_extractor
 from ventmap.tests.constants import *
 from ventmap.tests.raw_utils_legacy import extract_raw as extract_raw_legacy
+from ventmap.timestamps import OUT_TIMESTAMPS
 
 open_func = lambda f: open(f, encoding='ascii', errors='ignore')
 
@@ -173,6 +181,171 @@ def test_read_processed_file():
     os.remove(out_proc)
 
 
+def test_processed_file_is_structured():
+    out_raw = 'tmp.test.raw.npy'
+    out_proc = 'tmp.test.processed.npy'
+    process_breath_file(open(WITH_TIMESTAMP), False, 'tmp.test')
+    processed = load_processed(out_proc)
+    assert isinstance(processed, np.memmap)
+    eq_(processed.dtype, PROCESSED_DTYPE)
+    breaths = extract_raw(open(WITH_TIMESTAMP), False)
+    eq_(processed['abs_bs'].tolist(), [b['abs_bs_us'] for b in breaths])
+    # nothing in the processed files should need pickle to load
+    np.load(out_raw, allow_pickle=False)
+    np.load(out_proc, allow_pickle=False)
+    os.remove(out_raw)
+    os.remove(out_proc)
+
+
+def test_read_legacy_processed_file():
+    out_raw = 'tmp.test.raw.npy'
+    out_proc = 'tmp.test.processed.npy'
+    for filename in [RAW_UTILS_TEST2, WITH_TIMESTAMP]:
+        process_breath_file(open(filename), False, 'tmp.test')
+        expected = list(read_processed_file(out_raw))
+        # older versions saved a list of rows with mixed types
+        legacy_rows = [
+            [b['rel_bn'], b['vent_bn'], b['abs_bs'], b['bs_time'], b['frame_dur'], b['dt'], start, end]
+            for b, (start, end) in zip(expected, load_processed(out_proc)[['start_idx', 'end_idx']].tolist())
+        ]
+        np.save(out_proc, legacy_rows)
+        eq_(list(read_processed_file(out_raw)), expected)
+    os.remove(out_raw)
+    os.remove(out_proc)
+
+
+def test_processed_file_reader():
+    out_raw = 'tmp.test.raw.npy'
+    out_proc = 'tmp.test.processed.npy'
+    process_breath_file(open(RAW_UTILS_TEST2), False, 'tmp.test')
+    expected = list(read_processed_file(out_raw))
+    processed = ProcessedFile(out_raw)
+    eq_(len(processed), len(expected))
+    for breath, orig in zip(processed, expected):
+        assert isinstance(breath['flow'], np.ndarray)
+        eq_(breath['flow'].tolist(), orig['flow'])
+        eq_(breath['pressure'].tolist(), orig['pressure'])
+    eq_(processed[len(expected)]['vent_bn'], expected[-1]['vent_bn'])
+    eq_([b['rel_bn'] for b in processed[2:5]], [2, 3, 4])
+    eq_([b['rel_bn'] for b in processed[:3]], [1, 2])
+    eq_(len(processed[5:]), len(expected) - 4)
+    eq_(processed.get_rel_bn(10)['vent_bn'], expected[9]['vent_bn'])
+    eq_(processed[10]['vent_bn'], expected[9]['vent_bn'])
+    eq_(processed[5:8][6]['rel_bn'], 6)
+    eq_(processed.get_vent_bn(expected[9]['vent_bn'])['rel_bn'], 10)
+    eq_([b['rel_bn'] for b in processed.get_rel_bn_interval(3, 6)], [3, 4, 5, 6])
+    assert_raises(KeyError, processed.get_rel_bn, len(expected) + 1)
+    assert_raises(KeyError, processed.__getitem__, 0)
+    assert_raises(KeyError, processed.__getitem__, -1)
+    eq_(list(ProcessedFile(out_raw, as_lists=True)), expected)
+    os.remove(out_raw)
+    os.remove(out_proc)
+
+
+def test_processed_writer():
+    process_breath_file(open(RAW_UTILS_TEST2), False, 'tmp.test')
+    expected = list(read_processed_file('tmp.test.raw.npy'))
+    # small buffer so metadata is flushed several times
+    with ProcessedWriter('tmp.test2', buffer_size=3) as writer:
+        for breath in extract_raw(open(RAW_UTILS_TEST2), False):
+            writer.add_breath(
+                breath['rel_bn'], breath['vent_bn'], breath['abs_bs_us'], breath['bs_time'],
+                breath['frame_dur'], breath['dt'], breath['flow'], breath['pressure']
+            )
+    eq_(list(read_processed_file('tmp.test2.raw.npy')), expected)
+    eq_(np.load('tmp.test2.processed.npy').tolist(), np.load('tmp.test.processed.npy').tolist())
+    for filename in ['tmp.test', 'tmp.test2']:
+        os.remove(filename + '.raw.npy')
+        os.remove(filename + '.processed.npy')
+
+
+def test_consolidate_files():
+    dir = tempfile.mkdtemp()
+    consolidate_files([RAW_UTILS_TEST2, WITH_TIMESTAMP], False, dir, to_csv=True)
+    name = os.path.basename(RAW_UTILS_TEST2).replace('.csv', '')
+    expected = extract_raw(open(RAW_UTILS_TEST2), False) + extract_raw(open(WITH_TIMESTAMP), False)
+    consolidated = list(read_processed_file(os.path.join(dir, name + '.raw.npy')))
+    eq_([b['rel_bn'] for b in consolidated], list(range(1, len(expected) + 1)))
+    eq_([b['abs_bs'] for b in consolidated], [b['abs_bs'] for b in expected])
+    eq_([b['flow'] for b in consolidated], [b['flow'] for b in expected])
+    breaths = extract_raw(open(os.path.join(dir, name + '.csv')), False)
+    eq_([b['vent_bn'] for b in breaths], [b['vent_bn'] for b in expected])
+    eq_([b['pressure'] for b in breaths], [[round(p, 2) for p in b['pressure']] for b in expected])
+    eq_([f for f in os.listdir(dir) if f.endswith('.tmp')], [])
+
+
+def test_encoded_processed_file():
+    for compress in [False, True]:
+        process_breath_file(open(RAW_UTILS_TEST2), False, 'tmp.test')
+        process_breath_file(open(RAW_UTILS_TEST2), False, 'tmp.enc', encode=True, compress=compress)
+        assert not os.path.exists('tmp.enc.raw.npy')
+        raw, encoded = load_raw('tmp.test.raw.npy'), load_raw('tmp.enc.raw.npz')
+        eq_(raw.tobytes(), encoded.tobytes())
+        eq_(list(read_processed_file('tmp.enc.raw.npz')), list(read_processed_file('tmp.test.raw.npy')))
+        assert os.path.getsize('tmp.enc.raw.npz') < os.path.getsize('tmp.test.raw.npy') / 3
+        for filename in ['tmp.test.raw.npy', 'tmp.test.processed.npy', 'tmp.enc.raw.npz', 'tmp.enc.processed.npy']:
+            os.remove(filename)
+
+
+def test_encode_raw():
+    raw = np.array([[1.5, -0.0], [-2.25, 3.0], [300.07, 0.01], [-3.28, 20.0]])
+    encoded = encode_raw(raw, [0, 2])
+    eq_(encoded['deltas'].dtype, np.int16)
+    eq_(decode_raw(encoded).tobytes(), raw.tobytes())
+    # deltas that do not fit in int16
+    raw[3, 0] = 9000.0
+    encoded = encode_raw(raw, [0, 2])
+    eq_(encoded['deltas'].dtype, np.int32)
+    eq_(decode_raw(encoded).tobytes(), raw.tobytes())
+    # more than 2 decimals cannot be encoded exactly
+    raw[0, 0] = 1.505
+    assert 'raw' in encode_raw(raw, [0, 2])
+    eq_(decode_raw(encode_raw(raw, [0, 2])).tobytes(), raw.tobytes())
+
+
+def test_processed_writer_encoded():
+    dir = tempfile.mkdtemp()
+    breaths = [
+        [[1.5, -2.25], [-0.0, 3.0]],
+        [[], []],
+        [[300.07, -3.28, 0.0], [0.01, 20.0, -0.0]],
+        [[], []],
+    ]
+    for last_flow, dtype in [(-3.28, np.int16), (9000.0, np.int32), (1.505, None)]:
+        breaths[2][0][1] = last_flow
+        prefix = os.path.join(dir, 'tmp')
+        chunk_size = processed_file.ENCODE_CHUNK_SIZE
+        # copy a couple of rows at a time
+        processed_file.ENCODE_CHUNK_SIZE = 2
+        try:
+            with ProcessedWriter(prefix, buffer_size=3, encode=True, compress=True) as writer:
+                for i, (flow, pressure) in enumerate(breaths):
+                    writer.add_breath(i + 1, i + 1, None, 0.02, 0.0, 0.02, flow, pressure)
+        finally:
+            processed_file.ENCODE_CHUNK_SIZE = chunk_size
+        raw = np.concatenate([np.array(breath, dtype=np.float64).transpose() for breath in breaths])
+        expected = encode_raw(raw, load_processed(prefix + '.processed.npy')['start_idx'])
+        with np.load(prefix + '.raw.npz') as npz:
+            eq_(sorted(npz.files), sorted(expected))
+            for name in expected:
+                eq_(npz[name].dtype, expected[name].dtype)
+                eq_(npz[name].tobytes(), expected[name].tobytes())
+            if dtype is not None:
+                eq_(npz['deltas'].dtype, dtype)
+        eq_(load_raw(prefix + '.raw.npz').tobytes(), raw.tobytes())
+        eq_(sorted(os.listdir(dir)), ['tmp.processed.npy', 'tmp.raw.npz'])
+
+
+def test_consolidate_files_encoded():
+    dir = tempfile.mkdtemp()
+    consolidate_files([RAW_UTILS_TEST2, WITH_TIMESTAMP], False, dir)
+    name = os.path.join(dir, os.path.basename(RAW_UTILS_TEST2).replace('.csv', ''))
+    os.rename(name + '.raw.npy', name + '.plain.npy')
+    consolidate_files([RAW_UTILS_TEST2, WITH_TIMESTAMP], False, dir, encode=True, compress=True)
+    assert not os.path.exists(name + '.raw.npy')
+    eq_(load_raw(name + '.raw.npz').tobytes(), load_raw(name + '.plain.npy').tobytes())
+
+
 def test_bad_unicode_error():
     gen = extract_raw(open(BAD_UNICODE_ERROR, encoding='ascii', errors='ignore'), False)
     has_breaths = False
@@ -253,3 +426,57 @@ def test_hundred_hz():
         assert breath['dt'] == 0.01
         assert breath['bs_time'] == round(0.01 + prev_breaths_len, 2), (breath['bs_time'], 0.01 + prev_breaths_len)
         prev_breaths_len += breath['frame_dur']
+
+
+def summarize_breath(breath, keys):
+    """
+    Put a breath in the format of the stored baseline, where flow and pressure
+    are replaced by their length and a hash
+    """
+    summary = {key: breath[key] for key in keys}
+    for key in ['flow', 'pressure']:
+        values = breath[key]
+        summary[key] = [len(values), hashlib.sha256(json.dumps(values).encode('utf-8')).hexdigest()[:16]]
+    return summary
+
+
+def test_iter_breaths_matches_baseline():
+    """
+    Compare iter_breaths with output stored from extract_raw before it was
+    rewritten on top of iter_breaths
+    """
+    gen = PB840File(open_func(RAW_UTILS_TEST2)).iter_breaths(False)
+    assert not isinstance(gen, list)
+    eq_(next(gen)['rel_bn'], 1)
+
+    with open(EXTRACT_RAW_BASELINE) as f:
+        cases = json.load(f)
+    for case in cases:
+        gen = PB840File(open_func(join(dirname(RAW_UTILS_TEST), case['file']))).iter_breaths(
+            case['skip_breaths_without_be'], **case['kwargs']
+        )
+        breaths = [summarize_breath(b, case['breaths'][0].keys() if case['breaths'] else []) for b in gen]
+        eq_(len(case['breaths']), len(breaths), case)
+        for b, b_match in zip(case['breaths'], breaths):
+            assert_dict_equal(b, b_match)
+
+
+def test_iter_breaths_with_interval():
+    gen = PB840File(open_func(RAW_UTILS_TEST)).iter_breaths(False, vent_bn_interval=[65427, 65428])
+    eq_([b['vent_bn'] for b in gen], [65427, 65428])
+
+
+def test_numeric_abs_bs():
+    breaths = PB840File(open_func(RAW_UTILS_TEST2)).extract_raw(False)
+    unformatted = PB840File(open_func(RAW_UTILS_TEST2), format_timestamps=False).extract_raw(False)
+    eq_(len(breaths), len(unformatted))
+    for b, b_match in zip(breaths, unformatted):
+        eq_(OUT_TIMESTAMPS.to_epoch_us(b['abs_bs']), b['abs_bs_us'])
+        eq_(b_match['abs_bs_us'], b['abs_bs_us'])
+        assert b_match['abs_bs'] is None
+
+
+def test_no_abs_bs():
+    for b in PB840File(open_func(RAW_UTILS_TEST)).extract_raw(False):
+        assert b['abs_bs'] is None
+        assert b['abs_bs_us'] is None
@@ -0,0 +1,75 @@
+from datetime import datetime
+import gzip
+from io import open
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_
+
+from ventmap.raw_utils import extract_raw
+from ventmap.tests.constants import *
+from ventmap.time_index import extract_by_time_range, PatientTimeIndex, TIME_INDEX_NAME
+
+open_func = lambda f: open(f, encoding='ascii', errors='ignore')
+
+
+def make_patient_dir():
+    dir = tempfile.mkdtemp()
+    shutil.copy(PT0149_CSV, os.path.join(dir, 'a.csv'))
+    shutil.copy(RAW_UTILS_TEST2, os.path.join(dir, 'b.csv'))
+    with open(WITH_TIMESTAMP, 'rb') as f, gzip.open(os.path.join(dir, 'c.csv.gz'), 'wb') as out:
+        out.write(f.read())
+    return dir
+
+
+def brute_force(start, end):
+    breaths = []
+    for filename in [PT0149_CSV, RAW_UTILS_TEST2, WITH_TIMESTAMP]:
+        breaths.extend(b for b in extract_raw(open_func(filename), False) if start <= b['abs_bs_us'] <= end)
+    return sorted(breaths, key=lambda b: b['abs_bs_us'])
+
+
+def strip_filename(breaths):
+    for breath in breaths:
+        del breath['filename']
+    return breaths
+
+
+def test_extract_by_time_range():
+    dir = make_patient_dir()
+    pt0149 = extract_raw(open_func(PT0149_CSV), False)
+    start, end = pt0149[5]['abs_bs_us'], pt0149[30]['abs_bs_us']
+    breaths = extract_by_time_range(dir, start, end)
+    eq_(set(b['filename'] for b in breaths), {os.path.join(dir, 'a.csv')})
+    # like extract_raw with a breath filter, bs_time counts from the first breath output
+    eq_(strip_filename(breaths), extract_raw(open_func(PT0149_CSV), False, rel_bn_interval=[6, 31]))
+
+    # compressed files are parsed instead of seeked but give the same breaths
+    with_ts = extract_raw(open_func(WITH_TIMESTAMP), False)
+    breaths = extract_by_time_range(dir, with_ts[1]['abs_bs_us'], with_ts[2]['abs_bs_us'])
+    eq_(set(b['filename'] for b in breaths), {os.path.join(dir, 'c.csv.gz')})
+    eq_(strip_filename(breaths), extract_raw(open_func(WITH_TIMESTAMP), False, rel_bn_interval=[2, 3]))
+
+    # a range covering every file
+    start, end = datetime(2000, 1, 1), datetime(2030, 1, 1)
+    breaths = strip_filename(extract_by_time_range(dir, start, end))
+    eq_(sorted(breaths, key=lambda b: b['abs_bs_us']), brute_force(0, 2 ** 62))
+    eq_(extract_by_time_range(dir, datetime(2001, 1, 1), datetime(2001, 1, 2)), [])
+
+
+def test_time_index_updates():
+    dir = make_patient_dir()
+    index = PatientTimeIndex.for_dir(dir)
+    eq_(index.update(), True)
+    index.save()
+    assert os.path.exists(os.path.join(dir, TIME_INDEX_NAME))
+    index = PatientTimeIndex.for_dir(dir)
+    eq_(sorted(index.files), ['a.csv', 'b.csv', 'c.csv.gz'])
+    eq_(index.update(), False)
+    pt0149 = extract_raw(open_func(PT0149_CSV), False)
+    eq_(index.files['a.csv']['first_abs_bs'], pt0149[0]['abs_bs_us'])
+    eq_(index.files['a.csv']['last_abs_bs'], pt0149[-1]['abs_bs_us'])
+    os.remove(os.path.join(dir, 'b.csv'))
+    eq_(index.update(), True)
+    eq_(sorted(index.files), ['a.csv', 'c.csv.gz'])
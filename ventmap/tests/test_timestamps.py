@@ -0,0 +1,38 @@
+from datetime import datetime
+
+from dateutil import parser
+from nose.tools import assert_raises, eq_
+
+from ventmap.constants import IN_DATETIME_FORMAT, OUT_DATETIME_FORMAT
+from ventmap.timestamps import (
+    datetime_to_epoch_us, epoch_us_to_datetime, IN_TIMESTAMPS, NO_TIMESTAMP, OUT_TIMESTAMPS, THREE_COL_TIMESTAMPS
+)
+
+
+def test_in_timestamps():
+    for ts in ['2016-12-15-11-54-58.672431', '2016-12-15-11-54-58.6', '2016-02-29-23-59-59.999999']:
+        eq_(IN_TIMESTAMPS.to_datetime(ts), datetime.strptime(ts, IN_DATETIME_FORMAT))
+        eq_(IN_TIMESTAMPS.to_epoch_us(ts), datetime_to_epoch_us(datetime.strptime(ts, IN_DATETIME_FORMAT)))
+    # non fixed width timestamps are still accepted
+    eq_(IN_TIMESTAMPS.to_datetime('2016-12-5-1-54-58.672431'), datetime(2016, 12, 5, 1, 54, 58, 672431))
+    assert_raises(ValueError, IN_TIMESTAMPS.to_datetime, '2016-13-15-11-54-58.672431')
+    assert_raises(ValueError, IN_TIMESTAMPS.to_datetime, '2016-12-15-24-54-58.672431')
+
+
+def test_three_col_timestamps():
+    eq_(THREE_COL_TIMESTAMPS.to_datetime('2015-06-03 17:33:08.421956857'), datetime(2015, 6, 3, 17, 33, 8, 421956))
+    for ts in ['2015-06-03 17:33:08.421956', '2015-06-03 17:33:08.42', '2015-06-03 17:33:08', '2015-06-03T17:33:08.1']:
+        eq_(THREE_COL_TIMESTAMPS.to_datetime(ts), parser.parse(ts))
+    eq_(THREE_COL_TIMESTAMPS.to_epoch_us('1970-01-02 00:00:01.5'), 86401500000)
+
+
+def test_out_timestamps():
+    ts = '2016-12-15 11-54-58.672431'
+    eq_(OUT_TIMESTAMPS.to_datetime(ts), datetime.strptime(ts, OUT_DATETIME_FORMAT))
+
+
+def test_epoch_round_trip():
+    dt = datetime(1969, 12, 31, 23, 59, 59, 999999)
+    eq_(epoch_us_to_datetime(datetime_to_epoch_us(dt)), dt)
+    eq_(datetime_to_epoch_us(None), NO_TIMESTAMP)
+    eq_(epoch_us_to_datetime(NO_TIMESTAMP), None)
@@ -0,0 +1,79 @@
+from io import open
+import tempfile
+
+from nose.tools import eq_
+import numpy as np
+import pandas as pd
+
+from ventmap.breath_meta import get_file_breath_meta, get_file_breath_meta_features, get_file_experimental_breath_meta
+from ventmap.constants import EXPERIMENTAL_META_HEADER, META_HEADER
+from ventmap.meta_cache import BreathMetaCache
+from ventmap.raw_utils import extract_raw
+from ventmap.tests.constants import *
+from ventmap.timestamps import OUT_TIMESTAMPS
+
+
+def assert_typed_matches(expected, typed):
+    eq_(list(typed.dtype.names), expected[0])
+    eq_(len(typed), len(expected) - 1)
+    for i, name in enumerate(expected[0]):
+        values = [row[i] for row in expected[1:]]
+        if name.startswith('abs_time'):
+            values = [OUT_TIMESTAMPS.to_epoch_us(v) if v != '-' else -2 ** 63 for v in values]
+            np.testing.assert_array_equal(np.array(values, dtype=np.int64), typed[name].view(np.int64))
+        elif name == ' ':
+            assert np.isnan(typed[name]).all()
+        else:
+            np.testing.assert_array_equal(np.array(values, dtype=typed[name].dtype), typed[name])
+
+
+def test_typed_matches_lists():
+    for filename in [WITH_TIMESTAMP, BREATH_META1]:
+        assert_typed_matches(get_file_breath_meta(filename), get_file_breath_meta(filename, typed=True))
+    typed = get_file_experimental_breath_meta(WITH_TIMESTAMP, typed=True)
+    assert_typed_matches(get_file_experimental_breath_meta(WITH_TIMESTAMP), typed)
+    eq_(typed['BN'].dtype, np.int64)
+    eq_(typed['x0_index'].dtype, np.int64)
+    eq_(typed['abs_time_at_x0'].dtype, np.dtype('datetime64[us]'))
+    eq_(typed['tvi'].dtype, np.float64)
+    # file without timestamps
+    assert np.isnat(get_file_breath_meta(BREATH_META1, typed=True)['abs_time_at_BE']).all()
+
+
+def test_typed_data_frame():
+    df = get_file_breath_meta(PT0149_CSV, to_data_frame=True, typed=True, n_jobs=2)
+    eq_(list(df.columns), META_HEADER)
+    eq_(df['ventBN'].dtype, np.int64)
+    eq_(df['abs_time_at_BS'].dtype, np.dtype('datetime64[ns]'))
+    eq_(df['PEEP'].dtype, np.float64)
+    typed = get_file_breath_meta(extract_raw(open(PT0149_CSV), True), typed=True)
+    for name in META_HEADER:
+        np.testing.assert_array_equal(typed[name], df[name].values)
+    df = get_file_breath_meta_features(PT0149_CSV, ['tvi', 'abs_time_at_x0'], to_data_frame=True, typed=True)
+    eq_(list(df.columns), ['tvi', 'abs_time_at_x0'])
+    np.testing.assert_array_equal(typed['tvi'], df['tvi'].values)
+
+
+def test_typed_vectorized():
+    typed = get_file_breath_meta(WITH_TIMESTAMP, vectorized=True, typed=True)
+    expected = get_file_breath_meta(WITH_TIMESTAMP, typed=True)
+    eq_(typed.dtype, expected.dtype)
+    for name in META_HEADER:
+        if expected[name].dtype == np.float64:
+            np.testing.assert_allclose(expected[name], typed[name], rtol=1e-9)
+        else:
+            np.testing.assert_array_equal(expected[name], typed[name])
+
+
+def test_typed_cache():
+    cache = BreathMetaCache(tempfile.mkdtemp())
+    expected = get_file_experimental_breath_meta(WITH_TIMESTAMP, typed=True)
+    for _ in range(2):
+        typed = get_file_experimental_breath_meta(WITH_TIMESTAMP, typed=True, cache=cache)
+        eq_(typed.dtype, expected.dtype)
+        for name in EXPERIMENTAL_META_HEADER:
+            np.testing.assert_array_equal(expected[name], typed[name])
+    eq_(len(cache.entries()), 1)
+    df = get_file_experimental_breath_meta(WITH_TIMESTAMP, typed=True, to_data_frame=True, cache=cache)
+    pd.testing.assert_frame_equal(get_file_experimental_breath_meta(WITH_TIMESTAMP, typed=True, to_data_frame=True), df)
+    eq_(len(cache.entries()), 1)
@@ -0,0 +1,184 @@
+"""
+ventmap.time_index
+~~~~~~~~~~~~~~~~~~
+
+Find breaths by absolute time across all the files in a patient's directory.
+
+A time index is kept in each patient directory recording the first and last
+breath start of every ventilator file in it. Where each breath starts in a
+file, and at what time, comes from the file's breath index sidecar (see
+ventmap.breath_index). A time range query only opens the files overlapping
+the range and seeks straight to the matching breaths. Compressed files
+cannot have a breath index so they are parsed from the start.
+
+Usage:
+
+    breaths = extract_by_time_range('/path/to/0149', datetime(2016, 2, 17, 2), datetime(2016, 2, 17, 4, 30))
+"""
+from glob import glob
+from io import open
+import json
+import os
+
+from ventmap.breath_index import get_breath_index
+from ventmap.compression import COMPRESSED_SUFFIXES, detect_compression, open_vent_file
+from ventmap.raw_utils import PB840File
+from ventmap.timestamps import seconds_to_us, to_epoch_us
+
+TIME_INDEX_NAME = '.ventmap_time_index.json'
+TIME_INDEX_VERSION = 1
+
+
+def find_vent_files(patient_dir):
+    """
+    Find all ventilator files in a directory, compressed or not
+    """
+    files = glob(os.path.join(str(patient_dir), '*.csv'))
+    for suffix in COMPRESSED_SUFFIXES:
+        files.extend(glob(os.path.join(str(patient_dir), '*.csv' + suffix)))
+    return sorted(files)
+
+
+def get_breath_times(path, vent_cls=PB840File):
+    """
+    Get the start time of every breath in a file in microseconds since the
+    epoch. Breaths without a timestamp are None.
+    """
+    if detect_compression(path) is None:
+        return get_breath_index(path).abs_bs_us(seconds_to_us(vent_cls.dt))
+    with open_vent_file(path) as f:
+        return [breath['abs_bs_us'] for breath in vent_cls(f, format_timestamps=False).iter_breaths(False)]
+
+
+class PatientTimeIndex(object):
+    def __init__(self, path):
+        """
+        :param path: path to the time index file. It is created on save if it does not exist
+        """
+        self.path = path
+        self.files = {}
+        try:
+            with open(path) as f:
+                index = json.load(f)
+            if index.get('version') == TIME_INDEX_VERSION:
+                self.files = index['files']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    @classmethod
+    def for_dir(cls, patient_dir):
+        return cls(os.path.join(str(patient_dir), TIME_INDEX_NAME))
+
+    @property
+    def dir(self):
+        return os.path.dirname(self.path)
+
+    def update(self, vent_cls=PB840File):
+        """
+        Bring the index up to date with the files in the directory. Only new
+        or modified files are read. Returns True if anything changed.
+        """
+        changed = False
+        names = set()
+        for path in find_vent_files(self.dir):
+            name = os.path.basename(path)
+            names.add(name)
+            stat = os.stat(path)
+            entry = self.files.get(name)
+            if entry is not None and (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            times = [t for t in get_breath_times(path, vent_cls) if t is not None]
+            self.files[name] = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'first_abs_bs': min(times) if times else None,
+                'last_abs_bs': max(times) if times else None,
+            }
+            changed = True
+        for name in set(self.files) - names:
+            del self.files[name]
+            changed = True
+        return changed
+
+    def files_in_range(self, start, end):
+        """
+        Get the paths of files with breaths starting between start and end,
+        ordered by their first breath
+
+        :param start: datetime or microseconds since the epoch
+        :param end: datetime or microseconds since the epoch
+        """
+        start, end = to_epoch_us(start), to_epoch_us(end)
+        overlapping = [
+            (entry['first_abs_bs'], name) for name, entry in self.files.items()
+            if entry['first_abs_bs'] is not None and entry['first_abs_bs'] <= end and entry['last_abs_bs'] >= start
+        ]
+        return [os.path.join(self.dir, name) for _, name in sorted(overlapping)]
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'version': TIME_INDEX_VERSION, 'files': self.files}, indent=1, sort_keys=True))
+        os.replace(tmp_path, self.path)
+
+
+def iter_file_time_range(path, start, end, skip_breaths_without_be=False, vent_cls=PB840File):
+    """
+    Yield the breaths of a single file that start between start and end.
+    Breaths are the same as extract_raw outputs when filtering on their
+    relative breath numbers, so bs_time counts from the first breath output.
+    """
+    start, end = to_epoch_us(start), to_epoch_us(end)
+    if detect_compression(path) is None:
+        index = get_breath_index(path)
+        times = zip(index.breaths['rel_bn'].tolist(), index.abs_bs_us(seconds_to_us(vent_cls.dt)))
+        open_file = lambda: vent_cls(open(path, encoding='ascii', errors='ignore'), breath_index=index)
+    else:
+        # there is no index to find breaths with so the file is parsed twice
+        with open_vent_file(path) as f:
+            times = [(b['rel_bn'], b['abs_bs_us']) for b in vent_cls(f, format_timestamps=False).iter_breaths(False)]
+        open_file = lambda: vent_cls(open_vent_file(path))
+    rel_bns = [rel_bn for rel_bn, t in times if t is not None and start <= t <= end]
+    if not rel_bns:
+        return
+    # contiguous breaths are read as an interval, which is cheaper than a set of breaths
+    if rel_bns[-1] - rel_bns[0] + 1 == len(rel_bns):
+        filters = {'rel_bn_interval': [rel_bns[0], rel_bns[-1]]}
+    else:
+        filters = {'spec_rel_bns': rel_bns}
+    vent_file = open_file()
+    try:
+        for breath in vent_file.iter_breaths(skip_breaths_without_be, **filters):
+            yield breath
+    finally:
+        vent_file.descriptor.close()
+
+
+def iter_by_time_range(patient_dir, start, end, skip_breaths_without_be=False, vent_cls=PB840File):
+    """
+    Yield all breaths in a patient's directory that start between start and
+    end. See extract_by_time_range.
+    """
+    index = PatientTimeIndex.for_dir(patient_dir)
+    if index.update(vent_cls):
+        index.save()
+    for path in index.files_in_range(start, end):
+        for breath in iter_file_time_range(path, start, end, skip_breaths_without_be, vent_cls):
+            breath['filename'] = path
+            yield breath
+
+
+def extract_by_time_range(patient_dir, start, end, skip_breaths_without_be=False, vent_cls=PB840File):
+    """
+    Extract all breaths in a patient's directory that start between start and
+    end inclusive. Breaths are in the format output by extract_raw, plus the
+    filename they came from, and are ordered by file then by breath. The time
+    index and breath indices are built or refreshed as needed.
+
+    :param patient_dir: directory holding the patient's ventilator files
+    :param start: datetime or microseconds since the epoch
+    :param end: datetime or microseconds since the epoch
+    :param skip_breaths_without_be: same as for extract_raw
+    :param vent_cls: ventilator class to parse the files with
+    """
+    return list(iter_by_time_range(patient_dir, start, end, skip_breaths_without_be, vent_cls))
@@ -0,0 +1,153 @@
+"""
+ventmap.timestamps
+~~~~~~~~~~~~~~~~~~
+
+Fast decoding of the timestamp formats found in ventilator files, and helpers
+for converting timestamps to and from integer microseconds since the unix epoch.
+Timestamps in ventilator files carry no timezone info so everything here works
+on naive datetimes.
+
+Timestamps are decoded by slicing their fixed width fields into ints. Rows
+from the same day share a date prefix so the date part is only decoded once
+per day. Anything that does not look exactly like the expected format is
+handed off to the slower generic parser so behavior never changes.
+"""
+from datetime import date, datetime, timedelta
+import re
+
+from dateutil import parser
+
+from ventmap.constants import IN_DATETIME_FORMAT, OUT_DATETIME_FORMAT
+
+EPOCH = datetime(1970, 1, 1)
+# used in integer timestamp columns when a breath has no absolute timestamp
+NO_TIMESTAMP = -2 ** 63
+
+
+def timedelta_to_us(td):
+    return (td.days * 86400 + td.seconds) * 10 ** 6 + td.microseconds
+
+
+def seconds_to_us(seconds):
+    """
+    Convert seconds into microseconds rounding the same way that
+    timedelta(seconds=seconds) would.
+    """
+    return timedelta_to_us(timedelta(seconds=seconds))
+
+
+def datetime_to_epoch_us(dt):
+    if dt is None:
+        return NO_TIMESTAMP
+    # the generic parser can return timezone aware datetimes. The timezone
+    # was never part of formatted output so it is dropped here
+    return timedelta_to_us(dt.replace(tzinfo=None) - EPOCH)
+
+
+def to_epoch_us(time):
+    """
+    Convert a datetime to microseconds since the epoch. Anything else is
+    assumed to already be in microseconds and is returned unchanged.
+    """
+    return datetime_to_epoch_us(time) if isinstance(time, datetime) else time
+
+
+def epoch_us_to_datetime(us):
+    if us is None or us == NO_TIMESTAMP:
+        return None
+    return EPOCH + timedelta(microseconds=int(us))
+
+
+class TimestampFormatter(object):
+    def __init__(self, date_fmt, time_fmt):
+        """
+        Format epoch microseconds as strings. Equivalent to strftime with
+        date_fmt + time_fmt, but the date part is only formatted once per day.
+
+        :param date_fmt: strftime format for the date
+        :param time_fmt: %% style format taking hours, minutes, seconds and microseconds
+        """
+        self.date_fmt = date_fmt
+        self.time_fmt = time_fmt
+        self._cached_day = (None, None)
+
+    def format(self, us):
+        day, us_of_day = divmod(us, 86400 * 10 ** 6)
+        cached = self._cached_day
+        if day != cached[0]:
+            cached = self._cached_day = (day, (EPOCH + timedelta(days=day)).strftime(self.date_fmt))
+        seconds, us_of_day = divmod(us_of_day, 10 ** 6)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return cached[1] + self.time_fmt % (hours, minutes, seconds, us_of_day)
+
+
+# OUT_DATETIME_FORMAT
+OUT_FORMATTER = TimestampFormatter('%Y-%m-%d', ' %02d-%02d-%02d.%06d')
+# IN_DATETIME_FORMAT
+IN_FORMATTER = TimestampFormatter('%Y-%m-%d', '-%02d-%02d-%02d.%06d')
+
+
+class TimestampDecoder(object):
+    def __init__(self, date_time_sep, time_sep, fallback, trim_nanoseconds=False):
+        """
+        :param date_time_sep: character separating the date from the time
+        :param time_sep: character separating hours, minutes and seconds
+        :param fallback: function used to parse timestamps not in the expected format
+        :param trim_nanoseconds: drop the last 3 digits of 29 character timestamps
+        """
+        self.regex = re.compile(r'(\d{{4}}-\d{{2}}-\d{{2}}){}(\d{{2}}){}(\d{{2}}){}(\d{{2}})\.(\d{{1,6}})$'.format(
+            re.escape(date_time_sep), re.escape(time_sep), re.escape(time_sep)
+        ))
+        self.fallback = fallback
+        self.trim_nanoseconds = trim_nanoseconds
+        # (date prefix, date, epoch microseconds at midnight)
+        self._cached_date = (None, None, None)
+
+    def _match(self, ts):
+        if self.trim_nanoseconds and len(ts) == 29:
+            ts = ts[:-3]
+        match = self.regex.match(ts)
+        if not match:
+            return ts, None
+        prefix, hour, minute, second, frac = match.groups()
+        cached = self._cached_date
+        if prefix != cached[0]:
+            try:
+                day = date(int(prefix[:4]), int(prefix[5:7]), int(prefix[8:10]))
+            except ValueError:
+                return ts, None
+            cached = self._cached_date = (prefix, day, (day - EPOCH.date()).days * 86400 * 10 ** 6)
+        hour, minute, second = int(hour), int(minute), int(second)
+        if hour > 23 or minute > 59 or second > 59:
+            return ts, None
+        return ts, (cached[1], cached[2], hour, minute, second, int(frac) * 10 ** (6 - len(frac)))
+
+    def to_datetime(self, ts):
+        ts, fields = self._match(ts)
+        if fields is None:
+            return self.fallback(ts)
+        day, _, hour, minute, second, us = fields
+        return datetime(day.year, day.month, day.day, hour, minute, second, us)
+
+    def to_epoch_us(self, ts):
+        ts, fields = self._match(ts)
+        if fields is None:
+            return datetime_to_epoch_us(self.fallback(ts))
+        _, day_us, hour, minute, second, us = fields
+        return day_us + ((hour * 60 + minute) * 60 + second) * 10 ** 6 + us
+
+
+def _parse_3_col_timestamp(ts):
+    try:
+        return parser.parse(ts)
+    except:
+        return datetime.strptime(ts, IN_DATETIME_FORMAT)
+
+
+# timestamp lines in 2 column files, eg. 2016-12-15-11-54-58.672431
+IN_TIMESTAMPS = TimestampDecoder('-', '-', lambda ts: datetime.strptime(ts, IN_DATETIME_FORMAT))
+# first column of 3 column files, eg. 2015-06-03 17:33:08.421956857
+THREE_COL_TIMESTAMPS = TimestampDecoder(' ', ':', _parse_3_col_timestamp, trim_nanoseconds=True)
+# abs_bs timestamps output by ventmap, eg. 2016-12-15 11-54-58.672431
+OUT_TIMESTAMPS = TimestampDecoder(' ', '-', lambda ts: datetime.strptime(ts, OUT_DATETIME_FORMAT))
@@ -0,0 +1,117 @@
+"""
+ventmap.typed_meta
+~~~~~~~~~~~~~~~~~~
+
+Typed columnar breath meta. Instead of rows of python objects, breath meta is
+kept in one numpy array per column. Breath numbers and x0_index are int64,
+absolute times are datetime64[us] with NaT for files without timestamps, and
+everything else is float64. The ' ' spacer column is all NaN. Columns are
+returned as a numpy record array, or a DataFrame that pandas builds without
+having to infer any types.
+
+For files with many breaths this takes a fraction of the memory of the list
+of rows format and builds DataFrames much faster.
+
+Usage:
+
+    meta = get_file_breath_meta(<filepath>, typed=True)
+    meta['tvi'], meta['abs_time_at_BS']
+"""
+import numpy as np
+import pandas as pd
+
+from ventmap.breath_features import BreathFeatures
+from ventmap.timestamps import NO_TIMESTAMP
+
+INT_COLUMNS = ['BN', 'ventBN', 'x0_index']
+# absolute time columns and the breath_features values giving them in microseconds since epoch
+ABS_TIME_COLUMNS = {
+    'abs_time_at_BS': 'abs_us_at_BS',
+    'abs_time_at_x0': 'abs_us_at_x0',
+    'abs_time_at_BE': 'abs_us_at_BE',
+}
+SPACER_COLUMN = ' '
+TIME_DTYPE = 'datetime64[us]'
+
+
+def column_dtype(name):
+    if name in INT_COLUMNS:
+        return np.dtype(np.int64)
+    elif name in ABS_TIME_COLUMNS:
+        return np.dtype(TIME_DTYPE)
+    return np.dtype(np.float64)
+
+
+def typed_breath_values(breath, header, tve_pos=True):
+    """
+    Get breath meta for a breath as values that can be put in typed columns.
+    Absolute times are given in microseconds, or NO_TIMESTAMP if the breath has
+    no timestamp.
+
+    :param breath: Breath information as given by raw_utils.py
+    :param header: list of column names from EXPERIMENTAL_META_HEADER
+    :param tve_pos: Give a positive value for TVe
+    """
+    features = BreathFeatures(breath, tve_pos)
+    values = []
+    for name in header:
+        if name in ABS_TIME_COLUMNS:
+            us = features[ABS_TIME_COLUMNS[name]]
+            values.append(NO_TIMESTAMP if us is None else us)
+        elif name == SPACER_COLUMN:
+            values.append(np.nan)
+        else:
+            values.append(features[name])
+    return values
+
+
+def fill_columns(header, rows, n_rows):
+    """
+    Put rows from typed_breath_values into preallocated typed columns
+
+    :param header: list of column names
+    :param rows: iterable of n_rows rows
+    :param n_rows: number of rows
+    """
+    # absolute times are filled as int64 microseconds. NO_TIMESTAMP is the same bits as NaT
+    columns = [
+        np.empty(n_rows, dtype=np.int64 if name in ABS_TIME_COLUMNS else column_dtype(name))
+        for name in header
+    ]
+    for i, row in enumerate(rows):
+        for col, value in zip(columns, row):
+            col[i] = value
+    return [
+        col.view(TIME_DTYPE) if name in ABS_TIME_COLUMNS else col
+        for name, col in zip(header, columns)
+    ]
+
+
+def to_typed_output(header, columns, to_data_frame=False):
+    """
+    Make a record array, or a DataFrame if to_data_frame, from typed columns.
+    Absolute time columns can be given as datetime64 or int64 microseconds.
+    """
+    columns = [
+        col.astype(TIME_DTYPE, copy=False) if name in ABS_TIME_COLUMNS else col
+        for name, col in zip(header, columns)
+    ]
+    if not to_data_frame:
+        # np.rec.fromarrays would strip the name of the ' ' column
+        meta = np.empty(len(columns[0]) if columns else 0, dtype=[
+            (name, col.dtype) for name, col in zip(header, columns)
+        ]).view(np.recarray)
+        for name, col in zip(header, columns):
+            meta[name] = col
+        return meta
+    # keyed by position so repeated column names are kept
+    df = pd.DataFrame({i: col for i, col in enumerate(columns)})
+    df.columns = list(header)
+    return df
+
+
+def record_columns(meta):
+    """
+    Get the header and columns of a record array from to_typed_output
+    """
+    return list(meta.dtype.names), [meta[name] for name in meta.dtype.names]